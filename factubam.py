@@ -1,31 +1,33 @@
-import re
-import pdfplumber
 import streamlit as st
 import pandas as pd
-import openpyxl
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from collections import defaultdict
-from datetime import datetime
 import io
-import json
-import base64
 import os
-import hashlib
-from pathlib import Path
-
-# --- CONSTANTES ---
-PRECIO_BN = 0.0098
-PRECIO_COLOR = 0.119
-IVA = 0.21
-
-# --- DIRECTORIOS ---
-DATA_DIR = Path("factubam_data")
-DATA_DIR.mkdir(exist_ok=True)
-HISTORIAL_FILE = DATA_DIR / "historial.json"
-DOCUMENTOS_DIR = DATA_DIR / "documentos"
-DOCUMENTOS_DIR.mkdir(exist_ok=True)
-BASE_EXCEL_FILE = DATA_DIR / "base_inventario.xlsx"  # NUEVO: Ruta para el Excel base
+import tempfile
+from datetime import datetime
+
+import factubam_almacen as almacen
+import factubam_calculo as calculo
+import factubam_core as core
+import factubam_derivados as derivados
+import factubam_export
+from factubam_almacen import DATA_DIR, cargar_inventarios
+from factubam_core import (
+    aplicar_costes,
+    asignar_candidatos_unicos,
+    cargar_tarifas,
+    guardar_escenario,
+    guardar_tarifas,
+    inventario_vigente,
+    normalizar_tarifas,
+    procesar_factura,
+    proponer_candidatos,
+    reevaluar_registro,
+    repreciar_historial,
+    resumen_escenario,
+)
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(
@@ -34,10 +36,29 @@ st.set_page_config(
     layout="wide"
 )
 
+# Streamlit redimensiona en cada rerun las imágenes más anchas que la página;
+# la cabecera se reduce una sola vez por proceso y se reutiliza
+ANCHO_MAXIMO_IMAGEN = 1460
+
+@st.cache_data(show_spinner=False)
+def cargar_cabecera(ruta="Imagenes/cabecera_andalucia.jpg"):
+    """Bytes JPEG de la cabecera ya ajustados al ancho máximo de la página"""
+    from PIL import Image
+
+    with Image.open(ruta) as imagen:
+        if imagen.width > ANCHO_MAXIMO_IMAGEN:
+            imagen = imagen.resize(
+                (ANCHO_MAXIMO_IMAGEN, int(imagen.height * ANCHO_MAXIMO_IMAGEN / imagen.width)),
+                resample=Image.BILINEAR
+            )
+        salida = io.BytesIO()
+        imagen.convert('RGB').save(salida, format='JPEG', quality=90)
+    return salida.getvalue()
+
 # Intentar cargar imagen, si falla no rompe la app
 try:
     st.image(
-        "Imagenes/cabecera_andalucia.jpg",
+        cargar_cabecera(),
         use_container_width=True
     )
 except:
@@ -96,131 +117,29 @@ details summary {
 """, unsafe_allow_html=True)
 
 # ======================================================
-# FUNCIÓN DE REDONDEO EXACTO (TIPO EXCEL/CONTABILIDAD)
-# ======================================================
-def redondear_euro(valor):
-    """
-    Redondea un valor a 2 decimales usando redondeo aritmético (0.5 sube).
-    Esto corrige las discrepancias de céntimos con Excel/PDF.
-    """
-    if valor is None:
-        return 0.0
-    # Se suma 0.5 para asegurar redondeo aritmético correcto en positivos
-    return int(valor * 100 + 0.5) / 100.0
-
-# ======================================================
-# FUNCIONES DE ALMACENAMIENTO Y GESTIÓN
+# ALMACENAMIENTO (AVISOS EN PANTALLA)
 # ======================================================
 def cargar_historial():
-    """Carga el historial desde archivo JSON local de forma segura"""
+    """Carga el historial desde disco mostrando en pantalla los registros que fallan"""
     try:
-        if not HISTORIAL_FILE.exists():
-            return []
-        
-        with open(HISTORIAL_FILE, 'r', encoding='utf-8') as f:
-            historial_data = json.load(f)
-        
-        historial = []
-        for reg_data in historial_data:
-            try:
-                # Cargar DataFrame
-                df_file = DOCUMENTOS_DIR / f"{reg_data['id']}_data.json"
-                
-                # CORRECCIÓN: Verificar que el archivo existe antes de leer
-                if df_file.exists():
-                    with open(df_file, 'r', encoding='utf-8') as f:
-                        df_data = json.load(f)
-                        reg_data['df'] = pd.DataFrame(df_data)
-                else:
-                    # Si no hay datos, saltamos este registro corrupto
-                    continue 
-                
-                # Cargar archivos PDF y Excel
-                pdf_file = DOCUMENTOS_DIR / f"{reg_data['id']}_factura.pdf"
-                excel_file = DOCUMENTOS_DIR / f"{reg_data['id']}_inventario.xlsx"
-                
-                if pdf_file.exists():
-                    with open(pdf_file, 'rb') as f:
-                        reg_data['pdf_bytes'] = f.read()
-                
-                if excel_file.exists():
-                    with open(excel_file, 'rb') as f:
-                        reg_data['excel_bytes'] = f.read()
-                
-                # Solo añadimos si el DataFrame es válido
-                if 'df' in reg_data and isinstance(reg_data['df'], pd.DataFrame):
-                    historial.append(reg_data)
-
-            except Exception as e:
-                st.warning(f"Error al cargar registro {reg_data.get('id', 'desconocido')}: {str(e)}")
-                continue
-        
-        return historial
+        return almacen.cargar_historial(avisar=st.warning)
     except Exception as e:
         st.error(f"Error al cargar historial: {str(e)}")
         return []
 
-def guardar_historial(historial):
-    """Guarda el historial en archivo JSON local"""
+def actualizar_registros(registros, con_datos=True):
+    """Guarda en disco los cambios de los registros indicados"""
     try:
-        historial_simple = []
-        
-        for registro in historial:
-            # Protección: si no hay df válido, no guardar
-            if 'df' not in registro or not isinstance(registro['df'], pd.DataFrame):
-                continue
-
-            reg_simple = {
-                'id': registro['id'],
-                'nombre': registro['nombre'],
-                'fecha_hora': registro['fecha_hora'],
-                'pdf_name': registro['pdf_name'],
-                'excel_name': registro['excel_name'],
-                'dispositivos': registro['dispositivos'],
-                # Guardamos los totales recalculados desde el DF para asegurar consistencia
-                'coste_total_sin_iva': registro['df']['coste_sin_iva'].sum(),
-                'coste_total_con_iva': registro['df']['coste_con_iva'].sum()
-            }
-            historial_simple.append(reg_simple)
-            
-            # Guardar DataFrame como JSON separado
-            df_file = DOCUMENTOS_DIR / f"{registro['id']}_data.json"
-            with open(df_file, 'w', encoding='utf-8') as f:
-                json.dump(registro['df'].to_dict('records'), f, ensure_ascii=False, indent=2)
-            
-            # Guardar archivos PDF y Excel
-            if 'pdf_bytes' in registro:
-                pdf_file = DOCUMENTOS_DIR / f"{registro['id']}_factura.pdf"
-                with open(pdf_file, 'wb') as f:
-                    f.write(registro['pdf_bytes'])
-            
-            if 'excel_bytes' in registro:
-                excel_file = DOCUMENTOS_DIR / f"{registro['id']}_inventario.xlsx"
-                with open(excel_file, 'wb') as f:
-                    f.write(registro['excel_bytes'])
-        
-        # Guardar índice principal
-        with open(HISTORIAL_FILE, 'w', encoding='utf-8') as f:
-            json.dump(historial_simple, f, ensure_ascii=False, indent=2)
-        
+        core.actualizar_registros(registros, con_datos=con_datos)
         return True
     except Exception as e:
         st.error(f"Error al guardar historial: {str(e)}")
         return False
 
 def eliminar_registro_disco(registro_id):
-    """Elimina los archivos de un registro del disco"""
+    """Quita un registro del índice y elimina sus archivos del disco"""
     try:
-        archivos = [
-            DOCUMENTOS_DIR / f"{registro_id}_data.json",
-            DOCUMENTOS_DIR / f"{registro_id}_factura.pdf",
-            DOCUMENTOS_DIR / f"{registro_id}_inventario.xlsx"
-        ]
-        
-        for archivo in archivos:
-            if archivo.exists():
-                archivo.unlink()
-        
+        core.quitar_registro(registro_id)
         return True
     except Exception as e:
         st.error(f"Error al eliminar archivos: {str(e)}")
@@ -229,25 +148,84 @@ def eliminar_registro_disco(registro_id):
 def limpiar_historial_disco():
     """Limpia todo el historial del disco"""
     try:
-        for archivo in DOCUMENTOS_DIR.glob("*"):
-            archivo.unlink()
-        
-        if HISTORIAL_FILE.exists():
-            HISTORIAL_FILE.unlink()
-        
-        # Opcional: Si quisieras también borrar el Excel base al limpiar todo el historial, 
-        # puedes descomentar las dos siguientes líneas, pero por defecto lo dejamos para que sea persistente:
-        # if BASE_EXCEL_FILE.exists():
-        #     BASE_EXCEL_FILE.unlink()
-            
+        core.limpiar_historial_disco()
         return True
     except Exception as e:
         st.error(f"Error al limpiar historial: {str(e)}")
         return False
 
+def marcar_anomalias(df):
+    """Añade al DataFrame la columna de lecturas anómalas (si falla, se muestra sin ella)"""
+    try:
+        return derivados.marcar_anomalias(df)
+    except Exception as e:
+        st.warning(f"No se pudieron evaluar las lecturas anómalas: {str(e)}")
+        return df
+
+def migrar_excel_base():
+    """Migra el Excel base heredado a inventario versionado"""
+    try:
+        core.migrar_excel_base()
+    except Exception as e:
+        st.warning(f"No se pudo migrar el Excel base: {str(e)}")
+
+# Espacio de trabajo de la sesión: se elige al entrar (o con ?espacio=nombre en la URL) y se
+# activa al principio de cada ejecución, antes de leer nada de disco
+CLAVES_DEL_ESPACIO = ['historial_documentos', 'firma_indice', 'registro_seleccionado',
+                      'documentos_seleccionados', 'repercusion', 'exportacion', 'avisos_vistos',
+                      'validacion_previa']
+
+def cambiar_espacio(nombre):
+    """Cambia el espacio de la sesión y descarta todo lo cargado del anterior"""
+    for clave in CLAVES_DEL_ESPACIO:
+        st.session_state.pop(clave, None)
+    st.session_state.espacio = nombre
+    if nombre:
+        st.query_params['espacio'] = nombre
+    elif 'espacio' in st.query_params:
+        del st.query_params['espacio']
+
+if 'espacio' not in st.session_state:
+    st.session_state.espacio = st.query_params.get('espacio', almacen.ESPACIO_POR_DEFECTO)
+try:
+    almacen.activar_espacio(st.session_state.espacio, crear=False)
+except (ValueError, LookupError) as e:
+    st.warning(f"⚠️ {str(e)}: se usa el espacio principal")
+    cambiar_espacio(almacen.activar_espacio(almacen.ESPACIO_POR_DEFECTO))
+
+with st.sidebar:
+    st.markdown("### 🏢 Espacio de trabajo")
+    espacios = almacen.listar_espacios()
+    espacio_elegido = st.selectbox(
+        "Espacio:",
+        espacios,
+        index=espacios.index(st.session_state.espacio),
+        format_func=lambda e: e or "Principal"
+    )
+    if espacio_elegido != st.session_state.espacio:
+        cambiar_espacio(espacio_elegido)
+        st.rerun()
+
+    nuevo_espacio = st.text_input("Nuevo espacio:", placeholder="Ej: sevilla")
+    if st.button("➕ Crear espacio") and nuevo_espacio:
+        try:
+            cambiar_espacio(almacen.activar_espacio(nuevo_espacio))
+            st.rerun()
+        except ValueError as e:
+            st.error(f"❌ {str(e)}")
+
+    st.checkbox("📦 Mostrar tamaño de los gráficos", key='tamano_graficos')
+
 # Inicializar session_state
 if 'historial_documentos' not in st.session_state:
+    migrar_excel_base()
     st.session_state.historial_documentos = cargar_historial()
+elif almacen.firma_indice() != st.session_state.get('firma_indice'):
+    # Otra sesión o un worker de la API ha cambiado el historial: solo se cargan las diferencias
+    st.session_state.historial_documentos = almacen.sincronizar_historial(
+        st.session_state.historial_documentos, avisar=st.warning
+    )
+st.session_state.firma_indice = almacen.firma_indice()
 
 if 'registro_seleccionado' not in st.session_state:
     st.session_state.registro_seleccionado = None
@@ -257,187 +235,43 @@ if 'modo_vista' not in st.session_state:
     st.session_state.modo_vista = 'nuevo'
 if 'documentos_seleccionados' not in st.session_state:
     st.session_state.documentos_seleccionados = []
+# Avisos del vigilante de la bandeja de entrada (factubam_vigilante.py)
+INTERVALO_AVISOS_BANDEJA = 15  # segundos entre consultas
+if 'avisos_vistos' not in st.session_state:
+    # Solo se notifica lo que llegue a la bandeja a partir de ahora
+    st.session_state.avisos_vistos = datetime.now().timestamp()
+
+@st.fragment(run_every=INTERVALO_AVISOS_BANDEJA)
+def avisos_bandeja():
+    """Notifica lo que el vigilante ha hecho con la bandeja y ofrece cargar los registros nuevos"""
+    try:
+        # Al refrescarse solo el fragmento no pasa por la activación del principio
+        almacen.activar_espacio(st.session_state.espacio, crear=False)
+        avisos = core.cargar_avisos_bandeja(st.session_state.avisos_vistos)
+    except Exception as e:
+        st.caption(f"No se pudieron leer los avisos de la bandeja: {str(e)}")
+        return
+    for aviso in avisos:
+        st.toast(core.describir_aviso_bandeja(aviso))
+    if avisos:
+        st.session_state.avisos_vistos = avisos[-1]['instante']
+    if almacen.firma_indice() != st.session_state.firma_indice:
+        st.info("📥 Hay registros nuevos en el historial")
+        if st.button("🔄 Cargar registros nuevos", key="cargar_nuevos"):
+            st.rerun()
 
-# ======================================================
-# LÓGICA DE NEGOCIO (PDF, EXCEL Y CÁLCULOS)
-# ======================================================
-
-def extraer_datos_pdf(pdf_bytes):
-    datos = defaultdict(lambda: {"bn": 0, "color": 0})
-    sn_actual = None
-    with pdfplumber.open(pdf_bytes) as pdf:
-        for page in pdf.pages:
-            tables = page.extract_tables()
-            if not tables:
-                continue
-            for table in tables:
-                for fila in table:
-                    if not fila or len(fila) < 3:
-                        continue
-                    desc = str(fila[1]).upper()
-                    cantidad = fila[2]
-                    
-                    match_sn = re.search(r'([A-Z0-9]{8,})\s+N/S', desc)
-                    if match_sn:
-                        sn_actual = match_sn.group(1)
-                        continue
-                    
-                    if sn_actual is None:
-                        continue
-                        
-                    if "TOTAL MONOCROMO" in desc:
-                        try:
-                            val = float(str(cantidad).replace('.', '').replace(',', '.'))
-                            datos[sn_actual]["bn"] = int(val)
-                        except:
-                            datos[sn_actual]["bn"] = 0
-                            
-                    if "TOTAL COLOR" in desc:
-                        try:
-                            val = float(str(cantidad).replace('.', '').replace(',', '.'))
-                            datos[sn_actual]["color"] = int(val)
-                        except:
-                            datos[sn_actual]["color"] = 0
-    return datos
-
-def calcular_linea_redondeada(bn, color):
-    """Realiza los cálculos de una línea aplicando redondeo estricto"""
-    # 1. Coste unitario redondeado a 2 decimales
-    coste_bn_sin_iva = redondear_euro(bn * PRECIO_BN)
-    coste_color_sin_iva = redondear_euro(color * PRECIO_COLOR)
-    
-    # 2. Base imponible total de la línea (suma de redondeados)
-    coste_sin_iva = redondear_euro(coste_bn_sin_iva + coste_color_sin_iva)
-    
-    # 3. IVA calculado sobre la base redondeada
-    iva_total = redondear_euro(coste_sin_iva * IVA)
-    
-    # 4. Total factura (Base + IVA)
-    coste_con_iva = redondear_euro(coste_sin_iva + iva_total)
-    
-    # Desglose de IVA (informativo)
-    iva_bn = redondear_euro(coste_bn_sin_iva * IVA)
-    iva_color = redondear_euro(coste_color_sin_iva * IVA)
-    
-    # Totales desglosados
-    coste_bn_con_iva = redondear_euro(coste_bn_sin_iva + iva_bn)
-    coste_color_con_iva = redondear_euro(coste_color_sin_iva + iva_color)
-    
-    return {
-        "coste_bn_sin_iva": coste_bn_sin_iva,
-        "coste_color_sin_iva": coste_color_sin_iva,
-        "coste_sin_iva": coste_sin_iva,
-        "iva_bn": iva_bn,
-        "iva_color": iva_color,
-        "iva_total": iva_total,
-        "coste_bn_con_iva": coste_bn_con_iva,
-        "coste_color_con_iva": coste_color_con_iva,
-        "coste_con_iva": coste_con_iva
-    }
-
-def cruzar_excel(xlsx_file, datos_pdf):
-    wb = openpyxl.load_workbook(xlsx_file)
-    resultados = []
-    
-    # IMPORTANTE: Set para rastrear qué números de serie del PDF están en el Excel
-    sns_encontrados_en_excel = set()
-
-    for sheet_name in wb.sheetnames:
-        sheet = wb[sheet_name]
-        
-        if sheet.max_row < 2:
-            continue
-            
-        header = [c.value for c in sheet[1]]
-        if "S/N" not in header:
-            continue
-            
-        idx_sn = header.index("S/N") + 1
-        idx_org = header.index("Organismo") + 1
-        idx_ubi = header.index("Ubicación exacta") + 1
-        
-        for row in range(2, sheet.max_row + 1):
-            sn_val = sheet.cell(row, idx_sn).value
-            
-            if sn_val:
-                sn = str(sn_val).strip()
-            else:
-                continue
-
-            if sn in datos_pdf:
-                # Marcamos este SN como encontrado
-                sns_encontrados_en_excel.add(sn)
-
-                bn = datos_pdf[sn]["bn"]
-                color = datos_pdf[sn]["color"]
-                
-                # CÁLCULOS CON REDONDEO ESTRICTO
-                calculos = calcular_linea_redondeada(bn, color)
-                
-                registro = {
-                    "sn": sn,
-                    "organismo": sheet.cell(row, idx_org).value,
-                    "ubicacion": sheet.cell(row, idx_ubi).value,
-                    "bn": bn,
-                    "color": color,
-                    "estado": "Revisado"
-                }
-                registro.update(calculos)
-                resultados.append(registro)
-    
-    # === CORRECCIÓN DEL DESCUADRE (LOS 200€) ===
-    # Buscar qué S/N existen en el PDF pero NO se encontraron en el Excel
-    for sn_pdf, valores in datos_pdf.items():
-        if sn_pdf not in sns_encontrados_en_excel:
-            # Esta es una máquina que se ha facturado pero no está en el inventario Excel
-            bn = valores["bn"]
-            color = valores["color"]
-            
-            # Calculamos sus costes
-            calculos = calcular_linea_redondeada(bn, color)
-
-            # Añadir al resultado con aviso visible
-            registro = {
-                "sn": sn_pdf,
-                "organismo": "⚠️ NO EN EXCEL (Solo Factura)",
-                "ubicacion": "Desconocida",
-                "bn": bn,
-                "color": color,
-                "estado": "⚠️ Faltante en Excel"
-            }
-            registro.update(calculos)
-            resultados.append(registro)
-
-    return resultados
+with st.sidebar:
+    avisos_bandeja()
 
-def guardar_registro(nombre, pdf_file, excel_file, df):
-    """Guarda un registro completo con los datos procesados"""
-    pdf_bytes = pdf_file.read()
-    pdf_file.seek(0)
-    excel_bytes = excel_file.read()
-    excel_file.seek(0)
-    
-    nuevo_id = int(datetime.now().timestamp() * 1000)
-    
-    # Recalcular totales sumando las columnas redondeadas
-    total_sin_iva = redondear_euro(df['coste_sin_iva'].sum())
-    total_con_iva = redondear_euro(df['coste_con_iva'].sum())
-    
-    registro = {
-        'id': nuevo_id,
-        'nombre': nombre,
-        'fecha_hora': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'pdf_name': pdf_file.name,
-        'excel_name': excel_file.name,
-        'pdf_bytes': pdf_bytes,
-        'excel_bytes': excel_bytes,
-        'df': df.copy(),
-        'dispositivos': len(df),
-        'coste_total_sin_iva': total_sin_iva,
-        'coste_total_con_iva': total_con_iva
-    }
+def guardar_registro(registro):
+    """Añade un registro procesado al historial y lo guarda en disco"""
+    try:
+        core.anadir_registro(registro)
+    except Exception as e:
+        st.error(f"Error al guardar historial: {str(e)}")
+        return False
     st.session_state.historial_documentos.append(registro)
-    guardar_historial(st.session_state.historial_documentos)
+    return True
 
 def eliminar_registro(registro_id):
     """Elimina un registro del historial y del disco"""
@@ -445,15 +279,71 @@ def eliminar_registro(registro_id):
     st.session_state.historial_documentos = [
         r for r in st.session_state.historial_documentos if r['id'] != registro_id
     ]
-    guardar_historial(st.session_state.historial_documentos)
 
 def limpiar_historial():
     """Limpia todo el historial del disco y memoria"""
     limpiar_historial_disco()
     st.session_state.historial_documentos = []
 
+def validar_subida(pdf_file, excel_file, fecha_factura):
+    """Validación previa de los archivos subidos; se repite solo si cambian los archivos o la fecha"""
+    clave = (pdf_file.file_id if pdf_file else None, excel_file.file_id if excel_file else None, str(fecha_factura))
+    previa = st.session_state.get('validacion_previa')
+    if previa is None or previa['clave'] != clave:
+        try:
+            resultado = core.validacion_previa(
+                pdf_file.getvalue() if pdf_file else None,
+                excel_file.getvalue() if excel_file else None,
+                fecha_factura
+            )
+        except Exception as e:
+            resultado = {'errores': [], 'avisos': [f"No se pudo hacer la comprobación previa: {str(e)}"]}
+        previa = {'clave': clave, 'resultado': resultado}
+        st.session_state.validacion_previa = previa
+    return previa['resultado']
+
+def mostrar_validacion_previa(previa):
+    """Resumen de la comprobación previa: lo detectado, los errores y los avisos"""
+    with st.container(border=True):
+        st.markdown("##### 🔎 Comprobación previa")
+        col1, col2, col3 = st.columns(3)
+        muestra = previa.get('pdf')
+        if muestra:
+            col1.metric("📄 Páginas", muestra['paginas'])
+            estimados = previa.get('dispositivos_estimados')
+            col2.metric("🖥️ Dispositivos (estimado)", f"≈ {estimados}" if estimados else "—",
+                        help=f"Según las primeras {muestra['muestreadas']} página(s)")
+        if previa.get('coincidencias'):
+            coincidencias = previa['coincidencias']
+            col3.metric("✅ En el inventario vigente", f"{coincidencias['encontrados']} / {coincidencias['muestra']}")
+        if previa.get('inventario'):
+            st.dataframe(
+                pd.DataFrame([
+                    {'Hoja': hoja['hoja'], 'Filas': hoja['filas'], 'Columnas': ', '.join(hoja['columnas']),
+                     'Faltan': ', '.join(hoja['faltan']) or '—'}
+                    for hoja in previa['inventario']
+                ]),
+                use_container_width=True,
+                hide_index=True
+            )
+        for error in previa.get('errores', []):
+            st.error(f"❌ {error}")
+        for aviso in previa.get('avisos', []):
+            st.warning(f"⚠️ {aviso}")
+        if not previa.get('errores') and not previa.get('avisos'):
+            st.caption(f"Todo correcto ({previa.get('segundos', 0):.2f} s)")
+
 def obtener_dataframe_acumulado(ids_seleccionados=None):
     """Combina los dataframes de múltiples registros de forma segura"""
+    # Con pyarrow, las filas salen del almacén columnar mapeado (compartido entre sesiones)
+    # en lugar de copiarse de los registros que cada sesión tiene cargados
+    try:
+        df_columnar = derivados.dispositivos_columnar(ids_seleccionados)
+        if df_columnar is not None:
+            return df_columnar if not df_columnar.empty else None
+    except Exception as e:
+        st.warning(f"No se pudo leer el almacén columnar, se usan los registros cargados: {str(e)}")
+    
     if ids_seleccionados is None:
         registros = st.session_state.historial_documentos
     else:
@@ -468,9 +358,10 @@ def obtener_dataframe_acumulado(ids_seleccionados=None):
         if 'df' not in registro or registro['df'] is None or not isinstance(registro['df'], pd.DataFrame):
             continue
             
-        df_temp = registro['df'].copy()
+        df_temp = calculo.df_con_costes(registro['df'])
         df_temp['documento'] = registro['nombre']
         df_temp['fecha'] = registro['fecha_hora']
+        df_temp['fecha_factura'] = almacen.fecha_factura_registro(registro)
         dfs.append(df_temp)
     
     if not dfs:
@@ -479,10 +370,99 @@ def obtener_dataframe_acumulado(ids_seleccionados=None):
     df_acumulado = pd.concat(dfs, ignore_index=True)
     return df_acumulado
 
+# ======================================================
+# DATOS DE LOS GRÁFICOS (TAMAÑO DE LO QUE SE ENVÍA AL NAVEGADOR)
+# ======================================================
+# Cada rerun manda al navegador la figura entera. Con muchos organismos o un historial
+# largo se limitan las categorías a las mayores más "Otros", las series largas se
+# reducen aquí (conservando su forma) y las trazas con muchos puntos usan WebGL.
+MAX_CATEGORIAS_GRAFICO = 15
+MAX_BARRAS_DOCUMENTO = 60  # por encima, la evolución por documento se agrupa por mes
+MAX_PUNTOS_SERIE = 500
+UMBRAL_WEBGL = 250
+
+def top_n_con_otros(df, categoria, orden, columnas_suma, n=MAX_CATEGORIAS_GRAFICO):
+    """Las n-1 categorías mayores según `orden`, con el resto sumado en una fila 'Otros (k)'"""
+    if len(df) <= n:
+        return df
+    df = df.sort_values(orden, ascending=False)
+    cabeza, resto = df.iloc[:n - 1], df.iloc[n - 1:]
+    otros = resto[columnas_suma].sum().to_frame().T
+    otros[categoria] = f"Otros ({len(resto)})"
+    return pd.concat([cabeza, otros], ignore_index=True)
+
+def indices_lttb(valores, max_puntos=MAX_PUNTOS_SERIE):
+    """
+    Puntos a conservar de una serie larga (Largest-Triangle-Three-Buckets): en cada tramo
+    se queda el punto que forma el triángulo mayor con sus vecinos, así que los picos
+    se mantienen. Devuelve todos los índices si la serie ya es corta.
+    """
+    n = len(valores)
+    if n <= max_puntos or max_puntos < 3:
+        return np.arange(n)
+    y = np.asarray(valores, dtype=float)
+    x = np.arange(n, dtype=float)
+    cortes = np.linspace(1, n - 1, max_puntos - 1).astype(int)
+    indices = [0]
+    for i in range(max_puntos - 2):
+        inicio, fin = cortes[i], cortes[i + 1]
+        siguiente_fin = cortes[i + 2] if i + 2 < len(cortes) else n
+        media_x = x[fin:siguiente_fin].mean()
+        media_y = y[fin:siguiente_fin].mean()
+        a = indices[-1]
+        areas = np.abs((x[a] - media_x) * (y[inicio:fin] - y[a]) - (x[a] - x[inicio:fin]) * (media_y - y[a]))
+        indices.append(inicio + int(areas.argmax()))
+    indices.append(n - 1)
+    return np.array(indices)
+
+def traza_lineas(n_puntos):
+    """Scatter normal o WebGL según el número de puntos"""
+    return go.Scattergl if n_puntos > UMBRAL_WEBGL else go.Scatter
+
+def mostrar_grafico(fig, key):
+    """st.plotly_chart y, si se pide en la barra lateral, el tamaño de la figura enviada"""
+    st.plotly_chart(fig, use_container_width=True, key=key)
+    if st.session_state.get('tamano_graficos'):
+        st.caption(f"📦 {len(fig.to_json()) / 1024:,.1f} KB enviados al navegador ({key})")
+
 # ======================================================
 # FUNCIONES DE VISUALIZACIÓN (RESTAURADAS COMPLETAS)
 # ======================================================
 
+def mostrar_conciliacion(conciliacion):
+    """Cuadre de los costes calculados con los totales impresos en la factura"""
+    if conciliacion['estado'] == 'sin_totales':
+        st.info("ℹ️ No se encontraron totales en la factura para conciliar")
+        return
+
+    conceptos = {'base': 'Base imponible', 'iva': 'IVA', 'total': 'Total'}
+    if conciliacion['estado'] == 'cuadra':
+        st.success("✅ Los importes calculados cuadran con los totales de la factura")
+    else:
+        st.error(f"❌ Descuadre con la factura: {len(conciliacion['dispositivos'])} línea(s) de dispositivo no cuadran")
+
+    with st.expander("🧾 Conciliación con la factura", expanded=conciliacion['estado'] != 'cuadra'):
+        if conciliacion['comprobaciones']:
+            st.dataframe(
+                pd.DataFrame(conciliacion['comprobaciones']).assign(
+                    concepto=lambda d: d['concepto'].map(conceptos),
+                    cuadra=lambda d: d['cuadra'].map({True: '✅', False: '❌'})
+                ).rename(columns={
+                    'concepto': 'Concepto', 'factura': 'Factura (€)', 'calculado': 'Calculado (€)',
+                    'diferencia': 'Diferencia (€)', 'cuadra': 'Cuadra'
+                }),
+                use_container_width=True
+            )
+        if conciliacion['dispositivos']:
+            st.markdown("**Líneas de dispositivo que no cuadran (sin IVA)**")
+            st.dataframe(
+                pd.DataFrame(conciliacion['dispositivos']).rename(columns={
+                    'sn': 'S/N', 'tipo': 'Tipo', 'factura': 'Factura (€)',
+                    'calculado': 'Calculado (€)', 'diferencia': 'Diferencia (€)'
+                }),
+                use_container_width=True
+            )
+
 def mostrar_analisis(df, titulo="Análisis", mostrar_por_documento=False):
     """Muestra todas las gráficas y tablas del análisis"""
     
@@ -517,6 +497,11 @@ def mostrar_analisis(df, titulo="Análisis", mostrar_por_documento=False):
     col4.metric("🖨️ Total B/N", f"{df['bn'].sum():,}")
     col5.metric("🎨 Total Color", f"{df['color'].sum():,}")
     
+    if 'anomalia' in df.columns:
+        anomalas = int((df['anomalia'] != '').sum())
+        if anomalas:
+            st.warning(f"📈 {anomalas} lectura(s) de contador fuera de lo habitual para su equipo (ver 'Anomalía' en el detalle por equipo)")
+    
     # Totales con y sin IVA
     col_iva1, col_iva2, col_iva3 = st.columns(3)
     col_iva1.metric("💰 Total sin IVA", f"{df['coste_sin_iva'].sum():,.2f} €")
@@ -554,60 +539,73 @@ def mostrar_analisis_por_documento(df):
         'coste_con_iva': 'sum',
         'iva_total': 'sum',
         'sn': 'count',
-        'fecha': 'first'
+        'fecha': 'first',
+        **({'fecha_factura': 'first'} if 'fecha_factura' in df.columns else {})
     }).rename(columns={'sn': 'dispositivos'}).reset_index()
     
     df_docs['total_impresiones'] = df_docs['bn'] + df_docs['color']
-    df_docs = df_docs.sort_values('fecha')
+    # Orden y meses por la fecha de la factura: la de proceso solo dice cuándo se subió
+    if 'fecha_factura' not in df_docs.columns:
+        df_docs['fecha_factura'] = df_docs['fecha'].astype(str).str[:10]
+    df_docs = df_docs.sort_values(['fecha_factura', 'fecha'])
     
     st.markdown("### 📊 Resumen por Documento")
     
-    # Gráfico de evolución de costes
+    # Gráfico de evolución de costes (con muchos documentos, por mes)
+    if len(df_docs) > MAX_BARRAS_DOCUMENTO:
+        df_evol = df_docs.groupby(df_docs['fecha_factura'].astype(str).str[:7])[['coste_sin_iva', 'coste_con_iva']].sum()
+        eje_evol, etiqueta_eje = df_evol.index, 'Mes'
+    else:
+        df_evol = df_docs
+        eje_evol, etiqueta_eje = df_docs['documento'], 'Documento'
     fig_evol = go.Figure()
     fig_evol.add_trace(go.Bar(
         name='Sin IVA',
-        x=df_docs['documento'],
-        y=df_docs['coste_sin_iva'],
+        x=eje_evol,
+        y=df_evol['coste_sin_iva'].round(2),
         marker_color='lightblue'
     ))
     fig_evol.add_trace(go.Bar(
         name='Con IVA',
-        x=df_docs['documento'],
-        y=df_docs['coste_con_iva'],
+        x=eje_evol,
+        y=df_evol['coste_con_iva'].round(2),
         marker_color='darkblue'
     ))
     fig_evol.update_layout(
-        title='Evolución de Costes por Documento',
+        title=f'Evolución de Costes por {etiqueta_eje}',
         barmode='group',
-        xaxis_title='Documento',
+        xaxis_title=etiqueta_eje,
         yaxis_title='Coste (€)',
         height=500
     )
-    st.plotly_chart(fig_evol, use_container_width=True, key="evol_costes_doc")
+    mostrar_grafico(fig_evol, "evol_costes_doc")
     
-    # Gráfico de impresiones por documento
+    # Gráfico de impresiones por documento (series largas reducidas conservando los picos)
+    df_imp = df_docs.iloc[indices_lttb(df_docs['total_impresiones'].to_numpy())]
+    Traza = traza_lineas(len(df_imp))
     fig_imp = go.Figure()
-    fig_imp.add_trace(go.Scatter(
+    fig_imp.add_trace(Traza(
         name='B/N',
-        x=df_docs['documento'],
-        y=df_docs['bn'],
+        x=df_imp['documento'],
+        y=df_imp['bn'],
         mode='lines+markers',
         line=dict(color='gray', width=2)
     ))
-    fig_imp.add_trace(go.Scatter(
+    fig_imp.add_trace(Traza(
         name='Color',
-        x=df_docs['documento'],
-        y=df_docs['color'],
+        x=df_imp['documento'],
+        y=df_imp['color'],
         mode='lines+markers',
         line=dict(color='skyblue', width=2)
     ))
     fig_imp.update_layout(
-        title='Evolución de Impresiones por Documento',
+        title='Evolución de Impresiones por Documento' + (
+            f' ({len(df_imp)} de {len(df_docs)} puntos)' if len(df_imp) < len(df_docs) else ''),
         xaxis_title='Documento',
         yaxis_title='Número de Impresiones',
         height=400
     )
-    st.plotly_chart(fig_imp, use_container_width=True, key="evol_imp_doc")
+    mostrar_grafico(fig_imp, "evol_imp_doc")
     
     # Tabla resumen
     st.markdown("### 📋 Tabla Resumen por Documento")
@@ -620,10 +618,11 @@ def mostrar_analisis_por_documento(df):
     df_docs_display['total_impresiones'] = df_docs_display['total_impresiones'].apply(lambda x: f"{x:,}")
     
     st.dataframe(
-        df_docs_display[['documento', 'fecha', 'dispositivos', 'bn', 'color', 
+        df_docs_display[['documento', 'fecha_factura', 'fecha', 'dispositivos', 'bn', 'color', 
                          'total_impresiones', 'coste_sin_iva', 'iva_total', 'coste_con_iva']].rename(columns={
             'documento': 'Documento',
-            'fecha': 'Fecha',
+            'fecha_factura': 'Fecha factura',
+            'fecha': 'Procesado',
             'dispositivos': 'Dispositivos',
             'bn': 'B/N',
             'color': 'Color',
@@ -646,23 +645,35 @@ def mostrar_analisis_por_departamento(df):
     }).rename(columns={'sn': 'dispositivos'}).reset_index()
     
     df_dept['total_impresiones'] = df_dept['bn'] + df_dept['color']
+    df_dept['promedio_por_dispositivo'] = df_dept['total_impresiones'] / df_dept['dispositivos']
+    
+    # Los gráficos muestran los mayores organismos y "Otros"; la tabla de detalle, todos
+    columnas_suma = ['bn', 'color', 'coste_sin_iva', 'coste_con_iva', 'iva_total', 'dispositivos', 'total_impresiones']
+    def grafico_dept(orden):
+        df_graf = top_n_con_otros(df_dept, 'organismo', orden, columnas_suma)
+        df_graf['promedio_por_dispositivo'] = df_graf['total_impresiones'] / df_graf['dispositivos']
+        return df_graf.round({'coste_sin_iva': 2, 'coste_con_iva': 2, 'promedio_por_dispositivo': 1})
     
     st.markdown("### 📊 Análisis por Departamento")
+    if len(df_dept) > MAX_CATEGORIAS_GRAFICO:
+        st.caption(f"Los gráficos muestran los {MAX_CATEGORIAS_GRAFICO - 1} departamentos mayores de "
+                   f"{len(df_dept)}; el resto se agrupa en 'Otros' (detalle completo en la pestaña 📋)")
     
     tab1, tab2, tab3, tab4 = st.tabs(["💰 Coste", "🖨️ Impresiones", "🖥️ Dispositivos", "📋 Detalle"])
     
     with tab1:
+        df_coste = grafico_dept('coste_con_iva')
         fig_coste_comp = go.Figure()
         fig_coste_comp.add_trace(go.Bar(
             name='Sin IVA',
-            x=df_dept['organismo'],
-            y=df_dept['coste_sin_iva'],
+            x=df_coste['organismo'],
+            y=df_coste['coste_sin_iva'],
             marker_color='lightcoral'
         ))
         fig_coste_comp.add_trace(go.Bar(
             name='Con IVA',
-            x=df_dept['organismo'],
-            y=df_dept['coste_con_iva'],
+            x=df_coste['organismo'],
+            y=df_coste['coste_con_iva'],
             marker_color='darkred'
         ))
         fig_coste_comp.update_layout(
@@ -672,29 +683,30 @@ def mostrar_analisis_por_departamento(df):
             yaxis_title='Coste (€)',
             height=500
         )
-        st.plotly_chart(fig_coste_comp, use_container_width=True, key="dept_coste_comp")
+        mostrar_grafico(fig_coste_comp, "dept_coste_comp")
         
         fig_pie_coste = px.pie(
-            df_dept,
+            df_coste,
             values='coste_con_iva',
             names='organismo',
             title='Distribución de Costes por Departamento (con IVA)',
             hole=0.4
         )
-        st.plotly_chart(fig_pie_coste, use_container_width=True, key="dept_pie_coste")
+        mostrar_grafico(fig_pie_coste, "dept_pie_coste")
     
     with tab2:
+        df_imp = grafico_dept('total_impresiones')
         fig_impresiones = go.Figure()
         fig_impresiones.add_trace(go.Bar(
             name='B/N',
-            x=df_dept['organismo'],
-            y=df_dept['bn'],
+            x=df_imp['organismo'],
+            y=df_imp['bn'],
             marker_color='lightgray'
         ))
         fig_impresiones.add_trace(go.Bar(
             name='Color',
-            x=df_dept['organismo'],
-            y=df_dept['color'],
+            x=df_imp['organismo'],
+            y=df_imp['color'],
             marker_color='lightblue'
         ))
         fig_impresiones.update_layout(
@@ -704,10 +716,10 @@ def mostrar_analisis_por_departamento(df):
             yaxis_title='Número de Impresiones',
             height=500
         )
-        st.plotly_chart(fig_impresiones, use_container_width=True, key="dept_impresiones")
+        mostrar_grafico(fig_impresiones, "dept_impresiones")
         
         fig_total = px.bar(
-            df_dept.sort_values('total_impresiones', ascending=False),
+            df_imp,
             x='organismo',
             y='total_impresiones',
             title='Total de Impresiones por Departamento',
@@ -715,11 +727,11 @@ def mostrar_analisis_por_departamento(df):
             color='total_impresiones',
             color_continuous_scale='Blues'
         )
-        st.plotly_chart(fig_total, use_container_width=True, key="dept_total_imp")
+        mostrar_grafico(fig_total, "dept_total_imp")
     
     with tab3:
         fig_dispositivos = px.bar(
-            df_dept.sort_values('dispositivos', ascending=False),
+            grafico_dept('dispositivos'),
             x='organismo',
             y='dispositivos',
             title='Número de Dispositivos por Departamento',
@@ -727,11 +739,10 @@ def mostrar_analisis_por_departamento(df):
             color='dispositivos',
             color_continuous_scale='Greens'
         )
-        st.plotly_chart(fig_dispositivos, use_container_width=True, key="dept_dispositivos")
+        mostrar_grafico(fig_dispositivos, "dept_dispositivos")
         
-        df_dept['promedio_por_dispositivo'] = df_dept['total_impresiones'] / df_dept['dispositivos']
         fig_promedio = px.bar(
-            df_dept.sort_values('promedio_por_dispositivo', ascending=False),
+            grafico_dept('promedio_por_dispositivo').sort_values('promedio_por_dispositivo', ascending=False),
             x='organismo',
             y='promedio_por_dispositivo',
             title='Promedio de Impresiones por Dispositivo',
@@ -739,7 +750,7 @@ def mostrar_analisis_por_departamento(df):
             color='promedio_por_dispositivo',
             color_continuous_scale='Purples'
         )
-        st.plotly_chart(fig_promedio, use_container_width=True, key="dept_promedio")
+        mostrar_grafico(fig_promedio, "dept_promedio")
     
     with tab4:
         df_dept_display = df_dept.copy()
@@ -798,6 +809,8 @@ def mostrar_detalle_equipos(df):
     
     columnas_mostrar = ['sn', 'organismo', 'ubicacion', 'bn', 'color', 
                         'coste_sin_iva', 'coste_con_iva', 'estado']
+    if 'anomalia' in df_display.columns:
+        columnas_mostrar.append('anomalia')
     
     if 'documento' in df_display.columns:
         columnas_mostrar.insert(1, 'documento')
@@ -811,13 +824,16 @@ def mostrar_detalle_equipos(df):
         'color': 'Color',
         'coste_sin_iva': 'Coste sin IVA',
         'coste_con_iva': 'Coste con IVA',
-        'estado': 'Estado'
+        'estado': 'Estado',
+        'anomalia': 'Anomalía'
     }
     
     def highlight_missing(row):
         # Protección si falta la columna estado
         if 'Estado' in row and row['Estado'] == '⚠️ Faltante en Excel':
             return ['background-color: #ffcccc'] * len(row)
+        if row.get('Anomalía'):
+            return ['background-color: #fff3cd'] * len(row)
         return [''] * len(row)
 
     st.dataframe(
@@ -825,6 +841,37 @@ def mostrar_detalle_equipos(df):
         use_container_width=True
     )
 
+def mostrar_historial_equipo(sn):
+    """Lecturas, costes y cambios de ubicación de un equipo en todas las facturas"""
+    historial = derivados.historial_dispositivo(sn)
+    if historial.empty:
+        st.info("No hay lecturas de este equipo en el historial.")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("📄 Facturas", len(historial))
+    col2.metric("🖨️ Total B/N", f"{historial['bn'].sum():,}")
+    col3.metric("🎨 Total Color", f"{historial['color'].sum():,}")
+    col4.metric("💰 Coste con IVA", f"{historial['coste_con_iva'].sum():,.2f} €")
+
+    cambios = historial[historial['cambio'] != '']
+    for _, fila in cambios.iterrows():
+        st.caption(f"📍 {fila['fecha']} ({fila['documento']}): {fila['cambio']}")
+
+    if len(historial) > 1:
+        fig = px.line(historial, x='fecha', y=['bn', 'color'], markers=True,
+                      render_mode='webgl' if len(historial) > UMBRAL_WEBGL else 'svg',
+                      labels={'value': 'Impresiones', 'fecha': 'Fecha de factura', 'variable': 'Tipo'})
+        mostrar_grafico(fig, "historial_equipo")
+
+    st.dataframe(
+        historial.drop(columns=['registro_id', 'fila']).rename(columns={
+            'documento': 'Documento', 'fecha': 'Fecha', 'organismo': 'Organismo', 'ubicacion': 'Ubicación',
+            'estado': 'Estado', 'bn': 'B/N', 'color': 'Color', 'coste_con_iva': 'Coste con IVA', 'cambio': 'Cambio'
+        }),
+        use_container_width=True
+    )
+
 # ======================================================
 # INTERFAZ PRINCIPAL (UI)
 # ======================================================
@@ -836,6 +883,16 @@ if st.session_state.historial_documentos:
     st.success(f"✅ {len(st.session_state.historial_documentos)} registro(s) guardado(s) en disco local")
     st.info(f"📁 Ubicación: `{DATA_DIR.absolute()}`")
 
+    with st.expander("🔍 Historial de un equipo (por S/N)", expanded=False):
+        texto_sn = st.text_input("S/N (completo o parte):", key="busqueda_sn")
+        if texto_sn:
+            coincidencias = derivados.buscar_sn(texto_sn)
+            if not coincidencias:
+                st.info("No hay ningún equipo con ese S/N en el historial.")
+            else:
+                sn_elegido = coincidencias[0] if len(coincidencias) == 1 else st.selectbox("Equipo:", coincidencias)
+                mostrar_historial_equipo(sn_elegido)
+
 # Menú de navegación principal
 st.markdown("### 🎯 Modo de Visualización")
 col_menu1, col_menu2, col_menu3, col_menu4 = st.columns(4)
@@ -884,7 +941,7 @@ if st.session_state.historial_documentos and st.session_state.modo_vista != 'nue
                 )
                 if nuevo_nombre != registro['nombre']:
                     registro['nombre'] = nuevo_nombre
-                    guardar_historial(st.session_state.historial_documentos)
+                    actualizar_registros([registro], con_datos=False)
             
             with col2:
                 st.text(registro['fecha_hora'])
@@ -903,12 +960,69 @@ if st.session_state.historial_documentos and st.session_state.modo_vista != 'nue
                     st.rerun()
         
         st.markdown("---")
+        if st.button("🔁 Re-cruzar historial con el inventario vigente en cada fecha"):
+            for registro in st.session_state.historial_documentos:
+                if 'df' in registro and isinstance(registro['df'], pd.DataFrame):
+                    reevaluar_registro(registro)
+            actualizar_registros(st.session_state.historial_documentos)
+            st.rerun()
+        
+        col_arch1, col_arch2 = st.columns([1, 2])
+        with col_arch1:
+            dias_en_caliente = st.number_input("Días en caliente", min_value=30, value=core.DIAS_EN_CALIENTE, step=30)
+        with col_arch2:
+            st.caption("Los PDF e inventarios de facturas más antiguas se comprimen en un zip por año; "
+                       "sus datos siguen disponibles y los originales se pueden descargar igual.")
+            if st.button("🗄️ Archivar binarios antiguos"):
+                try:
+                    resultado = core.archivar_binarios(int(dias_en_caliente))
+                    st.success(f"✅ {resultado['registros']} registro(s) archivado(s): "
+                               f"{resultado['bytes_liberados'] / 1024:,.0f} KB liberados en documentos/, "
+                               f"{resultado['bytes_archivo'] / 1024:,.0f} KB añadidos al archivo")
+                except Exception as e:
+                    st.error(f"❌ Error al archivar: {e}")
+        
         if st.button("🗑️ Limpiar todo el historial"):
             limpiar_historial()
             st.session_state.registro_seleccionado = None
             st.session_state.modo_vista = 'nuevo'
             st.rerun()
 
+# Tarifas y re-precio del historial
+if st.session_state.historial_documentos and st.session_state.modo_vista != 'nuevo':
+    with st.expander("💶 Tarifas y re-precio del historial", expanded=False):
+        st.markdown("**Tabla de tarifas** (cada fila rige desde su fecha hasta la siguiente):")
+        df_tarifas = st.data_editor(
+            pd.DataFrame(cargar_tarifas()),
+            num_rows="dynamic",
+            use_container_width=True,
+            key="editor_tarifas",
+            column_config={
+                'desde': st.column_config.TextColumn("Desde (AAAA-MM-DD)"),
+                'precio_bn': st.column_config.NumberColumn("Precio B/N", format="%.4f"),
+                'precio_color': st.column_config.NumberColumn("Precio Color", format="%.4f"),
+                'iva': st.column_config.NumberColumn("IVA", format="%.2f")
+            }
+        )
+        tarifas_editadas = normalizar_tarifas(df_tarifas.dropna().to_dict('records'))
+        
+        col_tar1, col_tar2 = st.columns(2)
+        
+        with col_tar1:
+            if st.button("💾 Guardar tarifas y recalcular historial", disabled=not tarifas_editadas):
+                guardar_tarifas(tarifas_editadas)
+                costes = repreciar_historial(st.session_state.historial_documentos, tarifas_editadas)
+                aplicar_costes(st.session_state.historial_documentos, costes)
+                actualizar_registros(st.session_state.historial_documentos)
+                st.rerun()
+        
+        with col_tar2:
+            nombre_escenario = st.text_input("🧪 Nombre del escenario", placeholder="Ej: Tarifa 2026")
+            if st.button("Simular escenario", disabled=not (tarifas_editadas and nombre_escenario)):
+                costes = repreciar_historial(st.session_state.historial_documentos, tarifas_editadas)
+                guardar_escenario(nombre_escenario, tarifas_editadas, costes)
+                st.dataframe(resumen_escenario(st.session_state.historial_documentos, costes), use_container_width=True)
+
 st.markdown("---")
 
 # Renderizar según modo de vista
@@ -917,47 +1031,71 @@ if st.session_state.modo_vista == 'nuevo':
     
     pdf_file = st.file_uploader("Sube la factura PDF", type=["pdf"])
     
-    # --- MODIFICACIÓN EXCEL BASE ---
-    tiene_base = BASE_EXCEL_FILE.exists()
+    # --- INVENTARIO VERSIONADO ---
+    versiones = cargar_inventarios()
+    tiene_base = bool(versiones)
+    
+    fecha_factura = st.date_input("📅 Fecha de la factura", value=datetime.now().date(), format="DD/MM/YYYY")
     
     if tiene_base:
-        st.info("ℹ️ Ya hay un inventario Excel guardado como base. Sube uno nuevo solo si quieres actualizarlo.")
-        excel_file = st.file_uploader("Sube el inventario Excel (Opcional - Sustituirá al actual)", type=["xlsx"])
+        vigente = inventario_vigente(fecha_factura, versiones)
+        st.info(f"ℹ️ Inventario vigente en esa fecha: **{vigente['nombre']}** (desde {vigente['fecha_vigencia']}). "
+                "Sube uno nuevo solo si quieres registrar una nueva versión.")
+        excel_file = st.file_uploader("Sube el inventario Excel (Opcional - Nueva versión)", type=["xlsx"])
     else:
         excel_file = st.file_uploader("Sube el inventario Excel (Requerido)", type=["xlsx"])
+    
+    if excel_file:
+        fecha_vigencia = st.date_input("📅 Inventario vigente desde", value=fecha_factura, format="DD/MM/YYYY")
+    
+    if versiones:
+        with st.expander(f"🗂️ Versiones de inventario ({len(versiones)})", expanded=False):
+            st.dataframe(
+                pd.DataFrame(versiones)[['fecha_vigencia', 'nombre', 'dispositivos', 'fecha_alta']].rename(columns={
+                    'fecha_vigencia': 'Vigente desde',
+                    'nombre': 'Archivo',
+                    'dispositivos': 'Dispositivos',
+                    'fecha_alta': 'Registrado'
+                }),
+                use_container_width=True
+            )
+
+    # Comprobación rápida de lo subido antes de procesarlo entero
+    previa = validar_subida(pdf_file, excel_file, fecha_factura) if pdf_file or excel_file else None
+    if previa:
+        mostrar_validacion_previa(previa)
 
-    # Verificamos que tengamos PDF y (o bien Excel subido, o bien Excel base)
+    # Verificamos que tengamos PDF y (o bien Excel subido, o bien inventario registrado)
     if pdf_file and (excel_file or tiene_base):
         nombre_registro = st.text_input("📝 Nombre para este análisis:", placeholder="Ej: Factura Enero 2024")
         
-        if st.button("Procesar y Guardar", type="primary"):
+        if st.button("Procesar y Guardar", type="primary", disabled=bool(previa and previa['errores'])):
             if nombre_registro:
                 with st.spinner("Procesando documentos..."):
                     
-                    # --- GESTIÓN DEL ARCHIVO EXCEL A USAR ---
-                    if excel_file:
-                        # Si han subido uno nuevo, lo guardamos como el base
-                        with open(BASE_EXCEL_FILE, "wb") as f:
-                            f.write(excel_file.getvalue())
-                        excel_procesar = excel_file
-                    else:
-                        # Si no han subido uno nuevo, leemos el base guardado y lo metemos en un BytesIO 
-                        # para que se comporte exactamente como un archivo subido de Streamlit
-                        with open(BASE_EXCEL_FILE, "rb") as f:
-                            bytes_excel = f.read()
-                        excel_procesar = io.BytesIO(bytes_excel)
-                        excel_procesar.name = "base_inventario.xlsx"
-                        
-                    # --- RESTO DE LA LÓGICA INTACTA ---
-                    datos_pdf = extraer_datos_pdf(pdf_file)
-                    resultados = cruzar_excel(excel_procesar, datos_pdf)
-                    df = pd.DataFrame(resultados)
-                    
-                    guardar_registro(nombre_registro, pdf_file, excel_procesar, df)
+                    # Cruza contra el inventario vigente en la fecha de la factura (el nuevo, si lo hay, se registra al guardar)
+                    try:
+                        registro = procesar_factura(
+                            nombre_registro,
+                            pdf_file.getvalue(),
+                            pdf_file.name,
+                            fecha_factura,
+                            excel_bytes=excel_file.getvalue() if excel_file else None,
+                            excel_name=excel_file.name if excel_file else None,
+                            fecha_vigencia=fecha_vigencia if excel_file else None
+                        )
+                    except ValueError as e:
+                        st.error(f"❌ {str(e)}")
+                        st.stop()
+                    except Exception as e:
+                        st.error(f"❌ Error al procesar los documentos: {str(e)}")
+                        st.stop()
+                    if not guardar_registro(registro):
+                        st.stop()  # guardar_registro ya ha mostrado el error
                     
                     st.success(f"✅ Análisis '{nombre_registro}' guardado correctamente")
                     st.session_state.modo_vista = 'individual'
-                    st.session_state.registro_seleccionado = st.session_state.historial_documentos[-1]['id']
+                    st.session_state.registro_seleccionado = registro['id']
                     st.rerun()
             else:
                 st.warning("⚠️ Por favor, ingresa un nombre para el análisis")
@@ -980,7 +1118,66 @@ elif st.session_state.modo_vista == 'individual':
             registro = registros_validos[doc_seleccionado_idx]
             st.session_state.registro_seleccionado = registro['id']
             
-            mostrar_analisis(registro['df'], titulo=f"📊 Análisis: {registro['nombre']}")
+            pdf_original = core.obtener_binario(registro, 'pdf_bytes')
+            if pdf_original:
+                st.download_button(
+                    "📥 Descargar factura original",
+                    pdf_original,
+                    file_name=registro['pdf_name'] or f"{registro['nombre']}.pdf",
+                    mime="application/pdf",
+                    key=f"descarga_pdf_{registro['id']}"
+                )
+            
+            if registro.get('incidencias_lectura'):
+                with st.expander(f"⚠️ {len(registro['incidencias_lectura'])} cantidad(es) ilegible(s) en la factura (contadas como 0)", expanded=False):
+                    st.dataframe(pd.DataFrame(registro['incidencias_lectura']), use_container_width=True)
+            
+            if registro.get('conciliacion'):
+                mostrar_conciliacion(registro['conciliacion'])
+            
+            mostrar_analisis(marcar_anomalias(calculo.df_con_costes(registro['df'])), titulo=f"📊 Análisis: {registro['nombre']}")
+            
+            propuestas = proponer_candidatos(registro)
+            if not propuestas.empty:
+                with st.expander(f"🔎 Posibles coincidencias para {propuestas['sn'].nunique()} equipo(s) sin ubicar", expanded=False):
+                    st.dataframe(
+                        propuestas.rename(columns={
+                            'sn': 'S/N (Factura)',
+                            'candidato': 'S/N (Inventario)',
+                            'distancia': 'Diferencias',
+                            'organismo': 'Organismo',
+                            'ubicacion': 'Ubicación'
+                        }),
+                        use_container_width=True
+                    )
+                    if st.button("✅ Asignar los candidatos sin empate", key=f"asignar_{registro['id']}"):
+                        asignados = asignar_candidatos_unicos(registro, propuestas)
+                        actualizar_registros([registro])
+                        st.success(f"✅ {asignados} equipo(s) asignado(s)")
+                        st.rerun()
+
+            with st.expander("🏢 Repercusión por organismo", expanded=False):
+                st.caption("Un documento por organismo con sus equipos, ubicaciones, contadores y costes, empaquetados en un zip.")
+                formato_rep = st.radio("Formato", factubam_export.FORMATOS_REPERCUSION, horizontal=True, key=f"formato_rep_{registro['id']}")
+                if st.button("📑 Generar documentos", key=f"btn_rep_{registro['id']}"):
+                    try:
+                        with st.spinner("Generando documentos por organismo..."):
+                            st.session_state.repercusion = (
+                                registro['id'], formato_rep,
+                                factubam_export.generar_repercusiones(registro, formato_rep)
+                            )
+                    except Exception as e:
+                        st.error(f"❌ Error al generar los documentos: {e}")
+
+                repercusion = st.session_state.get('repercusion')
+                if repercusion and repercusion[:2] == (registro['id'], formato_rep):
+                    st.download_button(
+                        f"💾 Descargar documentos ({formato_rep.upper()})",
+                        repercusion[2],
+                        file_name=f"repercusion_{registro['nombre']}.zip",
+                        mime="application/zip",
+                        key=f"btn_descarga_rep_{registro['id']}"
+                    )
         else:
              st.info("No hay documentos válidos guardados. Carga uno nuevo.")
     else:
@@ -1012,9 +1209,36 @@ elif st.session_state.modo_vista == 'acumulado':
         df_acumulado = obtener_dataframe_acumulado(ids_seleccionados)
         
         if df_acumulado is not None:
-            mostrar_analisis(df_acumulado, 
+            mostrar_analisis(marcar_anomalias(df_acumulado), 
                            titulo=f"📊 Análisis Acumulado ({len(ids_seleccionados)} documento(s))",
                            mostrar_por_documento=True)
+
+        with st.expander("⬇️ Exportar datos acumulados", expanded=False):
+            st.caption("Los registros se escriben de uno en uno desde disco, sin cargar todo el historial en memoria.")
+            formato = st.radio("Formato", factubam_export.FORMATOS, horizontal=True, key="formato_export")
+            if st.button("📦 Generar exportación", key="btn_export"):
+                ruta = None
+                try:
+                    with tempfile.NamedTemporaryFile(suffix=f".{formato}", delete=False) as tmp:
+                        ruta = tmp.name
+                    with st.spinner("Exportando..."):
+                        filas = factubam_export.exportar(formato, ruta, set(ids_seleccionados))
+                    with open(ruta, 'rb') as f:
+                        st.session_state.exportacion = (formato, f.read(), filas)
+                except Exception as e:
+                    st.error(f"❌ Error al exportar: {e}")
+                finally:
+                    if ruta and os.path.exists(ruta):
+                        os.remove(ruta)
+
+            if st.session_state.get('exportacion') and st.session_state.exportacion[0] == formato:
+                _, contenido, filas = st.session_state.exportacion
+                st.download_button(
+                    f"💾 Descargar {formato.upper()} ({filas} filas)",
+                    contenido,
+                    file_name=f"factubam_acumulado_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}",
+                    key="btn_descarga_export"
+                )
     else:
         st.warning("⚠️ Selecciona al menos un documento para ver el análisis acumulado")
 
@@ -1119,7 +1343,7 @@ elif st.session_state.modo_vista == 'comparativa':
                 barmode='group',
                 height=400
             )
-            st.plotly_chart(fig_comp_costes, use_container_width=True, key="comp_costes_docs")
+            mostrar_grafico(fig_comp_costes, "comp_costes_docs")
             
             # Comparación de impresiones
             col_imp1, col_imp2 = st.columns(2)
@@ -1132,7 +1356,7 @@ elif st.session_state.modo_vista == 'comparativa':
                     title='Distribución de Impresiones',
                     hole=0.4
                 )
-                st.plotly_chart(fig1, use_container_width=True, key="comp_pie1")
+                mostrar_grafico(fig1, "comp_pie1")
             
             with col_imp2:
                 st.markdown(f"#### {reg2['nombre']}")
@@ -1142,23 +1366,31 @@ elif st.session_state.modo_vista == 'comparativa':
                     title='Distribución de Impresiones',
                     hole=0.4
                 )
-                st.plotly_chart(fig2, use_container_width=True, key="comp_pie2")
+                mostrar_grafico(fig2, "comp_pie2")
             
             # Análisis por departamento comparativo
             st.markdown("---")
             st.markdown("### 🏢 Comparación por Departamentos")
             
-            df1_dept = reg1['df'].groupby('organismo').agg({
+            df1_dept = calculo.df_con_costes(reg1['df']).groupby('organismo').agg({
                 'coste_con_iva': 'sum'
             }).reset_index()
             df1_dept['documento'] = reg1['nombre']
             
-            df2_dept = reg2['df'].groupby('organismo').agg({
+            df2_dept = calculo.df_con_costes(reg2['df']).groupby('organismo').agg({
                 'coste_con_iva': 'sum'
             }).reset_index()
             df2_dept['documento'] = reg2['nombre']
             
+            # Los mayores organismos entre los dos documentos; el resto, en "Otros" por documento
             df_dept_comp = pd.concat([df1_dept, df2_dept])
+            totales_dept = df_dept_comp.groupby('organismo')['coste_con_iva'].sum()
+            if len(totales_dept) > MAX_CATEGORIAS_GRAFICO:
+                mayores = totales_dept.nlargest(MAX_CATEGORIAS_GRAFICO - 1).index
+                otros = f"Otros ({len(totales_dept) - len(mayores)})"
+                df_dept_comp['organismo'] = df_dept_comp['organismo'].where(df_dept_comp['organismo'].isin(mayores), otros)
+                df_dept_comp = df_dept_comp.groupby(['documento', 'organismo'], as_index=False, sort=False)['coste_con_iva'].sum()
+            df_dept_comp['coste_con_iva'] = df_dept_comp['coste_con_iva'].round(2)
             
             fig_dept = px.bar(
                 df_dept_comp,
@@ -1169,35 +1401,7 @@ elif st.session_state.modo_vista == 'comparativa':
                 title='Coste por Departamento (con IVA)',
                 labels={'coste_con_iva': 'Coste (€)', 'organismo': 'Departamento'}
             )
-            st.plotly_chart(fig_dept, use_container_width=True, key="comp_dept_costes")
+            mostrar_grafico(fig_dept, "comp_dept_costes")
             
         else:
             st.warning("⚠️ Por favor, selecciona dos documentos diferentes para comparar")
-
-# ======================================================
-# UTILIDADES MD5 – DETECCIÓN DE ARCHIVOS DUPLICADOS
-# ======================================================
-from collections import defaultdict
-
-def calcular_md5_archivo(ruta_archivo, bloque_size=8192):
-    """Calcula el MD5 de un archivo leyendo por bloques"""
-    md5 = hashlib.md5()
-    with open(ruta_archivo, "rb") as f:
-        for bloque in iter(lambda: f.read(bloque_size), b""):
-            md5.update(bloque)
-    return md5.hexdigest()
-
-def detectar_duplicados_md5():
-    """Detecta archivos duplicados por MD5 en factubam_data/documentos"""
-    hashes = defaultdict(list)
-
-    for archivo in DOCUMENTOS_DIR.iterdir():
-        if archivo.is_file():
-            try:
-                md5 = calcular_md5_archivo(archivo)
-                hashes[md5].append(archivo.name)
-            except Exception as e:
-                print(f"Error leyendo {archivo.name}: {e}")
-
-    duplicados = {md5: files for md5, files in hashes.items() if len(files) > 1}
-    return duplicados
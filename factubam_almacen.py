@@ -0,0 +1,370 @@
+"""
+Almacenamiento de FactuBAM: espacios de trabajo, escrituras atómicas, journal de
+transacciones, bloqueo entre procesos e índice del historial.
+"""
+import re
+import pandas as pd
+import contextvars
+import json
+import logging
+import os
+import uuid
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+
+from factubam_calculo import compactar_df, total_euros
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger("factubam")
+
+# --- ESPACIOS DE TRABAJO ---
+# Cada espacio (una oficina) tiene su propia raíz de datos en factubam_data/espacios/<nombre>;
+# el activo va por contexto (la sesión de Streamlit o la petición de la API)
+RAIZ_DATOS = Path("factubam_data")
+ESPACIOS_DIR = RAIZ_DATOS / "espacios"
+ESPACIO_POR_DEFECTO = ""
+_ESPACIO_ACTIVO = contextvars.ContextVar("factubam_espacio", default=ESPACIO_POR_DEFECTO)
+_PATRON_ESPACIO = re.compile(r'^[a-z0-9][a-z0-9_-]{0,63}$')
+_SUBDIRECTORIOS_ESPACIO = ("documentos", "inventarios", "escenarios", "archivo", "ocr", "bandeja")
+_ESPACIOS_PREPARADOS = set()
+
+def normalizar_espacio(nombre):
+    """Nombre de espacio válido para usarlo como directorio ('' es el espacio por defecto)"""
+    nombre = (nombre or ESPACIO_POR_DEFECTO).strip().lower()
+    if nombre != ESPACIO_POR_DEFECTO and not _PATRON_ESPACIO.match(nombre):
+        raise ValueError(f"Nombre de espacio no válido: '{nombre}' (minúsculas, números, '-' y '_')")
+    return nombre
+
+def raiz_espacio(nombre=None):
+    """Directorio de datos de un espacio (por defecto, el activo); lo crea la primera vez"""
+    nombre = _ESPACIO_ACTIVO.get() if nombre is None else normalizar_espacio(nombre)
+    raiz = ESPACIOS_DIR / nombre if nombre else RAIZ_DATOS
+    if nombre not in _ESPACIOS_PREPARADOS:
+        for subdirectorio in _SUBDIRECTORIOS_ESPACIO:
+            (raiz / subdirectorio).mkdir(parents=True, exist_ok=True)
+        _ESPACIOS_PREPARADOS.add(nombre)
+    return raiz
+
+def espacio_activo():
+    return _ESPACIO_ACTIVO.get()
+
+def existe_espacio(nombre):
+    nombre = normalizar_espacio(nombre)
+    return nombre == ESPACIO_POR_DEFECTO or (ESPACIOS_DIR / nombre).is_dir()
+
+def activar_espacio(nombre, crear=True):
+    """
+    Fija el espacio de trabajo del contexto actual (p. ej. al empezar cada ejecución de la sesión).
+    Con crear=False, un espacio que no existe es un LookupError.
+    """
+    nombre = normalizar_espacio(nombre)
+    if not crear and not existe_espacio(nombre):
+        raise LookupError(f"No existe el espacio de trabajo '{nombre}'")
+    raiz_espacio(nombre)
+    _ESPACIO_ACTIVO.set(nombre)
+    return nombre
+
+@contextmanager
+def espacio_de_trabajo(nombre):
+    """Ejecuta un bloque con otro espacio activo y restaura el anterior al salir"""
+    token = _ESPACIO_ACTIVO.set(normalizar_espacio(nombre))
+    try:
+        raiz_espacio()
+        yield
+    finally:
+        _ESPACIO_ACTIVO.reset(token)
+
+def listar_espacios():
+    """Espacios existentes: el de por defecto y los de factubam_data/espacios"""
+    otros = sorted(d.name for d in ESPACIOS_DIR.iterdir() if d.is_dir()) if ESPACIOS_DIR.exists() else []
+    return [ESPACIO_POR_DEFECTO] + [nombre for nombre in otros if _PATRON_ESPACIO.match(nombre)]
+
+class RutaEspacio(os.PathLike):
+    """Ruta dentro del espacio activo, resuelta en cada uso; se comporta como el Path resultante"""
+    def __init__(self, relativa=""):
+        self._relativa = relativa
+
+    def resolver(self):
+        return raiz_espacio() / self._relativa if self._relativa else raiz_espacio()
+
+    def __fspath__(self):
+        return os.fspath(self.resolver())
+
+    def __truediv__(self, otra):
+        return self.resolver() / otra
+
+    def __getattr__(self, nombre):
+        return getattr(self.resolver(), nombre)
+
+    def __eq__(self, otra):
+        if isinstance(otra, RutaEspacio):
+            otra = otra.resolver()
+        return self.resolver() == otra
+
+    # El hash cambiaría al cambiar de espacio: como clave de un dict o un set se usa resolver()
+    __hash__ = None
+
+    def __str__(self):
+        return str(self.resolver())
+
+    def __repr__(self):
+        return f"RutaEspacio({self._relativa!r} -> {self.resolver()})"
+
+# --- DIRECTORIOS (del espacio activo) ---
+DATA_DIR = RutaEspacio()
+HISTORIAL_FILE = RutaEspacio("historial.json")
+DOCUMENTOS_DIR = RutaEspacio("documentos")
+BASE_EXCEL_FILE = RutaEspacio("base_inventario.xlsx")  # Excel base heredado (se migra a inventarios versionados)
+LOCK_FILE = RutaEspacio(".historial.lock")
+JOURNAL_FILE = RutaEspacio("historial.journal")
+INVENTARIOS_DIR = RutaEspacio("inventarios")
+INVENTARIOS_FILE = RutaEspacio("inventarios/inventarios.json")
+TARIFAS_FILE = RutaEspacio("tarifas.json")
+ESCENARIOS_DIR = RutaEspacio("escenarios")
+SERIES_FILE = RutaEspacio("series_contadores.jsonl")  # Contadores por S/N y registro (derivado, se reconstruye si falta)
+ARCHIVO_DIR = RutaEspacio("archivo")  # Binarios de facturas antiguas comprimidos por año
+
+# ======================================================
+# FUNCIONES DE ALMACENAMIENTO Y GESTIÓN
+# ======================================================
+# Cada modificación se anota en el journal antes de aplicarse; si un proceso muere a
+# medias, el siguiente que toma el bloqueo la rehace
+
+def _relativa(ruta):
+    return str(Path(ruta).relative_to(DATA_DIR))
+
+def _escribir_temporal(ruta, contenido):
+    """Escribe el contenido junto a su destino con un nombre temporal único; devuelve la ruta temporal"""
+    ruta = Path(ruta)
+    tmp = ruta.with_name(f"{ruta.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    if isinstance(contenido, bytes):
+        with open(tmp, 'wb') as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp
+
+def escribir_atomico(ruta, contenido):
+    """Sustituye un archivo de golpe: los lectores ven la versión anterior o la nueva, nunca una a medias"""
+    os.replace(_escribir_temporal(ruta, contenido), ruta)
+
+def _json_texto(datos, indent=2):
+    return json.dumps(datos, ensure_ascii=False, indent=indent, default=str)
+
+def _recuperar_journal():
+    """Rehace las transacciones anotadas que no llegaron a cerrarse (con el bloqueo tomado)"""
+    if not JOURNAL_FILE.exists():
+        return
+    with open(JOURNAL_FILE, 'r', encoding='utf-8') as f:
+        lineas = f.read().splitlines()
+    for linea in lineas:
+        try:
+            transaccion = json.loads(linea)
+        except json.JSONDecodeError:
+            # Línea cortada: la transacción no llegó a anotarse, así que nunca se aplicó
+            logger.warning("Descartada una entrada incompleta del journal")
+            continue
+        logger.warning(f"Rehaciendo transacción pendiente {transaccion.get('tx')}")
+        _aplicar_transaccion(transaccion)
+    JOURNAL_FILE.unlink()
+
+@contextmanager
+def bloqueo_historial():
+    """
+    Bloqueo exclusivo entre procesos para modificar el historial y los inventarios.
+    Al tomarlo se recuperan las transacciones pendientes del journal.
+    """
+    with open(LOCK_FILE, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            _recuperar_journal()
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _aplicar_transaccion(transaccion):
+    """Aplica una transacción; es idempotente para poder rehacerla tras un fallo"""
+    for origen, destino in transaccion.get('mover', []):
+        if (DATA_DIR / origen).exists():
+            os.replace(DATA_DIR / origen, DATA_DIR / destino)
+
+    for ruta in transaccion.get('borrar', []):
+        (DATA_DIR / ruta).unlink(missing_ok=True)
+
+    if transaccion.get('vaciar') or 'poner' in transaccion or 'quitar' in transaccion:
+        indice = [] if transaccion.get('vaciar') else cargar_indice()
+        quitar = set(transaccion.get('quitar', []))
+        poner = {r['id']: r for r in transaccion.get('poner', [])}
+
+        nuevo_indice = []
+        for entrada in indice:
+            if entrada['id'] in quitar:
+                continue
+            nuevo_indice.append(poner.pop(entrada['id'], entrada))
+        nuevo_indice.extend(poner.values())
+        escribir_atomico(HISTORIAL_FILE, _json_texto(nuevo_indice))
+
+    if 'inventario' in transaccion:
+        versiones = cargar_inventarios()
+        if all(v['id'] != transaccion['inventario']['id'] for v in versiones):
+            versiones.append(transaccion['inventario'])
+            escribir_atomico(INVENTARIOS_FILE, _json_texto(versiones))
+
+def _ejecutar_transaccion(transaccion):
+    """Anota la transacción en el journal, la aplica y la cierra (requiere el bloqueo)"""
+    transaccion['tx'] = uuid.uuid4().hex
+    with open(JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(transaccion, ensure_ascii=False, default=str) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    _aplicar_transaccion(transaccion)
+    JOURNAL_FILE.unlink()
+
+def cargar_indice():
+    """Carga solo el índice del historial (sin DataFrames ni binarios)"""
+    if not HISTORIAL_FILE.exists():
+        return []
+    with open(HISTORIAL_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def firma_indice():
+    """Cambia cada vez que alguien modifica el índice del historial"""
+    return HISTORIAL_FILE.stat().st_mtime_ns if HISTORIAL_FILE.exists() else None
+
+def cargar_registro(reg_data, incluir_binarios=True):
+    """Completa una entrada del índice con su DataFrame (y sus archivos); None si no hay datos"""
+    # Cargar DataFrame
+    df_file = DOCUMENTOS_DIR / f"{reg_data['id']}_data.json"
+    
+    # CORRECCIÓN: Verificar que el archivo existe antes de leer
+    if not df_file.exists():
+        return None
+
+    with open(df_file, 'r', encoding='utf-8') as f:
+        reg_data['df'] = compactar_df(pd.DataFrame(json.load(f)))
+    
+    if incluir_binarios:
+        # Cargar archivos PDF y Excel
+        pdf_file = DOCUMENTOS_DIR / f"{reg_data['id']}_factura.pdf"
+        excel_file = DOCUMENTOS_DIR / f"{reg_data['id']}_inventario.xlsx"
+        
+        if pdf_file.exists():
+            with open(pdf_file, 'rb') as f:
+                reg_data['pdf_bytes'] = f.read()
+        
+        if excel_file.exists():
+            with open(excel_file, 'rb') as f:
+                reg_data['excel_bytes'] = f.read()
+
+    return reg_data
+
+def cargar_historial(avisar=None):
+    """
+    Carga el historial desde archivo JSON local.
+    Los registros que no se pueden leer se omiten y se notifican con `avisar` (por defecto, al log).
+    """
+    avisar = avisar or logger.warning
+    historial = []
+    for reg_data in cargar_indice():
+        try:
+            registro = cargar_registro(reg_data)
+            if registro is None:
+                avisar(f"Registro {reg_data['id']} sin datos en disco")
+            elif isinstance(registro['df'], pd.DataFrame):
+                historial.append(registro)
+        except Exception as e:
+            avisar(f"Error al cargar registro {reg_data.get('id', 'desconocido')}: {str(e)}")
+    
+    return historial
+
+def sincronizar_historial(historial, avisar=None):
+    """
+    Pone al día un historial ya cargado con los cambios de otros procesos leyendo solo
+    el índice: añade los registros nuevos, quita los borrados y recarga los modificados.
+    """
+    avisar = avisar or logger.warning
+    en_memoria = {r['id']: r for r in historial}
+    resultado = []
+    for entrada in cargar_indice():
+        actual = en_memoria.get(entrada['id'])
+        if actual is not None and actual.get('revision', 0) == entrada.get('revision', 0):
+            actual.update({k: v for k, v in entrada.items() if k != 'revision'})
+            resultado.append(actual)
+            continue
+        try:
+            registro = cargar_registro(entrada)
+            if registro is not None:
+                resultado.append(registro)
+        except Exception as e:
+            avisar(f"Error al cargar registro {entrada.get('id', 'desconocido')}: {str(e)}")
+    return resultado
+
+def resumen_registro(registro):
+    """Entrada del índice para un registro"""
+    return {
+        'id': registro['id'],
+        'nombre': registro['nombre'],
+        'fecha_hora': registro['fecha_hora'],
+        'pdf_name': registro['pdf_name'],
+        'excel_name': registro['excel_name'],
+        'dispositivos': registro['dispositivos'],
+        'fecha_factura': registro.get('fecha_factura', registro['fecha_hora'][:10]),
+        'inventario_id': registro.get('inventario_id'),
+        'revision': registro.get('revision', 0),
+        'incidencias_lectura': registro.get('incidencias_lectura', []),
+        'archivado': registro.get('archivado'),
+        'conciliacion': registro.get('conciliacion'),
+        # Guardamos los totales recalculados desde el DF para asegurar consistencia
+        'coste_total_sin_iva': total_euros(registro['df'], 'coste_sin_iva'),
+        'coste_total_con_iva': total_euros(registro['df'], 'coste_con_iva')
+    }
+
+def _archivos_registro(registro_id):
+    return {
+        'df': DOCUMENTOS_DIR / f"{registro_id}_data.json",
+        'pdf_bytes': DOCUMENTOS_DIR / f"{registro_id}_factura.pdf",
+        'excel_bytes': DOCUMENTOS_DIR / f"{registro_id}_inventario.xlsx"
+    }
+
+def cargar_inventarios():
+    """Carga el índice de versiones de inventario ordenado por fecha de vigencia"""
+    if not INVENTARIOS_FILE.exists():
+        return []
+    with open(INVENTARIOS_FILE, 'r', encoding='utf-8') as f:
+        versiones = json.load(f)
+    return sorted(versiones, key=lambda v: (v['fecha_vigencia'], v['id']))
+
+def fecha_factura_registro(registro):
+    """Fecha de la factura de un registro (los antiguos solo tienen la fecha de proceso)"""
+    return registro.get('fecha_factura') or registro['fecha_hora'][:10]
+
+# ======================================================
+# UTILIDADES MD5
+# ======================================================
+
+def calcular_md5_archivo(ruta_archivo, bloque_size=8192):
+    """Calcula el MD5 de un archivo leyendo por bloques"""
+    md5 = hashlib.md5()
+    with open(ruta_archivo, "rb") as f:
+        for bloque in iter(lambda: f.read(bloque_size), b""):
+            md5.update(bloque)
+    return md5.hexdigest()
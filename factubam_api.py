@@ -0,0 +1,255 @@
+"""
+Servidor API de FactuBAM (ASGI), independiente de Streamlit.
+
+Expone la carga y el procesado de facturas, el listado de registros y las
+consultas agregadas sobre el mismo almacenamiento de `factubam_data/`.
+Las escrituras pasan por el bloqueo entre procesos del núcleo, de modo que
+puede ejecutarse con varios workers:
+
+    python factubam_api.py                      # FACTUBAM_WORKERS=4 por defecto
+    uvicorn factubam_api:app --workers 4 --port 8503
+
+Cada petición trabaja sobre un espacio de trabajo: el de `?espacio=nombre` o la
+cabecera `X-Factubam-Espacio` (por defecto, el principal).
+"""
+import json
+import os
+import tempfile
+from datetime import date
+from typing import List, Optional
+
+import pandas as pd
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Query, UploadFile
+from fastapi.responses import FileResponse, Response
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+
+import factubam_almacen as almacen
+import factubam_calculo as calculo
+import factubam_core as core
+import factubam_derivados as derivados
+import factubam_export
+import factubam_verificar
+
+
+async def _espacio_de_la_peticion(
+    espacio: Optional[str] = Query(None, description="Espacio de trabajo"),
+    x_factubam_espacio: Optional[str] = Header(None),
+):
+    """
+    Activa el espacio de trabajo de la petición. Es asíncrona a propósito: se ejecuta
+    en el contexto de la petición y los endpoints síncronos heredan ese contexto.
+    """
+    try:
+        almacen.activar_espacio(espacio if espacio is not None else x_factubam_espacio, crear=False)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+app = FastAPI(title="FactuBAM API", dependencies=[Depends(_espacio_de_la_peticion)])
+
+
+def _df_a_json(df):
+    """Convierte un DataFrame a lista de dicts serializable (NaN -> null)"""
+    return json.loads(df.to_json(orient='records', force_ascii=False))
+
+
+def _buscar_en_indice(registro_id):
+    for entrada in almacen.cargar_indice():
+        if entrada['id'] == registro_id:
+            return entrada
+    raise HTTPException(status_code=404, detail=f"Registro {registro_id} no encontrado")
+
+
+@app.get("/registros")
+def listar_registros():
+    """Índice del historial (sin datos por dispositivo)"""
+    return almacen.cargar_indice()
+
+
+@app.get("/registros/{registro_id}")
+def ver_registro(registro_id: int):
+    """Resumen de un registro con el detalle de sus dispositivos"""
+    registro = almacen.cargar_registro(_buscar_en_indice(registro_id), incluir_binarios=False)
+    if registro is None:
+        raise HTTPException(status_code=404, detail=f"Registro {registro_id} sin datos")
+    df = calculo.df_con_costes(registro.pop('df'))
+    return {**registro, 'dispositivos_detalle': _df_a_json(df)}
+
+
+@app.get("/registros/{registro_id}/factura")
+def descargar_factura(registro_id: int):
+    """PDF original de la factura (también si ya está archivado)"""
+    entrada = _buscar_en_indice(registro_id)
+    contenido = core.obtener_binario(entrada, 'pdf_bytes')
+    if contenido is None:
+        raise HTTPException(status_code=404, detail=f"Registro {registro_id} sin PDF guardado")
+    return Response(
+        contenido,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{entrada["pdf_name"] or registro_id}"'}
+    )
+
+
+@app.post("/registros", status_code=201)
+def procesar_y_guardar(
+    nombre: str = Form(...),
+    fecha_factura: date = Form(...),
+    pdf: UploadFile = File(...),
+    excel: Optional[UploadFile] = File(None),
+    fecha_vigencia: Optional[date] = Form(None),
+):
+    """Procesa una factura (y opcionalmente una nueva versión del inventario) y la guarda"""
+    excel_bytes = excel.file.read() if excel is not None else None
+    try:
+        registro = core.procesar_factura(
+            nombre,
+            pdf.file.read(),
+            pdf.filename,
+            fecha_factura,
+            excel_bytes=excel_bytes,
+            excel_name=excel.filename if excel is not None else None,
+            fecha_vigencia=fecha_vigencia
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    core.anadir_registro(registro)
+    return almacen.resumen_registro(registro)
+
+
+@app.post("/validacion")
+async def validar_subida(
+    pdf: Optional[UploadFile] = File(None),
+    excel: Optional[UploadFile] = File(None),
+    fecha_factura: Optional[date] = Form(None),
+):
+    """Comprobación rápida (≈1 s) de una factura y/o un inventario antes de enviarlos a POST /registros"""
+    if pdf is None and excel is None:
+        raise HTTPException(status_code=422, detail="Hay que enviar la factura, el inventario o los dos")
+    return await run_in_threadpool(
+        core.validacion_previa,
+        await pdf.read() if pdf is not None else None,
+        await excel.read() if excel is not None else None,
+        fecha_factura
+    )
+
+
+@app.delete("/registros/{registro_id}", status_code=204)
+def eliminar_registro(registro_id: int):
+    """Quita un registro del historial y borra sus archivos"""
+    if not core.quitar_registro(registro_id):
+        raise HTTPException(status_code=404, detail=f"Registro {registro_id} no encontrado")
+
+
+@app.get("/agregados")
+def agregados(
+    por: str = Query("organismo", pattern="^(organismo|documento|ubicacion|estado)$"),
+    ids: Optional[List[int]] = Query(None),
+):
+    """Totales agrupados sobre los registros indicados (por defecto, todo el historial)"""
+    agregado = derivados.agregar_columnar(por, set(ids) if ids else None)
+    if agregado is not None:
+        return _df_a_json(agregado)
+
+    dfs = []
+    for entrada in almacen.cargar_indice():
+        if ids and entrada['id'] not in ids:
+            continue
+        registro = almacen.cargar_registro(entrada, incluir_binarios=False)
+        if registro is None or registro['df'].empty:
+            continue
+        df = registro['df']
+        df['documento'] = registro['nombre']
+        dfs.append(df)
+
+    if not dfs:
+        return []
+    return _df_a_json(core.agregar_por(pd.concat(dfs, ignore_index=True), por))
+
+
+@app.get("/dispositivos")
+def buscar_dispositivos(q: str = Query(..., min_length=1), limite: int = Query(20, ge=1, le=200)):
+    """S/N del historial que coinciden con el texto (el exacto primero)"""
+    return derivados.buscar_sn(q, limite)
+
+
+@app.get("/dispositivos/{sn}")
+def historial_dispositivo(sn: str):
+    """Lecturas de un equipo en todas las facturas, con sus cambios de organismo/ubicación"""
+    historial = derivados.historial_dispositivo(sn)
+    if historial.empty:
+        raise HTTPException(status_code=404, detail=f"S/N {sn} sin lecturas en el historial")
+    return _df_a_json(historial)
+
+
+@app.get("/exportar")
+def exportar(
+    formato: str = Query("csv", pattern="^(csv|parquet|xlsx)$"),
+    ids: Optional[List[int]] = Query(None),
+):
+    """Exporta las filas de dispositivos (y en xlsx, los resúmenes) escribiendo por bloques"""
+    with tempfile.NamedTemporaryFile(suffix=f".{formato}", delete=False) as tmp:
+        ruta = tmp.name
+    try:
+        factubam_export.exportar(formato, ruta, set(ids) if ids else None)
+    except RuntimeError as e:
+        os.remove(ruta)
+        raise HTTPException(status_code=501, detail=str(e))
+    return FileResponse(
+        ruta,
+        filename=f"factubam_historial.{formato}",
+        background=BackgroundTask(os.remove, ruta)
+    )
+
+
+@app.get("/anomalias")
+def anomalias(umbral: float = Query(derivados.UMBRAL_ANOMALIA, gt=0)):
+    """Lecturas de contador anómalas de todo el historial (z-score robusto por equipo)"""
+    return _df_a_json(derivados.anomalias_historial(umbral))
+
+
+@app.get("/verificacion")
+def verificacion():
+    """Informe de integridad de factubam_data (solo lectura; la reparación se hace con factubam_verificar.py)"""
+    return json.loads(json.dumps(factubam_verificar.verificar(), default=str))
+
+
+@app.post("/archivar")
+def archivar(dias: int = Query(core.DIAS_EN_CALIENTE, ge=0)):
+    """Comprime por año los binarios de las facturas más antiguas que `dias`"""
+    return core.archivar_binarios(dias)
+
+
+@app.get("/espacios")
+def listar_espacios():
+    """Espacios de trabajo existentes ('' es el principal)"""
+    return almacen.listar_espacios()
+
+
+@app.put("/espacios/{nombre}", status_code=201)
+def crear_espacio(nombre: str):
+    """Crea (si no existe) un espacio de trabajo vacío"""
+    try:
+        return {'espacio': almacen.activar_espacio(nombre)}
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.get("/inventarios")
+def listar_inventarios():
+    """Versiones de inventario registradas, por fecha de vigencia"""
+    return almacen.cargar_inventarios()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "factubam_api:app",
+        host=os.environ.get("FACTUBAM_API_HOST", "0.0.0.0"),
+        port=int(os.environ.get("FACTUBAM_API_PORT", "8503")),
+        workers=int(os.environ.get("FACTUBAM_WORKERS", "4"))
+    )
@@ -0,0 +1,171 @@
+"""
+Cálculo de costes de FactuBAM: tarifa del contrato, redondeo al céntimo y esquema
+compacto de las tablas de dispositivos.
+"""
+import numpy as np
+import pandas as pd
+
+# --- CONSTANTES ---
+PRECIO_BN = 0.0098
+PRECIO_COLOR = 0.119
+IVA = 0.21
+
+# ======================================================
+# FUNCIÓN DE REDONDEO EXACTO (TIPO EXCEL/CONTABILIDAD)
+# ======================================================
+def redondear_euro(valor):
+    """
+    Redondea un valor a 2 decimales usando redondeo aritmético (0.5 sube).
+    Esto corrige las discrepancias de céntimos con Excel/PDF.
+    """
+    if valor is None:
+        return 0.0
+    # Se suma 0.5 para asegurar redondeo aritmético correcto en positivos
+    return int(valor * 100 + 0.5) / 100.0
+
+# ======================================================
+# ESQUEMA COMPACTO DE LAS TABLAS DE DISPOSITIVOS
+# ======================================================
+# Contadores int32, textos repetidos como categorías y los costes base en céntimos enteros;
+# el resto de columnas de coste se derivan al mostrar o exportar (df_con_costes)
+COLUMNAS_CENTIMOS = ['coste_bn_sin_iva', 'coste_color_sin_iva', 'iva_bn', 'iva_color', 'iva_total']
+COLUMNAS_COSTE = [
+    'coste_bn_sin_iva', 'coste_color_sin_iva', 'coste_sin_iva',
+    'iva_bn', 'iva_color', 'iva_total',
+    'coste_bn_con_iva', 'coste_color_con_iva', 'coste_con_iva'
+]
+COLUMNAS_CATEGORICAS = ['organismo', 'ubicacion', 'estado']
+
+def _centimos(valores):
+    return np.rint(np.asarray(valores, dtype=np.float64) * 100).astype(np.int32)
+
+def centimos_df(df, columna):
+    """Columna de coste (base o derivada) en céntimos, a partir del esquema compacto"""
+    c = {col: df[f"{col}_cent"].to_numpy(dtype=np.int64) for col in COLUMNAS_CENTIMOS}
+    if columna in c:
+        return c[columna]
+    if columna == 'coste_sin_iva':
+        return c['coste_bn_sin_iva'] + c['coste_color_sin_iva']
+    if columna == 'coste_con_iva':
+        return c['coste_bn_sin_iva'] + c['coste_color_sin_iva'] + c['iva_total']
+    if columna == 'coste_bn_con_iva':
+        return c['coste_bn_sin_iva'] + c['iva_bn']
+    if columna == 'coste_color_con_iva':
+        return c['coste_color_sin_iva'] + c['iva_color']
+    raise KeyError(columna)
+
+def compactar_df(df):
+    """Pasa una tabla de dispositivos (antigua o recién cruzada) al esquema compacto"""
+    df = df.copy()
+    if 'bn' not in df.columns:
+        return df
+    if not all(f"{col}_cent" in df.columns for col in COLUMNAS_CENTIMOS):
+        if all(col in df.columns for col in COLUMNAS_CENTIMOS):
+            for col in COLUMNAS_CENTIMOS:
+                df[f"{col}_cent"] = _centimos(df[col])
+        else:
+            # Registros muy antiguos sin desglose: se valoran con la tarifa por defecto
+            costes = calcular_costes_vectorizado(df['bn'], df['color'], PRECIO_BN, PRECIO_COLOR, IVA)
+            for col in COLUMNAS_CENTIMOS:
+                df[f"{col}_cent"] = _centimos(costes[col])
+        df = df.drop(columns=[col for col in COLUMNAS_COSTE if col in df.columns])
+
+    for col in ('bn', 'color'):
+        df[col] = df[col].fillna(0).astype(np.int32)
+    for col in (f"{c}_cent" for c in COLUMNAS_CENTIMOS):
+        df[col] = df[col].astype(np.int32)
+    for col in COLUMNAS_CATEGORICAS:
+        # Solo compensa si los valores se repiten (las ubicaciones pueden ser casi únicas)
+        if col in df.columns and df[col].nunique(dropna=True) <= len(df) // 2:
+            df[col] = df[col].astype('category')
+    return df
+
+def df_con_costes(df):
+    """Copia de la tabla con las nueve columnas de coste en euros (derivadas de los céntimos)"""
+    if not all(f"{col}_cent" in df.columns for col in COLUMNAS_CENTIMOS):
+        return df.copy()
+    completo = df.drop(columns=[f"{col}_cent" for col in COLUMNAS_CENTIMOS])
+    for col in COLUMNAS_COSTE:
+        completo[col] = centimos_df(df, col) / 100.0
+    for col in COLUMNAS_CATEGORICAS:
+        if col in completo.columns and isinstance(completo[col].dtype, pd.CategoricalDtype):
+            completo[col] = completo[col].astype(object)
+    return completo
+
+def total_euros(df, columna):
+    """Suma exacta de una columna de coste de la tabla compacta"""
+    return int(centimos_df(df, columna).sum()) / 100.0 if len(df) else 0.0
+
+# ======================================================
+# CÁLCULO DE COSTES POR LÍNEA
+# ======================================================
+def calcular_linea_redondeada(bn, color, tarifa=None):
+    """Realiza los cálculos de una línea aplicando redondeo estricto"""
+    precio_bn, precio_color, iva = PRECIO_BN, PRECIO_COLOR, IVA
+    if tarifa is not None:
+        precio_bn, precio_color, iva = tarifa['precio_bn'], tarifa['precio_color'], tarifa['iva']
+
+    # 1. Coste unitario redondeado a 2 decimales
+    coste_bn_sin_iva = redondear_euro(bn * precio_bn)
+    coste_color_sin_iva = redondear_euro(color * precio_color)
+    
+    # 2. Base imponible total de la línea (suma de redondeados)
+    coste_sin_iva = redondear_euro(coste_bn_sin_iva + coste_color_sin_iva)
+    
+    # 3. IVA calculado sobre la base redondeada
+    iva_total = redondear_euro(coste_sin_iva * iva)
+    
+    # 4. Total factura (Base + IVA)
+    coste_con_iva = redondear_euro(coste_sin_iva + iva_total)
+    
+    # Desglose de IVA (informativo)
+    iva_bn = redondear_euro(coste_bn_sin_iva * iva)
+    iva_color = redondear_euro(coste_color_sin_iva * iva)
+    
+    # Totales desglosados
+    coste_bn_con_iva = redondear_euro(coste_bn_sin_iva + iva_bn)
+    coste_color_con_iva = redondear_euro(coste_color_sin_iva + iva_color)
+    
+    return {
+        "coste_bn_sin_iva": coste_bn_sin_iva,
+        "coste_color_sin_iva": coste_color_sin_iva,
+        "coste_sin_iva": coste_sin_iva,
+        "iva_bn": iva_bn,
+        "iva_color": iva_color,
+        "iva_total": iva_total,
+        "coste_bn_con_iva": coste_bn_con_iva,
+        "coste_color_con_iva": coste_color_con_iva,
+        "coste_con_iva": coste_con_iva
+    }
+
+def redondear_euro_array(valores):
+    """Versión vectorizada de redondear_euro (mismo truncado de int() sobre valor*100 + 0.5)"""
+    return np.trunc(np.asarray(valores, dtype=float) * 100 + 0.5) / 100.0
+
+def calcular_costes_vectorizado(bn, color, precio_bn, precio_color, iva):
+    """
+    Aplica los mismos pasos de calcular_linea_redondeada a columnas completas.
+    Los precios pueden ser escalares o un array por fila (una tarifa por registro).
+    """
+    bn = np.asarray(bn, dtype=float)
+    color = np.asarray(color, dtype=float)
+
+    coste_bn_sin_iva = redondear_euro_array(bn * precio_bn)
+    coste_color_sin_iva = redondear_euro_array(color * precio_color)
+    coste_sin_iva = redondear_euro_array(coste_bn_sin_iva + coste_color_sin_iva)
+    iva_total = redondear_euro_array(coste_sin_iva * iva)
+    coste_con_iva = redondear_euro_array(coste_sin_iva + iva_total)
+    iva_bn = redondear_euro_array(coste_bn_sin_iva * iva)
+    iva_color = redondear_euro_array(coste_color_sin_iva * iva)
+
+    return {
+        "coste_bn_sin_iva": coste_bn_sin_iva,
+        "coste_color_sin_iva": coste_color_sin_iva,
+        "coste_sin_iva": coste_sin_iva,
+        "iva_bn": iva_bn,
+        "iva_color": iva_color,
+        "iva_total": iva_total,
+        "coste_bn_con_iva": redondear_euro_array(coste_bn_sin_iva + iva_bn),
+        "coste_color_con_iva": redondear_euro_array(coste_color_sin_iva + iva_color),
+        "coste_con_iva": coste_con_iva
+    }
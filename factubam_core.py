@@ -0,0 +1,844 @@
+"""
+Núcleo de FactuBAM: registros del historial, inventarios versionados, tarifas,
+conciliación y validación de las subidas.
+No depende de Streamlit, de modo que lo comparten la interfaz y el servidor API.
+"""
+import re
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as TiempoAgotado
+from datetime import date, datetime, timedelta
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zipfile
+import numpy as np
+import hashlib
+from bisect import bisect_right
+
+from factubam_almacen import (
+    ARCHIVO_DIR, BASE_EXCEL_FILE, DOCUMENTOS_DIR, ESCENARIOS_DIR, INVENTARIOS_DIR, INVENTARIOS_FILE,
+    RutaEspacio, TARIFAS_FILE, _archivos_registro, _escribir_temporal, _ejecutar_transaccion, _json_texto,
+    _relativa, bloqueo_historial, calcular_md5_archivo, cargar_indice, cargar_inventarios, escribir_atomico,
+    espacio_activo, fecha_factura_registro, resumen_registro
+)
+from factubam_calculo import (
+    COLUMNAS_CATEGORICAS, COLUMNAS_CENTIMOS, IVA, PRECIO_BN, PRECIO_COLOR, _centimos, calcular_costes_vectorizado,
+    centimos_df, compactar_df, df_con_costes, total_euros
+)
+from factubam_derivados import _actualizar_columnar, _actualizar_series
+from factubam_extraccion import (
+    buscar_candidatos, cabeceras_inventario, construir_indice_aproximado, cruzar_inventario,
+    extraer_datos_pdf, leer_inventario_excel, muestra_pdf, normalizar_sn, ocr_disponible
+)
+
+logger = logging.getLogger("factubam")
+
+# ======================================================
+# ALTAS, CAMBIOS Y BAJAS DE REGISTROS
+# ======================================================
+def _preparar_registro(registro, con_binarios):
+    """Escribe a temporales los archivos de un registro: {clave: ruta temporal}"""
+    # El destino definitivo se decide con el bloqueo tomado (el id puede cambiar)
+    destinos = _archivos_registro('tmp')
+    registro['df'] = compactar_df(registro['df'])
+    preparados = {'df': _escribir_temporal(destinos['df'], _json_texto(registro['df'].to_dict('records')))}
+    if con_binarios:
+        for clave in ('pdf_bytes', 'excel_bytes'):
+            if registro.get(clave):
+                preparados[clave] = _escribir_temporal(destinos[clave], registro[clave])
+    return preparados
+
+def _movimientos(registro_id, preparados):
+    destinos = _archivos_registro(registro_id)
+    return [[_relativa(tmp), _relativa(destinos[clave])] for clave, tmp in preparados.items()]
+
+def anadir_registro(registro):
+    """
+    Añade un registro al historial sin reescribir los demás (seguro entre procesos). Si trae
+    un inventario nuevo (procesar_factura), su versión se da de alta en la misma transacción.
+    """
+    preparados = _preparar_registro(registro, con_binarios=True)
+    nuevo = registro.get('inventario_nuevo')
+    if nuevo:
+        version, inventario = _preparar_inventario(nuevo['excel_bytes'], nuevo['excel_name'],
+                                                   nuevo['fecha_vigencia'], nuevo['filas'])
+    with bloqueo_historial():
+        # Dos procesos pueden generar el mismo id en el mismo milisegundo
+        ids = {r['id'] for r in cargar_indice()}
+        while registro['id'] in ids:
+            registro['id'] += 1
+        transaccion = {'mover': _movimientos(registro['id'], preparados)}
+        if nuevo:
+            version = _alta_inventario(transaccion, version, inventario)
+            if nuevo['cruzado']:
+                registro['inventario_id'] = version['id']
+        transaccion['poner'] = [resumen_registro(registro)]
+        _ejecutar_transaccion(transaccion)
+        _actualizar_series(poner=[registro])
+        _actualizar_columnar(poner=[registro])
+    registro.pop('inventario_nuevo', None)
+
+def actualizar_registros(registros, con_datos=True):
+    """
+    Guarda los cambios de unos registros concretos (nombre, costes, ubicaciones...)
+    sin tocar el resto del historial.
+    """
+    registros = [r for r in registros if 'df' in r and isinstance(r['df'], pd.DataFrame)]
+    for registro in registros:
+        registro['revision'] = registro.get('revision', 0) + 1
+    preparados = {r['id']: _preparar_registro(r, con_binarios=False) for r in registros} if con_datos else {}
+
+    with bloqueo_historial():
+        vigentes = {r['id'] for r in cargar_indice()}
+        # Un registro borrado por otro proceso no se resucita
+        registros = [r for r in registros if r['id'] in vigentes]
+        mover = []
+        for registro in registros:
+            mover.extend(_movimientos(registro['id'], preparados.pop(registro['id'], {})))
+        _ejecutar_transaccion({'mover': mover, 'poner': [resumen_registro(r) for r in registros]})
+        if con_datos:
+            _actualizar_series(poner=registros)
+            _actualizar_columnar(poner=registros)
+
+    # Temporales de registros que ya no existen
+    for sobrantes in preparados.values():
+        for tmp in sobrantes.values():
+            tmp.unlink(missing_ok=True)
+
+def quitar_registro(registro_id):
+    """Quita un registro del índice y borra sus archivos (seguro entre procesos)"""
+    with bloqueo_historial():
+        existia = any(r['id'] == registro_id for r in cargar_indice())
+        _ejecutar_transaccion({
+            'quitar': [registro_id],
+            'borrar': [_relativa(ruta) for ruta in _archivos_registro(registro_id).values()]
+        })
+        _actualizar_series(quitar=[registro_id])
+        _actualizar_columnar()
+    return existia
+
+def eliminar_registro_disco(registro_id):
+    """Elimina un registro del disco (índice incluido)"""
+    quitar_registro(registro_id)
+
+def limpiar_historial_disco():
+    """Limpia todo el historial del disco"""
+    with bloqueo_historial():
+        _ejecutar_transaccion({
+            'vaciar': True,
+            'borrar': [_relativa(archivo) for archivo in list(DOCUMENTOS_DIR.glob("*")) + list(ARCHIVO_DIR.glob("*.zip"))
+                       if not archivo.name.endswith('.tmp')]
+        })
+        _actualizar_series(vaciar=True)
+        _actualizar_columnar(vaciar=True)
+    
+    # Opcional: Si quisieras también borrar el Excel base al limpiar todo el historial, 
+    # puedes descomentar las dos siguientes líneas, pero por defecto lo dejamos para que sea persistente:
+    # if BASE_EXCEL_FILE.exists():
+    #     BASE_EXCEL_FILE.unlink()
+
+# ======================================================
+# ARCHIVO DE BINARIOS ANTIGUOS
+# ======================================================
+# Los binarios de las facturas anteriores al corte se comprimen en archivo/<año>.zip
+
+DIAS_EN_CALIENTE = 365
+
+def _archivo_anual(anio):
+    return ARCHIVO_DIR / f"{anio}.zip"
+
+def obtener_binario(registro, clave):
+    """Bytes del PDF ('pdf_bytes') o del inventario ('excel_bytes') de un registro, estén donde estén"""
+    if registro.get(clave):
+        return registro[clave]
+    ruta = _archivos_registro(registro['id'])[clave]
+    if ruta.exists():
+        with open(ruta, 'rb') as f:
+            return f.read()
+    if registro.get('archivado') and _archivo_anual(registro['archivado']).exists():
+        with zipfile.ZipFile(_archivo_anual(registro['archivado'])) as zf:
+            if ruta.name in zf.NameToInfo:
+                return zf.read(ruta.name)
+    if clave == 'excel_bytes' and registro.get('inventario_id'):
+        # La copia del inventario no se archiva si es idéntica a su versión registrada
+        try:
+            return obtener_bytes_inventario(registro['inventario_id'])
+        except FileNotFoundError:
+            pass
+    return None
+
+def _copia_de_version(entrada, ruta):
+    """True si el xlsx guardado con el registro es idéntico a la versión de inventario que usó"""
+    version = INVENTARIOS_DIR / f"{entrada.get('inventario_id')}_inventario.xlsx"
+    return (entrada.get('inventario_id') is not None and version.exists()
+            and version.stat().st_size == ruta.stat().st_size
+            and calcular_md5_archivo(version) == calcular_md5_archivo(ruta))
+
+def archivar_binarios(dias_en_caliente=DIAS_EN_CALIENTE, hoy=None):
+    """
+    Comprime en archivo/<año>.zip los binarios de los registros con factura anterior al corte
+    y los quita de documentos/. Los zip de años con registros ya borrados se reescriben sin ellos.
+    Devuelve {'registros', 'bytes_liberados', 'bytes_archivo'}.
+    """
+    corte = str((hoy or date.today()) - timedelta(days=dias_en_caliente))
+    resultado = {'registros': 0, 'bytes_liberados': 0, 'bytes_archivo': 0}
+
+    with bloqueo_historial():
+        indice = cargar_indice()
+        ids = {entrada['id'] for entrada in indice}
+        por_anio = defaultdict(list)
+        for entrada in indice:
+            fecha = entrada.get('fecha_factura') or entrada['fecha_hora'][:10]
+            if not entrada.get('archivado') and fecha < corte:
+                por_anio[fecha[:4]].append(entrada)
+
+        for zip_anual in ARCHIVO_DIR.glob("*.zip"):
+            with zipfile.ZipFile(zip_anual) as zf:
+                if any(int(nombre.split('_')[0]) not in ids for nombre in zf.namelist()):
+                    por_anio.setdefault(zip_anual.stem, [])
+
+        mover, borrar, poner = [], [], []
+        for anio, entradas in por_anio.items():
+            destino = _archivo_anual(anio)
+            tmp = destino.with_name(f"{destino.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as nuevo:
+                if destino.exists():
+                    with zipfile.ZipFile(destino) as anterior:
+                        for info in anterior.infolist():
+                            if int(info.filename.split('_')[0]) in ids:
+                                nuevo.writestr(info, anterior.read(info))
+                for entrada in entradas:
+                    archivos = _archivos_registro(entrada['id'])
+                    for clave in ('pdf_bytes', 'excel_bytes'):
+                        ruta = archivos[clave]
+                        if not ruta.exists():
+                            continue
+                        if not (clave == 'excel_bytes' and _copia_de_version(entrada, ruta)):
+                            nuevo.write(ruta, ruta.name)
+                        resultado['bytes_liberados'] += ruta.stat().st_size
+                        borrar.append(_relativa(ruta))
+                    poner.append({**entrada, 'archivado': anio})
+            with open(tmp, 'rb+') as f:
+                os.fsync(f.fileno())
+            resultado['bytes_archivo'] += tmp.stat().st_size - (destino.stat().st_size if destino.exists() else 0)
+            mover.append([_relativa(tmp), _relativa(destino)])
+
+        if mover:
+            # El zip queda en su sitio antes de borrar los originales (orden de _aplicar_transaccion)
+            _ejecutar_transaccion({'mover': mover, 'borrar': borrar, 'poner': poner})
+        resultado['registros'] = len(poner)
+    return resultado
+
+# ======================================================
+# INVENTARIOS VERSIONADOS (FECHA DE VIGENCIA)
+# ======================================================
+
+def _preparar_inventario(excel_bytes, excel_name, fecha_vigencia, filas):
+    """Escribe a temporales el xlsx y su índice compilado: (versión sin id, {sufijo: ruta temporal})"""
+    preparados = {
+        'inventario.xlsx': _escribir_temporal(INVENTARIOS_DIR / "tmp_inventario.xlsx", excel_bytes),
+        # Índice compilado: evita volver a abrir el xlsx en cada cruce
+        'indice.json': _escribir_temporal(INVENTARIOS_DIR / "tmp_indice.json", _json_texto(filas, indent=None))
+    }
+    version = {
+        'nombre': excel_name,
+        'fecha_vigencia': str(fecha_vigencia)[:10],
+        'fecha_alta': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'dispositivos': len(filas)
+    }
+    return version, preparados
+
+def _alta_inventario(transaccion, version, preparados):
+    """Añade a la transacción el alta de la versión con un id libre; devuelve la versión (requiere el bloqueo)"""
+    nuevo_id = int(datetime.now().timestamp() * 1000)
+    ids = {v['id'] for v in cargar_inventarios()}
+    while nuevo_id in ids:
+        nuevo_id += 1
+    version = {'id': nuevo_id, **version}
+    transaccion.setdefault('mover', []).extend(
+        [_relativa(tmp), _relativa(INVENTARIOS_DIR / f"{nuevo_id}_{sufijo}")] for sufijo, tmp in preparados.items()
+    )
+    transaccion['inventario'] = version
+    return version
+
+def registrar_inventario(excel_bytes, excel_name, fecha_vigencia):
+    """Guarda una nueva versión del inventario y compila su índice de S/N"""
+    filas = leer_inventario_excel(io.BytesIO(excel_bytes))
+    version, preparados = _preparar_inventario(excel_bytes, excel_name, fecha_vigencia, filas)
+    with bloqueo_historial():
+        transaccion = {}
+        version = _alta_inventario(transaccion, version, preparados)
+        _ejecutar_transaccion(transaccion)
+    return version
+
+def cargar_filas_inventario(inventario_id):
+    """Devuelve las filas compiladas de una versión de inventario"""
+    with open(INVENTARIOS_DIR / f"{inventario_id}_indice.json", 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def obtener_bytes_inventario(inventario_id):
+    """Devuelve el xlsx original de una versión de inventario"""
+    with open(INVENTARIOS_DIR / f"{inventario_id}_inventario.xlsx", 'rb') as f:
+        return f.read()
+
+def inventario_vigente(fecha, versiones=None):
+    """
+    Devuelve la versión de inventario en vigor en una fecha (YYYY-MM-DD).
+    Si la fecha es anterior a todas las versiones se usa la más antigua.
+    """
+    if versiones is None:
+        versiones = cargar_inventarios()
+    if not versiones:
+        return None
+    fechas = [v['fecha_vigencia'] for v in versiones]
+    pos = bisect_right(fechas, str(fecha)[:10])
+    return versiones[max(pos - 1, 0)]
+
+def migrar_excel_base():
+    """Registra el Excel base heredado como primera versión si aún no hay inventarios versionados"""
+    if BASE_EXCEL_FILE.exists() and not INVENTARIOS_FILE.exists():
+        vigencia = datetime.fromtimestamp(BASE_EXCEL_FILE.stat().st_mtime).date()
+        with open(BASE_EXCEL_FILE, 'rb') as f:
+            registrar_inventario(f.read(), BASE_EXCEL_FILE.name, vigencia)
+
+# Línea temporal compilada por S/N y espacio, se reconstruye solo si cambia el índice de inventarios
+_LINEA_TEMPORAL_CACHE = {}
+
+def construir_linea_temporal():
+    """
+    Compila todas las versiones en una línea temporal por S/N normalizado:
+    sn -> ([fechas de vigencia], [(organismo, ubicación) o None si no figura]).
+    Solo se guardan los cambios, de modo que la consulta es una búsqueda binaria.
+    """
+    firma = INVENTARIOS_FILE.stat().st_mtime_ns if INVENTARIOS_FILE.exists() else None
+    cache = _LINEA_TEMPORAL_CACHE.setdefault(espacio_activo(), {})
+    if cache.get('firma') == firma and 'linea' in cache:
+        return cache
+
+    versiones = cargar_inventarios()
+    linea = {}
+
+    for version in versiones:
+        fecha = version['fecha_vigencia']
+        actuales = {}
+        for sn, organismo, ubicacion in cargar_filas_inventario(version['id']):
+            # Ante S/N duplicados en el inventario manda la primera fila
+            actuales.setdefault(normalizar_sn(sn), (organismo, ubicacion))
+
+        for sn in set(linea) | set(actuales):
+            valor = actuales.get(sn)
+            fechas, valores = linea.setdefault(sn, ([], []))
+            if valores and valores[-1] == valor:
+                continue
+            if fechas and fechas[-1] == fecha:
+                # Dos versiones con la misma vigencia: prevalece la última registrada
+                valores[-1] = valor
+            else:
+                fechas.append(fecha)
+                valores.append(valor)
+
+    cache.clear()
+    cache.update({
+        'firma': firma,
+        'fechas': [v['fecha_vigencia'] for v in versiones],
+        'linea': linea
+    })
+    return cache
+
+def resolver_ubicacion(sn, fecha):
+    """Resuelve (S/N, fecha) -> (organismo, ubicación) según el inventario vigente; None si no figura"""
+    compilado = construir_linea_temporal()
+    if not compilado['fechas']:
+        return None
+
+    entradas = compilado['linea'].get(normalizar_sn(sn))
+    if not entradas:
+        return None
+
+    # Fechas anteriores a la primera versión se resuelven contra la más antigua
+    fecha = max(str(fecha)[:10], compilado['fechas'][0])
+    fechas, valores = entradas
+    pos = bisect_right(fechas, fecha)
+    return valores[pos - 1] if pos else None
+
+def reevaluar_registro(registro):
+    """Reasigna organismo/ubicación de un registro según el inventario vigente en su fecha"""
+    fecha = fecha_factura_registro(registro)
+    df = registro['df'].copy()
+    ubicaciones = [resolver_ubicacion(sn, fecha) for sn in df['sn']]
+
+    df['organismo'] = [u[0] if u else "⚠️ NO EN EXCEL (Solo Factura)" for u in ubicaciones]
+    df['ubicacion'] = [u[1] if u else "Desconocida" for u in ubicaciones]
+    df['estado'] = ["Revisado" if u else "⚠️ Faltante en Excel" for u in ubicaciones]
+
+    registro['df'] = compactar_df(df)
+    version = inventario_vigente(fecha)
+    registro['inventario_id'] = version['id'] if version else None
+    return registro
+
+# ======================================================
+# TARIFAS CON PERIODO DE VIGENCIA
+# ======================================================
+def cargar_tarifas():
+    """
+    Carga la tabla de tarifas ordenada por fecha de inicio.
+    Sin tabla en disco se usa una única tarifa con las constantes del contrato.
+    """
+    if TARIFAS_FILE.exists():
+        with open(TARIFAS_FILE, 'r', encoding='utf-8') as f:
+            tarifas = json.load(f)
+        if tarifas:
+            return sorted(tarifas, key=lambda t: t['desde'])
+    return [{'desde': '2000-01-01', 'precio_bn': PRECIO_BN, 'precio_color': PRECIO_COLOR, 'iva': IVA}]
+
+def normalizar_tarifas(tarifas):
+    """Normaliza tipos y orden de una tabla de tarifas (p.ej. la editada en pantalla)"""
+    return sorted(
+        [{'desde': str(t['desde'])[:10],
+          'precio_bn': float(t['precio_bn']),
+          'precio_color': float(t['precio_color']),
+          'iva': float(t['iva'])} for t in tarifas],
+        key=lambda t: t['desde']
+    )
+
+def guardar_tarifas(tarifas):
+    """Guarda la tabla de tarifas"""
+    escribir_atomico(TARIFAS_FILE, _json_texto(normalizar_tarifas(tarifas)))
+
+def tarifa_vigente(fecha, tarifas=None):
+    """Tarifa en vigor en una fecha; antes de la primera se aplica la más antigua"""
+    if tarifas is None:
+        tarifas = cargar_tarifas()
+    pos = bisect_right([t['desde'] for t in tarifas], str(fecha)[:10])
+    return tarifas[max(pos - 1, 0)]
+
+def repreciar_historial(historial, tarifas=None):
+    """
+    Recalcula las columnas de coste de todos los registros en una única pasada
+    vectorizada sobre los contadores guardados (sin volver a leer ningún PDF).
+    Cada registro se valora con la tarifa vigente en su fecha de factura.
+    Devuelve {id_registro: {columna: array}} sin modificar el historial.
+    """
+    if tarifas is None:
+        tarifas = cargar_tarifas()
+
+    registros = [r for r in historial if 'df' in r and isinstance(r['df'], pd.DataFrame)]
+    if not registros:
+        return {}
+
+    longitudes = [len(r['df']) for r in registros]
+    tarifas_registro = [tarifa_vigente(fecha_factura_registro(r), tarifas) for r in registros]
+
+    bn = np.concatenate([r['df']['bn'].to_numpy(dtype=float) for r in registros])
+    color = np.concatenate([r['df']['color'].to_numpy(dtype=float) for r in registros])
+    precio_bn = np.repeat([t['precio_bn'] for t in tarifas_registro], longitudes)
+    precio_color = np.repeat([t['precio_color'] for t in tarifas_registro], longitudes)
+    iva = np.repeat([t['iva'] for t in tarifas_registro], longitudes)
+
+    costes = calcular_costes_vectorizado(bn, color, precio_bn, precio_color, iva)
+
+    # Volver a repartir las columnas por registro
+    cortes = np.cumsum(longitudes)[:-1]
+    por_columna = {col: np.split(valores, cortes) for col, valores in costes.items()}
+    return {
+        registro['id']: {col: partes[i] for col, partes in por_columna.items()}
+        for i, registro in enumerate(registros)
+    }
+
+def aplicar_costes(historial, costes):
+    """Sustituye las columnas de coste (y los totales) de los registros recalculados"""
+    for registro in historial:
+        if registro['id'] not in costes:
+            continue
+        df = registro['df'].copy()
+        for col in COLUMNAS_CENTIMOS:
+            df[f"{col}_cent"] = _centimos(costes[registro['id']][col])
+        registro['df'] = df
+        registro['coste_total_sin_iva'] = total_euros(df, 'coste_sin_iva')
+        registro['coste_total_con_iva'] = total_euros(df, 'coste_con_iva')
+        if registro.get('conciliacion'):
+            registro['conciliacion'] = conciliar_factura(df, registro['conciliacion']['totales'])
+
+def guardar_escenario(nombre, tarifas, costes):
+    """Guarda un escenario 'what-if' como capa aparte, sin tocar los registros"""
+    escenario = {
+        'nombre': nombre,
+        'fecha_hora': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'tarifas': tarifas,
+        'registros': {
+            str(registro_id): {col: valores.tolist() for col, valores in columnas.items()}
+            for registro_id, columnas in costes.items()
+        }
+    }
+    nombre_archivo = re.sub(r'[^A-Za-z0-9_-]+', '_', nombre).strip('_') or 'escenario'
+    escribir_atomico(ESCENARIOS_DIR / f"{nombre_archivo}.json", _json_texto(escenario, indent=None))
+    return escenario
+
+def resumen_escenario(historial, costes):
+    """Tabla de totales actuales frente a los del escenario, por registro"""
+    filas = []
+    for registro in historial:
+        if registro['id'] not in costes:
+            continue
+        actual = total_euros(registro['df'], 'coste_con_iva')
+        nuevo = costes[registro['id']]['coste_con_iva'].sum()
+        filas.append({
+            'Documento': registro['nombre'],
+            'Fecha factura': fecha_factura_registro(registro),
+            'Actual con IVA': round(actual, 2),
+            'Escenario con IVA': round(nuevo, 2),
+            'Diferencia': round(nuevo - actual, 2)
+        })
+    return pd.DataFrame(filas)
+
+# ======================================================
+# CANDIDATOS, CONCILIACIÓN Y PROCESADO DE FACTURAS
+# ======================================================
+# Índices aproximados ya construidos, por versión de inventario
+_INDICES_APROXIMADOS = {}
+
+def filas_inventario_registro(registro):
+    """Filas del inventario con el que se cruzó un registro (versión o copia xlsx guardada)"""
+    if registro.get('inventario_id'):
+        try:
+            return cargar_filas_inventario(registro['inventario_id'])
+        except FileNotFoundError:
+            pass
+    excel_bytes = obtener_binario(registro, 'excel_bytes')
+    if excel_bytes:
+        try:
+            return leer_inventario_excel(io.BytesIO(excel_bytes))
+        except Exception:
+            return []
+    return []
+
+def proponer_candidatos(registro, max_candidatos=3):
+    """Propone S/N del inventario parecidos para los equipos sin ubicar de un registro"""
+    df = registro['df']
+    columnas = ['sn', 'candidato', 'distancia', 'organismo', 'ubicacion']
+    faltantes = df.loc[df['estado'] == "⚠️ Faltante en Excel", 'sn'].tolist()
+    if not faltantes:
+        return pd.DataFrame(columns=columnas)
+
+    filas_inventario = filas_inventario_registro(registro)
+    clave_cache = (espacio_activo(), registro.get('inventario_id') or ('registro', registro['id']))
+    if clave_cache not in _INDICES_APROXIMADOS:
+        _INDICES_APROXIMADOS[clave_cache] = construir_indice_aproximado(f[0] for f in filas_inventario)
+    indice = _INDICES_APROXIMADOS[clave_cache]
+
+    ubicacion_por_sn = {}
+    for sn, organismo, ubicacion in filas_inventario:
+        ubicacion_por_sn.setdefault(sn, (organismo, ubicacion))
+
+    propuestas = []
+    for sn in faltantes:
+        for candidato, distancia in buscar_candidatos(indice, sn, max_candidatos):
+            organismo, ubicacion = ubicacion_por_sn[candidato]
+            propuestas.append({
+                'sn': sn,
+                'candidato': candidato,
+                'distancia': distancia,
+                'organismo': organismo,
+                'ubicacion': ubicacion
+            })
+    return pd.DataFrame(propuestas, columns=columnas)
+
+def asignar_candidatos_unicos(registro, propuestas):
+    """Asigna organismo/ubicación a los equipos cuyo mejor candidato no tiene empate"""
+    if propuestas.empty:
+        return 0
+    mejores = propuestas[propuestas['distancia'] == propuestas.groupby('sn')['distancia'].transform('min')]
+    unicos = mejores.drop_duplicates('sn', keep=False).set_index('sn')
+
+    df = registro['df'].copy()
+    for col in COLUMNAS_CATEGORICAS:
+        df[col] = df[col].astype(object)
+    mascara = (df['estado'] == "⚠️ Faltante en Excel") & df['sn'].isin(unicos.index)
+    df.loc[mascara, 'organismo'] = df.loc[mascara, 'sn'].map(unicos['organismo'])
+    df.loc[mascara, 'ubicacion'] = df.loc[mascara, 'sn'].map(unicos['ubicacion'])
+    df.loc[mascara, 'estado'] = "Revisado"
+    registro['df'] = compactar_df(df)
+    return int(mascara.sum())
+
+def crear_registro(nombre, pdf_bytes, pdf_name, excel_bytes, excel_name, df, fecha_factura=None, inventario_id=None):
+    """Construye un registro completo con los datos procesados"""
+    nuevo_id = int(datetime.now().timestamp() * 1000)
+    fecha_hora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    # Recalcular totales sumando las columnas redondeadas
+    df = compactar_df(df) if not df.empty else df
+    total_sin_iva = total_euros(df, 'coste_sin_iva') if not df.empty else 0.0
+    total_con_iva = total_euros(df, 'coste_con_iva') if not df.empty else 0.0
+    
+    return {
+        'id': nuevo_id,
+        'nombre': nombre,
+        'fecha_hora': fecha_hora,
+        'fecha_factura': str(fecha_factura)[:10] if fecha_factura else fecha_hora[:10],
+        'inventario_id': inventario_id,
+        'pdf_name': pdf_name,
+        'excel_name': excel_name,
+        'pdf_bytes': pdf_bytes,
+        'excel_bytes': excel_bytes,
+        'df': df,
+        'dispositivos': len(df),
+        'coste_total_sin_iva': total_sin_iva,
+        'coste_total_con_iva': total_con_iva
+    }
+
+TOLERANCIA_CONCILIACION = 0.01  # euros
+# El IVA de la factura se calcula sobre la base total y el nuestro línea a línea:
+# cada línea puede desviarse medio céntimo por el redondeo
+TOLERANCIA_IVA_POR_LINEA = 0.005
+
+def conciliar_factura(df, totales):
+    """
+    Compara los costes calculados con los importes leídos de la factura (ver procesar_filas).
+    Devuelve {'estado': 'cuadra' | 'descuadre' | 'sin_totales', 'comprobaciones': [...],
+    'dispositivos': [...solo las líneas que no cuadran...], 'totales': totales}.
+    """
+    totales = totales or {}
+    tolerancia_iva = TOLERANCIA_CONCILIACION + TOLERANCIA_IVA_POR_LINEA * len(df)
+    calculados = {
+        'base': (total_euros(df, 'coste_sin_iva'), TOLERANCIA_CONCILIACION),
+        'iva': (total_euros(df, 'iva_total'), tolerancia_iva),
+        'total': (total_euros(df, 'coste_con_iva'), tolerancia_iva)
+    }
+
+    comprobaciones = []
+    for concepto, (calculado, tolerancia) in calculados.items():
+        if concepto not in totales:
+            continue
+        diferencia = round(calculado - totales[concepto], 2)
+        comprobaciones.append({
+            'concepto': concepto,
+            'factura': totales[concepto],
+            'calculado': calculado,
+            'diferencia': diferencia,
+            'cuadra': abs(diferencia) <= tolerancia
+        })
+
+    dispositivos = []
+    importes = totales.get('importes', {})
+    if importes and not df.empty:
+        calculado_por_sn = dict(zip(
+            df['sn'],
+            zip(centimos_df(df, 'coste_bn_sin_iva').tolist(), centimos_df(df, 'coste_color_sin_iva').tolist())
+        ))
+        for sn, leidos in importes.items():
+            centimos = calculado_por_sn.get(sn, (0, 0))
+            for tipo, calculado in (('bn', centimos[0] / 100), ('color', centimos[1] / 100)):
+                if tipo not in leidos:
+                    continue
+                diferencia = round(calculado - leidos[tipo], 2)
+                if abs(diferencia) > TOLERANCIA_CONCILIACION:
+                    dispositivos.append({
+                        'sn': sn,
+                        'tipo': tipo,
+                        'factura': leidos[tipo],
+                        'calculado': calculado,
+                        'diferencia': diferencia
+                    })
+
+    if not comprobaciones and not importes:
+        estado = 'sin_totales'
+    elif dispositivos or not all(c['cuadra'] for c in comprobaciones):
+        estado = 'descuadre'
+    else:
+        estado = 'cuadra'
+    return {'estado': estado, 'comprobaciones': comprobaciones, 'dispositivos': dispositivos, 'totales': totales}
+
+def procesar_factura(nombre, pdf_bytes, pdf_name, fecha_factura,
+                     excel_bytes=None, excel_name=None, fecha_vigencia=None):
+    """
+    Flujo completo de una factura: extrae el PDF y lo cruza con el inventario y la tarifa
+    vigentes en la fecha de la factura, contando con el inventario nuevo si se aporta uno.
+    Devuelve el registro sin guardarlo; el inventario nuevo se registra al guardarlo.
+    """
+    versiones = cargar_inventarios()
+    nuevo = None
+    if excel_bytes:
+        # Se cruza con él como si ya fuera una versión más (la última de su fecha de vigencia)
+        nuevo = {'excel_bytes': excel_bytes, 'excel_name': excel_name,
+                 'fecha_vigencia': str(fecha_vigencia or fecha_factura)[:10],
+                 'filas': leer_inventario_excel(io.BytesIO(excel_bytes))}
+        posicion = bisect_right([v['fecha_vigencia'] for v in versiones], nuevo['fecha_vigencia'])
+        versiones = versiones[:posicion] + [{'id': None, 'nombre': excel_name, **nuevo}] + versiones[posicion:]
+
+    version = inventario_vigente(fecha_factura, versiones)
+    if version is None:
+        raise ValueError("No hay ningún inventario registrado")
+
+    incidencias = []
+    totales = {}
+    datos_pdf = extraer_datos_pdf(io.BytesIO(pdf_bytes), incidencias, totales)
+    if version['id'] is None:
+        filas, bytes_inventario = nuevo['filas'], excel_bytes
+    else:
+        filas, bytes_inventario = cargar_filas_inventario(version['id']), obtener_bytes_inventario(version['id'])
+    resultados = cruzar_inventario(filas, datos_pdf, tarifa_vigente(fecha_factura))
+    df = pd.DataFrame(resultados)
+
+    registro = crear_registro(nombre, pdf_bytes, pdf_name, bytes_inventario,
+                              version['nombre'], df, fecha_factura=fecha_factura, inventario_id=version['id'])
+    if nuevo:
+        registro['inventario_nuevo'] = {**nuevo, 'cruzado': version['id'] is None}
+    registro['incidencias_lectura'] = incidencias
+    registro['conciliacion'] = conciliar_factura(registro['df'], totales)
+    return registro
+
+# ======================================================
+# VALIDACIÓN PREVIA DE LAS SUBIDAS
+# ======================================================
+# Primeras páginas del PDF y cabeceras del xlsx, a la vez; lo que no termine a tiempo no se comprueba
+TIEMPO_VALIDACION = 1.0  # segundos
+MAX_COMPROBACIONES_RECORDADAS = 16
+
+# Un solo pool para todas las sesiones; un rerun espera a la comprobación del mismo contenido
+_POOL_VALIDACION = ThreadPoolExecutor(max_workers=2, thread_name_prefix="validacion")
+_COMPROBACIONES = {}
+_BLOQUEO_COMPROBACIONES = threading.Lock()
+
+def _comprobacion(funcion, contenido):
+    """Tarea (futuro) de funcion(contenido), la misma para el mismo contenido mientras se recuerde"""
+    clave = (funcion.__name__, hashlib.md5(contenido).hexdigest())
+    with _BLOQUEO_COMPROBACIONES:
+        tarea = _COMPROBACIONES.pop(clave, None)
+        if tarea is None:
+            tarea = _POOL_VALIDACION.submit(funcion, contenido)
+        _COMPROBACIONES[clave] = tarea  # al final: la más reciente
+        while len(_COMPROBACIONES) > MAX_COMPROBACIONES_RECORDADAS:
+            del _COMPROBACIONES[next(iter(_COMPROBACIONES))]
+    return tarea
+
+def validacion_previa(pdf_bytes=None, excel_bytes=None, fecha_factura=None, tiempo=TIEMPO_VALIDACION):
+    """
+    Comprobación rápida de una subida antes de procesarla. Devuelve {'pdf', 'inventario',
+    'dispositivos_estimados', 'coincidencias', 'errores', 'avisos', 'completa', 'segundos'}:
+    los errores harían fallar el procesado; los avisos, probablemente, darían un resultado raro.
+    """
+    inicio = time.monotonic()
+    resultado = {'pdf': None, 'inventario': None, 'dispositivos_estimados': None, 'coincidencias': None,
+                 'errores': [], 'avisos': [], 'completa': True}
+    tareas = {}
+    if pdf_bytes:
+        tareas['pdf'] = _comprobacion(muestra_pdf, pdf_bytes)
+    if excel_bytes:
+        tareas['inventario'] = _comprobacion(cabeceras_inventario, excel_bytes)
+
+    nombres = {'pdf': "La factura", 'inventario': "El inventario"}
+    for clave, tarea in tareas.items():
+        try:
+            resultado[clave] = tarea.result(timeout=max(tiempo - (time.monotonic() - inicio), 0))
+        except TiempoAgotado:
+            resultado['completa'] = False
+            resultado['avisos'].append(f"{nombres[clave]} no se ha podido comprobar en {tiempo:g} s")
+        except Exception as e:
+            resultado['errores'].append(f"{nombres[clave]} no se puede leer: {e}")
+
+    muestra = resultado['pdf']
+    if muestra is not None:
+        if muestra['sns'] and muestra['muestreadas']:
+            resultado['dispositivos_estimados'] = round(len(muestra['sns']) * muestra['paginas'] / muestra['muestreadas'])
+        if muestra['escaneadas']:
+            resultado['avisos'].append(
+                f"{muestra['escaneadas']} de las primeras {muestra['muestreadas']} página(s) son escaneadas: "
+                + ("se leerán por OCR (más lento)" if ocr_disponible() else "sin OCR disponible no se leerán")
+            )
+        elif not muestra['sns']:
+            resultado['avisos'].append(
+                f"No hay lecturas (N/S, Total monocromo/color) en las primeras {muestra['muestreadas']} página(s): "
+                "¿es la factura correcta?"
+            )
+
+    hojas = resultado['inventario']
+    if hojas is not None:
+        con_sn = [hoja for hoja in hojas if "S/N" not in hoja['faltan']]
+        if not con_sn:
+            resultado['errores'].append("Ninguna hoja del inventario tiene la columna 'S/N'")
+        for hoja in con_sn:
+            if hoja['faltan']:
+                resultado['errores'].append(f"La hoja '{hoja['hoja']}' no tiene la(s) columna(s): {', '.join(hoja['faltan'])}")
+    elif not excel_bytes:
+        # Sin inventario nuevo se cruzará con el registrado: la muestra se compara con él
+        version = inventario_vigente(fecha_factura or date.today())
+        if version is None:
+            resultado['errores'].append("No hay ningún inventario registrado: hay que subir uno")
+        elif muestra is not None and muestra['sns']:
+            claves = {normalizar_sn(fila[0]) for fila in cargar_filas_inventario(version['id'])}
+            encontrados = sum(normalizar_sn(sn) in claves for sn in muestra['sns'])
+            resultado['coincidencias'] = {'inventario': version['nombre'], 'encontrados': encontrados,
+                                          'muestra': len(muestra['sns'])}
+            if encontrados < len(muestra['sns']) / 2:
+                resultado['avisos'].append(
+                    f"Solo {encontrados} de {len(muestra['sns'])} S/N de la muestra están en el inventario "
+                    f"vigente ({version['nombre']})"
+                )
+
+    resultado['segundos'] = round(time.monotonic() - inicio, 3)
+    return resultado
+
+def agregar_por(df, columna):
+    """Totales de contadores y costes agrupados por una columna (organismo, documento...)"""
+    df = df_con_costes(df)
+    df_agr = df.groupby(columna).agg({
+        'bn': 'sum',
+        'color': 'sum',
+        'coste_sin_iva': 'sum',
+        'coste_con_iva': 'sum',
+        'iva_total': 'sum',
+        'sn': 'count'
+    }).rename(columns={'sn': 'dispositivos'}).reset_index()
+    df_agr['total_impresiones'] = df_agr['bn'] + df_agr['color']
+    return df_agr
+
+# ======================================================
+# BANDEJA DE ENTRADA (INGESTA AUTOMÁTICA)
+# ======================================================
+# Avisos que anota factubam_vigilante.py y que la interfaz notifica
+
+BANDEJA_DIR = RutaEspacio("bandeja")
+AVISOS_BANDEJA_FILE = RutaEspacio("bandeja/avisos.jsonl")
+MAX_AVISOS_BANDEJA = 500
+
+def anotar_aviso_bandeja(aviso):
+    """Añade un aviso ({'archivo', 'estado', ...}) con su instante; conserva los MAX_AVISOS_BANDEJA últimos"""
+    aviso = {'instante': datetime.now().timestamp(), **aviso}
+    with open(AVISOS_BANDEJA_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(aviso, ensure_ascii=False, default=str) + '\n')
+    with open(AVISOS_BANDEJA_FILE, 'r', encoding='utf-8') as f:
+        lineas = f.read().splitlines()
+    if len(lineas) > 2 * MAX_AVISOS_BANDEJA:
+        escribir_atomico(AVISOS_BANDEJA_FILE, '\n'.join(lineas[-MAX_AVISOS_BANDEJA:]) + '\n')
+    return aviso
+
+def cargar_avisos_bandeja(desde=0.0):
+    """Avisos de la bandeja posteriores al instante `desde`, del más antiguo al más reciente"""
+    if not AVISOS_BANDEJA_FILE.exists():
+        return []
+    avisos = []
+    with open(AVISOS_BANDEJA_FILE, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                aviso = json.loads(linea)
+            except json.JSONDecodeError:
+                continue  # línea a medio escribir
+            if aviso.get('instante', 0) > desde:
+                avisos.append(aviso)
+    return avisos
+
+def describir_aviso_bandeja(aviso):
+    """Texto de un aviso de la bandeja para el log y la interfaz"""
+    if aviso['estado'] == 'guardado':
+        texto = f"📥 {aviso['archivo']}: guardada como '{aviso['nombre']}' ({aviso['dispositivos']} dispositivos)"
+        if aviso.get('conciliacion') == 'descuadre':
+            texto += " ⚠️ no cuadra con los totales de la factura"
+        return texto
+    if aviso['estado'] == 'duplicado':
+        return f"♻️ {aviso['archivo']}: ya estaba en el historial (registro {aviso['registro_id']})"
+    return f"❌ {aviso['archivo']}: {aviso.get('detalle') or 'no se pudo procesar'}"
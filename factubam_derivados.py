@@ -0,0 +1,619 @@
+"""
+Datos derivados del historial: series de contadores (detección de anomalías e historial
+por S/N) y almacén columnar de dispositivos. Si faltan o no cuadran con el índice se
+reconstruyen.
+"""
+import pandas as pd
+from collections import defaultdict
+import json
+import logging
+import os
+import uuid
+import numpy as np
+
+from factubam_almacen import (
+    RutaEspacio, SERIES_FILE, _json_texto, bloqueo_historial, cargar_indice, cargar_registro,
+    escribir_atomico, espacio_activo, fecha_factura_registro, firma_indice
+)
+from factubam_calculo import COLUMNAS_CENTIMOS, COLUMNAS_COSTE, centimos_df, compactar_df, df_con_costes
+from factubam_extraccion import normalizar_sn
+
+logger = logging.getLogger("factubam")
+
+# ======================================================
+# DETECCIÓN DE LECTURAS ANÓMALAS
+# ======================================================
+# SERIES_FILE: una línea [id, serie] por registro guardado ([id, null] si se borra; vale la última).
+# Una lectura es anómala si su z-score robusto supera el umbral, o si el contador cae a 0.
+
+UMBRAL_ANOMALIA = 3.5
+MIN_LECTURAS_ANOMALIA = 4
+MAD_MINIMA_RELATIVA = 0.05  # evita que un equipo de consumo constante (MAD≈0) salte por cualquier variación
+FACTOR_ANOMALIA = 2.0  # además del z-score, la lectura debe ser al menos el doble o la mitad de la mediana
+FRACCION_COMPACTAR_SERIES = 0.5  # se reescribe SERIES_FILE cuando más de la mitad de sus líneas están superadas
+_SERIES_JSON_ANTIGUO = RutaEspacio("series_contadores.json")  # formato anterior (un solo JSON), se borra al reconstruir
+
+def _serie_registro(registro):
+    """Una lectura por fila del registro, en el orden de su DataFrame (la posición es la fila)"""
+    df = registro['df']
+    # Organismo/ubicación/estado codificados: cada registro repite pocos valores distintos
+    lugares = {}
+    codigos = [
+        lugares.setdefault(lugar, len(lugares))
+        for lugar in zip(*(df[col].astype(object).fillna('').tolist() for col in ('organismo', 'ubicacion', 'estado')))
+    ]
+    return {
+        'fecha': str(fecha_factura_registro(registro)),
+        'nombre': registro['nombre'],
+        'sn': [normalizar_sn(sn) for sn in df['sn']],
+        'bn': df['bn'].fillna(0).astype(int).tolist(),
+        'color': df['color'].fillna(0).astype(int).tolist(),
+        'coste': centimos_df(df, 'coste_con_iva').tolist(),
+        'lugares': [list(lugar) for lugar in lugares],
+        'lugar': codigos
+    }
+
+def tabla_series(series):
+    """Series por registro ({id: serie}) en formato largo: registro_id, fecha, sn, bn, color"""
+    ids = [int(i) for i in series]
+    longitudes = [len(serie['sn']) for serie in series.values()]
+    valores = list(series.values())
+    return pd.DataFrame({
+        'registro_id': np.repeat(np.array(ids, dtype=np.int64), longitudes),
+        'fecha': np.repeat(np.array([s['fecha'] for s in valores], dtype=object), longitudes),
+        'sn': [sn for s in valores for sn in s['sn']],
+        'bn': np.fromiter((v for s in valores for v in s['bn']), dtype=np.float64),
+        'color': np.fromiter((v for s in valores for v in s['color']), dtype=np.float64)
+    })
+
+def estadisticas_robustas(tabla):
+    """Número de lecturas, mediana y MAD de bn/color por S/N"""
+    if tabla.empty:
+        return pd.DataFrame(columns=['n', 'mediana_bn', 'mad_bn', 'mediana_color', 'mad_color'])
+    grupos = tabla.groupby('sn')
+    medianas = grupos[['bn', 'color']].transform('median')
+    desviaciones = (tabla[['bn', 'color']] - medianas).abs()
+    mad = desviaciones.groupby(tabla['sn']).median()
+    med = grupos[['bn', 'color']].median()
+    return pd.DataFrame({
+        'n': grupos.size(),
+        'mediana_bn': med['bn'], 'mad_bn': mad['bn'],
+        'mediana_color': med['color'], 'mad_color': mad['color']
+    })
+
+def _lineas_series(lineas):
+    return ''.join(_json_texto(linea, indent=None) + '\n' for linea in lineas).encode('utf-8')
+
+def _leer_series_registros(entradas):
+    """{id: (revisión, serie)} de esas entradas del índice (las de registros ilegibles no salen)"""
+    leidas = {}
+    for entrada in entradas:
+        registro = cargar_registro(entrada, incluir_binarios=False)
+        if registro is not None:
+            leidas[str(entrada['id'])] = (entrada.get('revision', 0), _serie_registro(registro))
+    return leidas
+
+def _series_al_dia(leidas, entradas):
+    """
+    {id: serie} de esas entradas, tomando de `leidas` (sin el bloqueo) las que no han cambiado
+    de revisión desde entonces; solo se vuelven a leer las demás (requiere el bloqueo)
+    """
+    al_dia = {}
+    for entrada in entradas:
+        registro_id = str(entrada['id'])
+        revision, serie = leidas.get(registro_id, (None, None))
+        if revision != entrada.get('revision', 0):
+            serie = _leer_series_registros([entrada]).get(registro_id, (None, None))[1]
+        if serie is not None:
+            al_dia[registro_id] = serie
+    return al_dia
+
+def _reconstruir_series():
+    """
+    Reescribe SERIES_FILE con una línea por registro del índice. Los registros se leen sin
+    el bloqueo; con él solo se releen los que se han guardado mientras tanto.
+    """
+    leidas = _leer_series_registros(cargar_indice())
+    with bloqueo_historial():
+        series = _series_al_dia(leidas, cargar_indice())
+        escribir_atomico(SERIES_FILE, _lineas_series([[int(registro_id), serie] for registro_id, serie in series.items()]))
+        _SERIES_JSON_ANTIGUO.unlink(missing_ok=True)
+
+def _descartar_linea_incompleta(f):
+    """Trunca lo que haya tras el último salto de línea (una escritura que no terminó)"""
+    fin = f.seek(0, os.SEEK_END)
+    posicion = fin
+    while posicion > 0:
+        bloque = min(posicion, 1 << 16)
+        f.seek(posicion - bloque)
+        salto = f.read(bloque).rfind(b'\n')
+        if salto >= 0:
+            posicion -= bloque - salto - 1
+            break
+        posicion -= bloque
+    if posicion != fin:
+        f.truncate(posicion)
+    f.seek(posicion)
+
+def _anadir_lineas_series(lineas):
+    with open(SERIES_FILE, 'r+b') as f:
+        _descartar_linea_incompleta(f)
+        f.write(_lineas_series(lineas))
+        f.flush()
+        os.fsync(f.fileno())
+
+def _actualizar_series(poner=(), quitar=(), vaciar=False):
+    """Añade las líneas de los registros guardados/modificados y de los borrados (requiere el bloqueo)"""
+    try:
+        if vaciar:
+            escribir_atomico(SERIES_FILE, b'')
+            return
+        if not SERIES_FILE.exists():
+            return  # la primera lectura las reconstruye con todo el historial
+        lineas = [[int(registro_id), None] for registro_id in quitar]
+        lineas += [[registro['id'], _serie_registro(registro)] for registro in poner]
+        _anadir_lineas_series(lineas)
+    except Exception as e:
+        # Son datos derivados: si fallan se reconstruyen en la siguiente lectura
+        logger.warning(f"No se pudieron actualizar las series de contadores: {e}")
+        SERIES_FILE.unlink(missing_ok=True)
+
+def _aplicar_lineas_series(estado, lineas):
+    """
+    Estado (series, estadísticas, índice por S/N) con las líneas aplicadas. No modifica el
+    de partida (otras sesiones pueden estar leyéndolo): copia los diccionarios y rehace
+    solo las listas del índice y las estadísticas de los S/N que tocan las líneas.
+    """
+    series, estadisticas, indice_sn = estado
+    cambios = {str(registro_id): serie for registro_id, serie in lineas}
+    series = dict(series)
+    afectados, superados = set(), set()
+    for registro_id, serie in cambios.items():
+        anterior = series.pop(registro_id, None)
+        if anterior is not None:
+            superados.update(anterior['sn'])
+        if serie is not None:
+            series[registro_id] = serie
+            afectados.update(serie['sn'])
+    afectados |= superados
+
+    indice_sn = dict(indice_sn)
+    cambiados = {int(registro_id) for registro_id in cambios}
+    for sn in afectados:
+        if sn in superados:
+            restantes = [entrada for entrada in indice_sn.get(sn, ()) if entrada[0] not in cambiados]
+        else:
+            restantes = list(indice_sn.get(sn, ()))  # solo gana lecturas: basta una lista nueva
+        if restantes:
+            indice_sn[sn] = restantes
+        else:
+            indice_sn.pop(sn, None)
+    _indexar_sn(series, [registro_id for registro_id, serie in cambios.items() if serie is not None], indice_sn)
+
+    if 2 * len(afectados) >= len(indice_sn):
+        # Afectan a casi todos los equipos (lo normal: cada factura trae el parque entero)
+        estadisticas = estadisticas_robustas(tabla_series(series))
+    elif afectados:
+        # Lecturas de los S/N afectados, tomadas registro a registro de sus series
+        filas_por_registro = defaultdict(list)
+        for sn in afectados:
+            for registro_id, fila in indice_sn.get(sn, ()):
+                filas_por_registro[registro_id].append(fila)
+        columnas = {'sn': [], 'bn': [], 'color': []}
+        for registro_id, filas in filas_por_registro.items():
+            serie = series[str(registro_id)]
+            filas = np.array(filas)
+            columnas['sn'].append(np.array(serie['sn'], dtype=object)[filas])
+            columnas['bn'].append(np.array(serie['bn'], dtype=np.float64)[filas])
+            columnas['color'].append(np.array(serie['color'], dtype=np.float64)[filas])
+        nuevas = estadisticas_robustas(pd.DataFrame({col: np.concatenate(partes) for col, partes in columnas.items()}))
+        estadisticas = pd.concat([estadisticas.drop(index=list(afectados), errors='ignore'), nuevas])
+    return series, estadisticas, indice_sn
+
+# Por espacio: (inodo, bytes leídos, líneas, firma del índice comprobada, (series, estadísticas, índice por S/N))
+_SERIES_CACHE = {}
+
+def _sincronizar_series():
+    """Estado del espacio activo al día con SERIES_FILE (solo se leen las líneas nuevas)"""
+    cache = _SERIES_CACHE.setdefault(espacio_activo(), {})
+    estado = SERIES_FILE.stat()
+    inodo, leidos, lineas, comprobado, datos = cache.get('estado') or (None, 0, 0, None, None)
+    if inodo != estado.st_ino or estado.st_size < leidos:
+        # Reconstruido, compactado o vaciado: se lee desde el principio
+        leidos, lineas, comprobado = 0, 0, None
+        datos = ({}, estadisticas_robustas(tabla_series({})), {})
+    if estado.st_size > leidos:
+        with open(SERIES_FILE, 'rb') as f:
+            f.seek(leidos)
+            nuevo = f.read(estado.st_size - leidos)
+        # La última línea puede estar a medio escribir: se deja para la próxima vez
+        nuevo = nuevo[:nuevo.rfind(b'\n') + 1]
+        if nuevo:
+            nuevas = [json.loads(linea) for linea in nuevo.splitlines()]
+            datos = _aplicar_lineas_series(datos, nuevas)
+            leidos += len(nuevo)
+            lineas += len(nuevas)
+            comprobado = None
+    cache['estado'] = (estado.st_ino, leidos, lineas, comprobado, datos)
+    return datos
+
+def _desfase_series(datos):
+    """
+    (entradas del índice sin línea, ids con línea que ya no están en el índice). Solo se
+    mira de nuevo cuando cambia el índice o llegan líneas nuevas.
+    """
+    cache = _SERIES_CACHE[espacio_activo()]
+    inodo, leidos, lineas, comprobado, actuales = cache['estado']
+    firma = firma_indice()
+    if comprobado == firma:
+        return [], []
+    indice = cargar_indice()
+    ids = {str(entrada['id']) for entrada in indice}
+    faltan = [entrada for entrada in indice if str(entrada['id']) not in datos[0]]
+    sobran = [registro_id for registro_id in datos[0] if registro_id not in ids]
+    if actuales is datos:
+        # Aunque no cuadre: lo que no se arregle (un registro ilegible) no se vuelve a intentar
+        # hasta que cambie algo; factubam_verificar.py lo señala
+        cache['estado'] = (inodo, leidos, lineas, firma, datos)
+    return faltan, sobran
+
+def _reparar_series(faltan, sobran):
+    """
+    Añade las líneas de los registros que faltan en SERIES_FILE (leídos sin el bloqueo) y
+    las de borrado de los que sobran, en vez de reconstruirlo entero
+    """
+    leidas = _leer_series_registros(faltan)
+    with bloqueo_historial():
+        # Con el bloqueo, quizá ya lo haya arreglado otro proceso o haya cambiado el índice
+        series = _sincronizar_series()[0]
+        indice = cargar_indice()
+        ids = {str(entrada['id']) for entrada in indice}
+        poner = _series_al_dia(leidas, [entrada for entrada in indice if str(entrada['id']) not in series])
+        quitar = [registro_id for registro_id in series if registro_id not in ids]
+        if poner or quitar:
+            _anadir_lineas_series(
+                [[int(registro_id), None] for registro_id in quitar]
+                + [[int(registro_id), serie] for registro_id, serie in poner.items()]
+            )
+
+def _series_por_compactar(datos):
+    lineas = _SERIES_CACHE[espacio_activo()]['estado'][2]
+    return lineas - len(datos[0]) > FRACCION_COMPACTAR_SERIES * max(lineas, 1)
+
+def _compactar_series():
+    """Reescribe SERIES_FILE sin las líneas superadas, desde el estado en memoria (requiere el bloqueo)"""
+    datos = _sincronizar_series()
+    if not _series_por_compactar(datos):
+        return  # ya lo ha compactado otro proceso
+    comprobado = _SERIES_CACHE[espacio_activo()]['estado'][3]
+    series = datos[0]
+    escribir_atomico(SERIES_FILE, _lineas_series([[int(registro_id), serie] for registro_id, serie in series.items()]))
+    estado = SERIES_FILE.stat()
+    _SERIES_CACHE[espacio_activo()]['estado'] = (estado.st_ino, estado.st_size, len(series), comprobado, datos)
+
+def _series_vigentes():
+    """
+    (series, estadísticas, índice por S/N) del espacio activo. Se reconstruyen si faltan y,
+    si no cuadran con el índice, se añaden solo las líneas de los registros desfasados. Lo
+    devuelto se comparte entre llamadas: no se debe modificar.
+    """
+    try:
+        datos = _sincronizar_series()
+    except (OSError, ValueError, KeyError, TypeError):
+        _reconstruir_series()
+        datos = _sincronizar_series()
+    faltan, sobran = _desfase_series(datos)
+    if faltan or sobran:
+        _reparar_series(faltan, sobran)
+        datos = _sincronizar_series()
+    if _series_por_compactar(datos):
+        with bloqueo_historial():
+            _compactar_series()
+        datos = _sincronizar_series()
+    return datos
+
+def cargar_series():
+    """Series de contadores y estadísticas por S/N; se reconstruyen si faltan o no cuadran con el índice"""
+    series, estadisticas, _ = _series_vigentes()
+    return series, estadisticas
+
+def _evaluar_lecturas(valores, mediana, mad, n, umbral):
+    """z-score robusto y marcas de salto / caída a 0 (arrays alineados)"""
+    escala = np.maximum(mad, np.maximum(MAD_MINIMA_RELATIVA * mediana, 1.0))
+    z = 0.6745 * (valores - mediana) / escala
+    fuera_de_escala = (valores >= FACTOR_ANOMALIA * mediana) | (valores * FACTOR_ANOMALIA <= mediana)
+    salto = (n >= MIN_LECTURAS_ANOMALIA) & (np.abs(z) > umbral) & fuera_de_escala & (valores > 0)
+    a_cero = (n >= 2) & (valores == 0) & (mediana > 0)
+    return np.nan_to_num(z), salto, a_cero
+
+def _describir_anomalias(df, marcas):
+    """Texto de la anomalía por fila ('' si no hay ninguna)"""
+    textos = np.full(len(df), '', dtype=object)
+    for tipo, etiqueta in (('bn', 'B/N'), ('color', 'Color')):
+        z, salto, a_cero, mediana = marcas[tipo]
+        for i in np.flatnonzero(salto | a_cero):
+            if a_cero[i]:
+                texto = f"{etiqueta} a 0 (mediana {mediana[i]:,.0f})"
+            else:
+                texto = f"{etiqueta} x{df[tipo].iloc[i] / mediana[i]:.1f} respecto a su mediana" if mediana[i] else f"{etiqueta} sin consumo previo"
+            textos[i] = f"{textos[i]} · {texto}" if textos[i] else texto
+    return textos
+
+def marcar_anomalias(df, estadisticas=None, umbral=UMBRAL_ANOMALIA):
+    """Copia del DataFrame con z_bn, z_color y 'anomalia' (texto; '' si la lectura es normal)"""
+    if estadisticas is None:
+        _, estadisticas = cargar_series()
+    df = df.copy()
+    stats = estadisticas.reindex(df['sn'].map(normalizar_sn))
+    n = stats['n'].fillna(0).to_numpy()
+
+    marcas = {}
+    for tipo in ('bn', 'color'):
+        mediana = stats[f'mediana_{tipo}'].to_numpy(dtype=np.float64)
+        z, salto, a_cero = _evaluar_lecturas(
+            df[tipo].fillna(0).to_numpy(dtype=np.float64), mediana, stats[f'mad_{tipo}'].to_numpy(dtype=np.float64), n, umbral
+        )
+        df[f'z_{tipo}'] = np.round(z, 2)
+        marcas[tipo] = (z, salto, a_cero, mediana)
+    df['anomalia'] = _describir_anomalias(df, marcas)
+    return df
+
+def anomalias_historial(umbral=UMBRAL_ANOMALIA):
+    """Todas las lecturas anómalas del historial (vectorizado sobre la tabla larga de series)"""
+    series, estadisticas = cargar_series()
+    tabla = tabla_series(series)
+    if tabla.empty:
+        return tabla.assign(z_bn=[], z_color=[], anomalia=[])
+    tabla = marcar_anomalias(tabla, estadisticas, umbral)
+    return tabla[tabla['anomalia'] != ''].sort_values(['sn', 'fecha']).reset_index(drop=True)
+
+# ======================================================
+# ÍNDICE INVERTIDO POR S/N (HISTORIAL DE UN EQUIPO)
+# ======================================================
+# S/N normalizado -> [[registro_id, fila], ...], puesto al día junto a las series
+
+COLUMNAS_HISTORIAL_SN = ['registro_id', 'documento', 'fecha', 'fila', 'organismo', 'ubicacion',
+                         'estado', 'bn', 'color', 'coste_con_iva', 'cambio']
+
+def _indexar_sn(series, registros_ids, indice_sn):
+    """Añade al índice las filas de los registros indicados"""
+    for registro_id in registros_ids:
+        for fila, sn in enumerate(series[registro_id]['sn']):
+            indice_sn.setdefault(sn, []).append([int(registro_id), fila])
+
+def buscar_sn(texto, limite=20):
+    """S/N del historial que coinciden con el texto: primero el exacto, luego los que lo contienen"""
+    clave = normalizar_sn(texto)
+    if not clave:
+        return []
+    _, _, indice_sn = _series_vigentes()
+    parecidos = sorted(sn for sn in indice_sn if clave in sn and sn != clave)
+    return ([clave] if clave in indice_sn else []) + parecidos[:limite - (clave in indice_sn)]
+
+def historial_dispositivo(sn):
+    """
+    Todas las lecturas de un equipo en el historial, por fecha de factura, con sus contadores,
+    coste y dónde estaba; 'cambio' describe el cambio de organismo/ubicación respecto a la
+    lectura anterior ('' si sigue igual).
+    """
+    series, _, indice_sn = _series_vigentes()
+    filas = []
+    for registro_id, fila in indice_sn.get(normalizar_sn(sn), []):
+        serie = series[str(registro_id)]
+        organismo, ubicacion, estado = serie['lugares'][serie['lugar'][fila]]
+        filas.append([registro_id, serie['nombre'], serie['fecha'], fila, organismo, ubicacion, estado,
+                      serie['bn'][fila], serie['color'][fila], serie['coste'][fila] / 100, ''])
+
+    df = pd.DataFrame(filas, columns=COLUMNAS_HISTORIAL_SN).sort_values(['fecha', 'registro_id'], kind='stable')
+    df = df.reset_index(drop=True)
+    anterior = None
+    for i, lugar in enumerate(zip(df['organismo'], df['ubicacion'])):
+        if anterior is not None and lugar != anterior:
+            partes = [f"{a} → {b}" for a, b in zip(anterior, lugar) if a != b]
+            df.at[i, 'cambio'] = ' · '.join(partes)
+        anterior = lugar
+    return df
+
+# ======================================================
+# ALMACÉN COLUMNAR DE DISPOSITIVOS (ARROW, MAPEADO EN MEMORIA)
+# ======================================================
+# Flujo Arrow IPC de solo añadir con un lote por registro guardado (vale el último de cada id).
+# Sin pyarrow no se usa.
+COLUMNAR_FILE = RutaEspacio("dispositivos.arrow")
+COLUMNAR_LOTES_FILE = RutaEspacio("dispositivos.lotes.json")  # generación, bytes válidos y [id, revisión, filas] de cada lote
+COLUMNAS_TEXTO_COLUMNAR = ['sn', 'organismo', 'ubicacion', 'estado']
+COLUMNAS_NUMERICAS_COLUMNAR = ['bn', 'color'] + [f"{col}_cent" for col in COLUMNAS_CENTIMOS]
+FRACCION_COMPACTAR = 0.5  # se reescribe entero cuando más de la mitad de las filas son de lotes muertos
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute  # noqa: F401
+        import pyarrow.ipc  # noqa: F401
+        return pyarrow
+    except ImportError:
+        return None
+
+def _esquema_columnar(pa, generacion=None):
+    """Esquema del almacén; la cabecera del archivo lleva la generación que anotan los lotes"""
+    return pa.schema(
+        [('registro_id', pa.int64())]
+        + [(col, pa.string()) for col in COLUMNAS_TEXTO_COLUMNAR]
+        + [(col, pa.int64()) for col in COLUMNAS_NUMERICAS_COLUMNAR],
+        metadata={'generacion': generacion} if generacion else None
+    )
+
+def _lote_columnar(pa, registro):
+    """Lote Arrow serializado con la tabla de dispositivos de un registro"""
+    df = compactar_df(registro['df'])
+    columnas = [pa.array(np.full(len(df), registro['id'], dtype=np.int64))]
+    for col in COLUMNAS_TEXTO_COLUMNAR:
+        valores = df[col].astype(object) if col in df.columns else pd.Series([None] * len(df), dtype=object)
+        columnas.append(pa.array([None if pd.isna(v) else str(v) for v in valores], type=pa.string()))
+    for col in COLUMNAS_NUMERICAS_COLUMNAR:
+        columnas.append(pa.array(df[col].to_numpy(dtype=np.int64) if col in df.columns else np.zeros(len(df), np.int64)))
+    return pa.record_batch(columnas, schema=_esquema_columnar(pa)).serialize().to_pybytes(), len(df)
+
+def _leer_lotes_columnar():
+    with open(COLUMNAR_LOTES_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _lotes_vigentes(lotes, indice):
+    """Posiciones de los lotes vigentes (el último de cada registro del índice); None si falta alguno"""
+    ultimo = {}
+    for posicion, (registro_id, _, _) in enumerate(lotes['lotes']):
+        ultimo[registro_id] = posicion
+    ids = {entrada['id'] for entrada in indice}
+    if not ids <= set(ultimo):
+        return None
+    return sorted(ultimo[registro_id] for registro_id in ids)
+
+def _reconstruir_columnar():
+    """Reescribe el almacén con los registros del índice (requiere el bloqueo)"""
+    pa = _pyarrow()
+    if pa is None:
+        return
+    lotes = {'generacion': uuid.uuid4().hex, 'bytes': 0, 'lotes': []}
+    tmp = COLUMNAR_FILE.with_name(f"{COLUMNAR_FILE.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    with open(tmp, 'wb') as f:
+        lotes['bytes'] += f.write(_esquema_columnar(pa, lotes['generacion']).serialize().to_pybytes())
+        for entrada in cargar_indice():
+            registro = cargar_registro(entrada, incluir_binarios=False)
+            if registro is None:
+                continue
+            contenido, filas = _lote_columnar(pa, registro)
+            lotes['bytes'] += f.write(contenido)
+            lotes['lotes'].append([registro['id'], registro.get('revision', 0), filas])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, COLUMNAR_FILE)
+    escribir_atomico(COLUMNAR_LOTES_FILE, _json_texto(lotes, indent=None))
+
+def _actualizar_columnar(poner=(), vaciar=False):
+    """Añade al final los lotes de los registros nuevos o modificados (requiere el bloqueo)"""
+    pa = _pyarrow()
+    if pa is None:
+        return
+    try:
+        if vaciar or not COLUMNAR_FILE.exists() or not COLUMNAR_LOTES_FILE.exists():
+            _reconstruir_columnar()
+            return
+        lotes = _leer_lotes_columnar()
+        if poner:
+            with open(COLUMNAR_FILE, 'r+b') as f:
+                # Lo que haya detrás de los bytes válidos es de una escritura que no terminó
+                f.truncate(lotes['bytes'])
+                f.seek(lotes['bytes'])
+                for registro in poner:
+                    contenido, filas = _lote_columnar(pa, registro)
+                    lotes['bytes'] += f.write(contenido)
+                    lotes['lotes'].append([registro['id'], registro.get('revision', 0), filas])
+                f.flush()
+                os.fsync(f.fileno())
+
+        vigentes = _lotes_vigentes(lotes, cargar_indice())
+        filas_vigentes = sum(lotes['lotes'][posicion][2] for posicion in vigentes or [])
+        filas_totales = sum(filas for _, _, filas in lotes['lotes'])
+        if vigentes is None or filas_totales - filas_vigentes > FRACCION_COMPACTAR * max(filas_totales, 1):
+            _reconstruir_columnar()
+        else:
+            escribir_atomico(COLUMNAR_LOTES_FILE, _json_texto(lotes, indent=None))
+    except Exception as e:
+        logger.warning(f"No se pudo actualizar el almacén columnar: {e}")
+        COLUMNAR_LOTES_FILE.unlink(missing_ok=True)
+
+# Tabla ya mapeada e índice con el que se eligieron sus lotes, por espacio
+_COLUMNAR_CACHE = {}
+
+def _abrir_columnar(pa):
+    """(tabla, {id: entrada del índice}) con los lotes vigentes para esa misma lectura del índice"""
+    cache = _COLUMNAR_CACHE.setdefault(espacio_activo(), {})
+    estado = COLUMNAR_LOTES_FILE.stat()
+    firma = (estado.st_ino, estado.st_mtime_ns, firma_indice())
+    if cache.get('firma') == firma:
+        return cache['tabla'], cache['indice']
+    lotes = _leer_lotes_columnar()
+    indice = cargar_indice()
+    vigentes = _lotes_vigentes(lotes, indice)
+    if vigentes is None:
+        raise ValueError("El almacén columnar no cuadra con el índice")
+    # Solo se leen los bytes válidos; los buffers de la tabla apuntan al mapa, sin copiarlos
+    lector = pa.ipc.open_stream(pa.memory_map(str(COLUMNAR_FILE)).read_buffer(lotes['bytes']))
+    # Entre que se sustituye el archivo y se escriben sus lotes, estos son los del anterior
+    if (lector.schema.metadata or {}).get(b'generacion') != str(lotes.get('generacion')).encode():
+        raise ValueError("Los lotes del almacén columnar son de otro archivo")
+    seleccion = set(vigentes)
+    tabla = pa.Table.from_batches(
+        [lote for posicion, lote in enumerate(lector) if posicion in seleccion], schema=lector.schema
+    )
+    indice = {entrada['id']: entrada for entrada in indice}
+    cache.update(firma=firma, tabla=tabla, indice=indice)
+    return tabla, indice
+
+def _columnar_e_indice(ids=None):
+    """(tabla, índice) de tabla_columnar; el índice es el que corresponde a la tabla. None sin pyarrow."""
+    pa = _pyarrow()
+    if pa is None:
+        return None
+    try:
+        tabla, indice = _abrir_columnar(pa)
+    except (OSError, ValueError, KeyError, pa.ArrowException):
+        with bloqueo_historial():
+            try:
+                # Con el bloqueo, quizá otro proceso ya haya terminado de escribirlo
+                tabla, indice = _abrir_columnar(pa)
+            except (OSError, ValueError, KeyError, pa.ArrowException):
+                _reconstruir_columnar()
+                tabla, indice = _abrir_columnar(pa)
+    if ids is not None:
+        tabla = tabla.filter(pa.compute.is_in(tabla['registro_id'], value_set=pa.array(list(ids), pa.int64())))
+    return tabla, indice
+
+def tabla_columnar(ids=None):
+    """
+    Tabla Arrow (registro_id + columnas de dispositivo, costes en céntimos) de los registros
+    indicados (por defecto, todos), mapeada en memoria. None si pyarrow no está instalado.
+    """
+    columnar = _columnar_e_indice(ids)
+    return None if columnar is None else columnar[0]
+
+def dispositivos_columnar(ids=None):
+    """
+    Filas de dispositivos de los registros (por defecto, todos) con los costes en euros y
+    el documento, la fecha de proceso y la de la factura de cada registro, leídas del almacén
+    columnar. None sin pyarrow.
+    """
+    columnar = _columnar_e_indice(ids)
+    if columnar is None:
+        return None
+    tabla, indice = columnar
+    df = tabla.to_pandas()
+    registro_id = df.pop('registro_id')
+    df = df_con_costes(compactar_df(df))
+    df['documento'] = registro_id.map(lambda i: indice[i]['nombre'])
+    df['fecha'] = registro_id.map(lambda i: indice[i]['fecha_hora'])
+    df['fecha_factura'] = registro_id.map(lambda i: fecha_factura_registro(indice[i]))
+    return df
+
+def agregar_columnar(columna, ids=None):
+    """
+    Lo mismo que agregar_por, pero sumando en Arrow sobre el mapa (sin pasar las filas a
+    pandas). `columna`: organismo, ubicacion, estado o documento. None sin pyarrow.
+    """
+    columnar = _columnar_e_indice(ids)
+    if columnar is None:
+        return None
+    tabla, indice = columnar
+    clave = 'registro_id' if columna == 'documento' else columna
+    sumas = ['bn', 'color'] + [f"{col}_cent" for col in COLUMNAS_CENTIMOS]
+    agregado = tabla.group_by(clave).aggregate([(col, 'sum') for col in sumas] + [('sn', 'count')]).to_pandas()
+    agregado.columns = [col.removesuffix('_sum').removesuffix('_count') for col in agregado.columns]
+    if columna == 'documento':
+        nombres = {registro_id: entrada['nombre'] for registro_id, entrada in indice.items()}
+        agregado['documento'] = agregado.pop('registro_id').map(nombres)
+        agregado = agregado.groupby('documento', as_index=False).sum()
+    for col in COLUMNAS_COSTE:
+        agregado[col] = centimos_df(agregado, col) / 100.0
+    agregado = agregado.rename(columns={'sn': 'dispositivos'}).sort_values(columna, ignore_index=True)
+    agregado['total_impresiones'] = agregado['bn'] + agregado['color']
+    return agregado[[columna, 'bn', 'color', 'coste_sin_iva', 'coste_con_iva', 'iva_total', 'dispositivos', 'total_impresiones']]
@@ -0,0 +1,327 @@
+"""
+Exportación del historial de FactuBAM a CSV, Parquet o xlsx.
+
+Los registros se leen de uno en uno desde `factubam_data/` y se escriben por
+bloques, así que la memoria no crece con el tamaño del historial. El xlsx se
+escribe con openpyxl en modo write-only e incluye los resúmenes por organismo
+y por documento y, opcionalmente, una hoja de facturación por organismo.
+
+Uso desde línea de comandos:
+
+    python factubam_export.py csv historial.csv
+    python factubam_export.py xlsx historial.xlsx --ids 1768915680662 1768915680663
+
+Las hojas de repercusión por organismo de un registro (un xlsx o PDF por
+organismo, empaquetados en un zip) se generan con `generar_repercusiones`, en
+paralelo solo si se le pide (`max_workers`).
+"""
+import argparse
+import importlib.util
+import io
+import multiprocessing
+import re
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import factubam_almacen as almacen
+import factubam_calculo as calculo
+
+COLUMNAS_TEXTO = ['documento', 'fecha', 'fecha_factura', 'sn', 'organismo', 'ubicacion', 'estado']
+COLUMNAS_CONTADORES = ['bn', 'color']
+COLUMNAS_COSTES = calculo.COLUMNAS_COSTE
+COLUMNAS_EXPORTACION = COLUMNAS_TEXTO + COLUMNAS_CONTADORES + COLUMNAS_COSTES
+FORMATOS = ('csv', 'parquet', 'xlsx')
+
+
+def _texto(valor):
+    return None if valor is None or pd.isna(valor) else str(valor)
+
+
+def iterar_dispositivos(ids=None):
+    """Genera, registro a registro, las filas de dispositivos con las columnas de exportación"""
+    for entrada in almacen.cargar_indice():
+        if ids is not None and entrada['id'] not in ids:
+            continue
+        registro = almacen.cargar_registro(entrada, incluir_binarios=False)
+        if registro is None or registro['df'].empty:
+            continue
+
+        df = calculo.df_con_costes(registro['df'])
+        df['documento'] = registro['nombre']
+        df['fecha'] = registro['fecha_hora']
+        df['fecha_factura'] = almacen.fecha_factura_registro(registro)
+        for col in COLUMNAS_EXPORTACION:
+            if col not in df.columns:
+                df[col] = None
+        for col in COLUMNAS_TEXTO:
+            df[col] = df[col].map(_texto)
+        for col in COLUMNAS_CONTADORES:
+            df[col] = df[col].fillna(0).astype('int64')
+        for col in COLUMNAS_COSTES:
+            df[col] = df[col].astype('float64')
+        yield df[COLUMNAS_EXPORTACION]
+
+
+def exportar_csv(destino, ids=None):
+    """CSV con separador ';' y coma decimal (se abre directamente en Excel en español)"""
+    filas = 0
+    with open(destino, 'w', encoding='utf-8-sig', newline='') as f:
+        f.write(';'.join(COLUMNAS_EXPORTACION) + '\n')
+        for bloque in iterar_dispositivos(ids):
+            bloque.to_csv(f, sep=';', decimal=',', header=False, index=False)
+            filas += len(bloque)
+    return filas
+
+
+def exportar_parquet(destino, ids=None):
+    """Parquet con un row group por registro (requiere pyarrow)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("La exportación a Parquet necesita pyarrow (pip install pyarrow)")
+
+    esquema = pa.schema(
+        [(col, pa.string()) for col in COLUMNAS_TEXTO]
+        + [(col, pa.int64()) for col in COLUMNAS_CONTADORES]
+        + [(col, pa.float64()) for col in COLUMNAS_COSTES]
+    )
+    filas = 0
+    with pq.ParquetWriter(destino, esquema, compression='zstd') as writer:
+        for bloque in iterar_dispositivos(ids):
+            writer.write_table(pa.Table.from_pandas(bloque, schema=esquema, preserve_index=False))
+            filas += len(bloque)
+    return filas
+
+
+def _nombre_hoja(nombre, usados):
+    """Nombre de hoja válido para Excel (31 caracteres, sin []:*?/\\) y sin repetir"""
+    base = re.sub(r'[\[\]:*?/\\]', '_', str(nombre or 'Sin organismo'))[:31] or 'Sin organismo'
+    candidato = base
+    n = 2
+    while candidato.lower() in usados:
+        sufijo = f" ({n})"
+        candidato = base[:31 - len(sufijo)] + sufijo
+        n += 1
+    usados.add(candidato.lower())
+    return candidato
+
+
+def _acumular(totales, clave, bloque_agrupado):
+    for fila in bloque_agrupado.itertuples(index=False):
+        acumulado = totales[getattr(fila, clave)]
+        for col in ('dispositivos', 'bn', 'color', 'coste_sin_iva', 'iva_total', 'coste_con_iva'):
+            acumulado[col] += getattr(fila, col)
+
+
+def exportar_xlsx(destino, ids=None, hojas_por_organismo=True):
+    """
+    xlsx en modo write-only: hoja de dispositivos, resúmenes por organismo y por documento
+    y (opcional) una hoja de facturación por organismo.
+    """
+    import openpyxl
+
+    wb = openpyxl.Workbook(write_only=True)
+    hoja_dispositivos = wb.create_sheet("Dispositivos")
+    hoja_dispositivos.append(COLUMNAS_EXPORTACION)
+
+    # Los resúmenes se acumulan al vuelo: su tamaño depende del número de organismos, no de filas
+    nuevo_total = lambda: defaultdict(float)
+    por_organismo = defaultdict(nuevo_total)
+    por_documento = defaultdict(nuevo_total)
+    hojas_organismo = {}
+    nombres_usados = {"dispositivos", "por organismo", "por documento"}
+    columnas_facturacion = ['documento', 'fecha_factura', 'sn', 'ubicacion', 'bn', 'color',
+                            'coste_sin_iva', 'iva_total', 'coste_con_iva']
+
+    filas = 0
+    for bloque in iterar_dispositivos(ids):
+        for fila in bloque.itertuples(index=False, name=None):
+            hoja_dispositivos.append(list(fila))
+
+        resumen = bloque.assign(dispositivos=1).groupby('organismo', dropna=False).sum(numeric_only=True).reset_index()
+        resumen['organismo'] = resumen['organismo'].fillna('Sin organismo')
+        _acumular(por_organismo, 'organismo', resumen)
+        resumen = bloque.assign(dispositivos=1).groupby('documento', dropna=False).sum(numeric_only=True).reset_index()
+        _acumular(por_documento, 'documento', resumen)
+
+        if hojas_por_organismo:
+            for organismo, grupo in bloque.groupby(bloque['organismo'].fillna('Sin organismo')):
+                if organismo not in hojas_organismo:
+                    hoja = wb.create_sheet(_nombre_hoja(organismo, nombres_usados))
+                    hoja.append([f"Facturación — {organismo}"])
+                    hoja.append(columnas_facturacion)
+                    hojas_organismo[organismo] = hoja
+                for fila in grupo[columnas_facturacion].itertuples(index=False, name=None):
+                    hojas_organismo[organismo].append(list(fila))
+        filas += len(bloque)
+
+    columnas_resumen = ['dispositivos', 'bn', 'color', 'coste_sin_iva', 'iva_total', 'coste_con_iva']
+    for titulo, clave, totales in (("Por organismo", 'organismo', por_organismo),
+                                   ("Por documento", 'documento', por_documento)):
+        hoja = wb.create_sheet(titulo)
+        hoja.append([clave] + columnas_resumen)
+        for nombre, acumulado in sorted(totales.items(), key=lambda t: str(t[0])):
+            hoja.append([nombre] + [round(acumulado[col], 2) for col in columnas_resumen])
+
+    wb.save(destino)
+    return filas
+
+
+# ============================================================================
+# REPERCUSIÓN DEL COSTE POR ORGANISMO
+# ============================================================================
+
+COLUMNAS_REPERCUSION = ['sn', 'ubicacion', 'estado', 'bn', 'color', 'coste_sin_iva', 'iva_total', 'coste_con_iva']
+FORMATOS_REPERCUSION = ('xlsx', 'pdf')
+
+
+def _repercusion_xlsx(organismo, documento, fecha_factura, filas, totales):
+    import openpyxl
+
+    wb = openpyxl.Workbook(write_only=True)
+    hoja = wb.create_sheet("Repercusión")
+    hoja.append(["Organismo", organismo])
+    hoja.append(["Factura", documento])
+    hoja.append(["Fecha de factura", fecha_factura])
+    hoja.append([])
+    hoja.append(COLUMNAS_REPERCUSION)
+    for fila in filas:
+        hoja.append(list(fila))
+    hoja.append(["TOTAL", None, None] + totales)
+    salida = io.BytesIO()
+    wb.save(salida)
+    return salida.getvalue()
+
+
+def _repercusion_pdf(organismo, documento, fecha_factura, filas, totales):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    estilos = getSampleStyleSheet()
+    cabecera = ['S/N', 'Ubicación', 'Estado', 'B/N', 'Color', 'Sin IVA (€)', 'IVA (€)', 'Con IVA (€)']
+    cuerpo = [
+        [sn, ubicacion, estado, f"{bn:,}", f"{color:,}", f"{sin_iva:.2f}", f"{iva:.2f}", f"{con_iva:.2f}"]
+        for sn, ubicacion, estado, bn, color, sin_iva, iva, con_iva in filas
+    ]
+    bn, color, sin_iva, iva, con_iva = totales
+    pie = ['TOTAL', '', '', f"{bn:,}", f"{color:,}", f"{sin_iva:.2f}", f"{iva:.2f}", f"{con_iva:.2f}"]
+
+    tabla = Table([cabecera] + cuerpo + [pie], repeatRows=1)
+    tabla.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f77b4')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('ALIGN', (3, 0), (-1, -1), 'RIGHT'),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+    ]))
+
+    salida = io.BytesIO()
+    SimpleDocTemplate(salida, pagesize=landscape(A4), title=f"Repercusión {organismo}").build([
+        Paragraph(f"Repercusión de costes de impresión — {organismo}", estilos['Title']),
+        Paragraph(f"Factura: {documento} · Fecha de factura: {fecha_factura}", estilos['Normal']),
+        Spacer(1, 12),
+        tabla,
+    ])
+    return salida.getvalue()
+
+
+def _documento_repercusion(trabajo):
+    """Genera el documento de un organismo (se ejecuta en un proceso del pool)"""
+    formato, organismo, documento, fecha_factura, filas = trabajo
+    totales = [
+        sum(fila[3] for fila in filas),
+        sum(fila[4] for fila in filas),
+        round(sum(fila[5] for fila in filas), 2),
+        round(sum(fila[6] for fila in filas), 2),
+        round(sum(fila[7] for fila in filas), 2),
+    ]
+    generador = _repercusion_pdf if formato == 'pdf' else _repercusion_xlsx
+    return organismo, generador(organismo, documento, fecha_factura, filas, totales)
+
+
+def _nombre_archivo(nombre, usados):
+    base = re.sub(r'[^\w\-. ]', '_', str(nombre)).strip() or 'organismo'
+    candidato = base
+    n = 2
+    while candidato.lower() in usados:
+        candidato = f"{base}_{n}"
+        n += 1
+    usados.add(candidato.lower())
+    return candidato
+
+
+def generar_repercusiones(registro, formato='xlsx', max_workers=1):
+    """
+    Genera un documento de repercusión por organismo para un registro y los devuelve
+    empaquetados en un zip (bytes). Con max_workers > 1 (o None: una por CPU) los organismos
+    se reparten en un pool de procesos; solo compensa con muchos organismos y varias CPU.
+    """
+    if formato not in FORMATOS_REPERCUSION:
+        raise ValueError(f"Formato no soportado: {formato}")
+    if formato == 'pdf' and importlib.util.find_spec('reportlab') is None:
+        raise RuntimeError("La generación en PDF necesita reportlab (pip install reportlab)")
+
+    df = calculo.df_con_costes(registro['df'])
+    df['organismo'] = df['organismo'].fillna('Sin organismo').astype(str)
+    df['ubicacion'] = df['ubicacion'].map(_texto)
+    df['bn'] = df['bn'].fillna(0).astype(int)
+    df['color'] = df['color'].fillna(0).astype(int)
+    df = df.sort_values(['organismo', 'ubicacion', 'sn'], na_position='last')
+
+    documento = registro['nombre']
+    fecha_factura = str(almacen.fecha_factura_registro(registro))
+    trabajos = [
+        (formato, organismo, documento, fecha_factura, list(grupo[COLUMNAS_REPERCUSION].itertuples(index=False, name=None)))
+        for organismo, grupo in df.groupby('organismo', sort=True)
+    ]
+
+    # Cada proceso arranca importando pandas (~1 s): con un solo organismo no hay nada que repartir
+    if max_workers == 1 or len(trabajos) <= 1:
+        resultados = list(map(_documento_repercusion, trabajos))
+    else:
+        # spawn y no fork: dentro de Streamlit o de la API hay hilos (y bloqueos tomados) que un
+        # proceso hijo hecho con fork heredaría a medias
+        contexto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=contexto) as pool:
+            resultados = list(pool.map(_documento_repercusion, trabajos, chunksize=max(1, len(trabajos) // 32)))
+
+    salida = io.BytesIO()
+    usados = set()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for organismo, contenido in resultados:
+            zf.writestr(f"{_nombre_archivo(organismo, usados)}.{formato}", contenido)
+    return salida.getvalue()
+
+
+def exportar(formato, destino, ids=None):
+    """Exporta en el formato indicado; devuelve el número de filas de dispositivos escritas"""
+    if formato == 'csv':
+        return exportar_csv(destino, ids)
+    if formato == 'parquet':
+        return exportar_parquet(destino, ids)
+    if formato == 'xlsx':
+        return exportar_xlsx(destino, ids)
+    raise ValueError(f"Formato no soportado: {formato}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporta el historial de FactuBAM")
+    parser.add_argument("formato", choices=FORMATOS)
+    parser.add_argument("destino")
+    parser.add_argument("--ids", type=int, nargs="*", help="Registros a exportar (por defecto, todos)")
+    parser.add_argument("--espacio", default=almacen.ESPACIO_POR_DEFECTO, help="Espacio de trabajo (por defecto, el principal)")
+    args = parser.parse_args()
+    try:
+        almacen.activar_espacio(args.espacio, crear=False)
+    except (ValueError, LookupError) as e:
+        parser.error(str(e))
+    total = exportar(args.formato, args.destino, set(args.ids) if args.ids else None)
+    print(f"{total} fila(s) exportada(s) a {args.destino}")
@@ -0,0 +1,465 @@
+"""
+Extracción de FactuBAM: lectura de facturas PDF (tablas y OCR) e inventarios Excel,
+normalización de S/N y cruce de ambos.
+"""
+import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import io
+import json
+import logging
+import os
+import hashlib
+from pathlib import Path
+
+from factubam_almacen import RutaEspacio, _json_texto, escribir_atomico
+from factubam_calculo import calcular_linea_redondeada
+
+logger = logging.getLogger("factubam")
+
+# ======================================================
+# NORMALIZACIÓN Y BÚSQUEDA APROXIMADA DE S/N
+# ======================================================
+_SEPARADORES_SN = re.compile(r'[\s\-_./]+')
+_NUMERO_CON_DECIMALES = re.compile(r'\d+\.0+')
+
+def normalizar_sn(valor):
+    """
+    Clave canónica de un S/N: mayúsculas, sin separadores ni ceros a la izquierda.
+    Los números que openpyxl lee como int/float se convierten sin el '.0'.
+    """
+    if valor is None:
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    texto = str(valor).strip().upper()
+    if _NUMERO_CON_DECIMALES.fullmatch(texto):
+        texto = texto.split('.')[0]
+    texto = _SEPARADORES_SN.sub('', texto)
+    return texto.lstrip('0') or texto
+
+def distancia_edicion(a, b, maximo):
+    """Distancia de Levenshtein; corta en cuanto se supera el máximo (devuelve maximo + 1)"""
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    anterior = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i]
+        for j, cb in enumerate(b, 1):
+            actual.append(min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + (ca != cb)))
+        if min(actual) > maximo:
+            return maximo + 1
+        anterior = actual
+    return anterior[-1]
+
+def _variantes_borrado(texto, max_distancia):
+    """Todas las cadenas obtenidas borrando hasta max_distancia caracteres"""
+    variantes = {texto}
+    frontera = {texto}
+    for _ in range(max_distancia):
+        frontera = {v[:i] + v[i + 1:] for v in frontera for i in range(len(v))}
+        variantes |= frontera
+    return variantes
+
+def construir_indice_aproximado(sns, max_distancia=2):
+    """
+    Índice de borrados (estilo SymSpell) sobre los S/N normalizados del inventario:
+    dos S/N a distancia <= max_distancia comparten al menos una variante de borrado.
+    """
+    variantes = defaultdict(set)
+    originales = defaultdict(list)
+    for sn in sns:
+        clave = normalizar_sn(sn)
+        if not clave:
+            continue
+        if sn not in originales[clave]:
+            originales[clave].append(sn)
+        for variante in _variantes_borrado(clave, max_distancia):
+            variantes[variante].add(clave)
+    return {'max_distancia': max_distancia, 'variantes': variantes, 'originales': originales}
+
+def buscar_candidatos(indice, sn, max_candidatos=3):
+    """Devuelve [(sn_inventario, distancia)] más parecidos a un S/N, ordenados por distancia"""
+    clave = normalizar_sn(sn)
+    max_distancia = indice['max_distancia']
+    claves = set()
+    for variante in _variantes_borrado(clave, max_distancia):
+        claves |= indice['variantes'].get(variante, set())
+
+    candidatos = []
+    for candidata in claves:
+        distancia = distancia_edicion(clave, candidata, max_distancia)
+        if distancia <= max_distancia:
+            candidatos.extend((sn_original, distancia) for sn_original in indice['originales'][candidata])
+
+    candidatos.sort(key=lambda c: (c[1], c[0]))
+    return candidatos[:max_candidatos]
+
+# ======================================================
+# LECTURA DEL INVENTARIO (EXCEL)
+# ======================================================
+COLUMNAS_INVENTARIO = ("S/N", "Organismo", "Ubicación exacta")
+
+def leer_inventario_excel(xlsx_file):
+    """Lee las filas [S/N, organismo, ubicación] de todas las hojas del inventario, en orden"""
+    import openpyxl  # diferido: solo se necesita al leer inventarios
+
+    wb = openpyxl.load_workbook(xlsx_file)
+    filas = []
+
+    for sheet_name in wb.sheetnames:
+        sheet = wb[sheet_name]
+
+        if sheet.max_row < 2:
+            continue
+
+        header = [c.value for c in sheet[1]]
+        if "S/N" not in header:
+            continue
+
+        faltan = [col for col in COLUMNAS_INVENTARIO if col not in header]
+        if faltan:
+            raise ValueError(f"La hoja '{sheet_name}' del inventario no tiene la(s) columna(s): {', '.join(faltan)}")
+
+        idx_sn = header.index("S/N") + 1
+        idx_org = header.index("Organismo") + 1
+        idx_ubi = header.index("Ubicación exacta") + 1
+
+        for row in range(2, sheet.max_row + 1):
+            sn_val = sheet.cell(row, idx_sn).value
+
+            if sn_val:
+                sn = str(sn_val).strip()
+            else:
+                continue
+
+            filas.append([sn, sheet.cell(row, idx_org).value, sheet.cell(row, idx_ubi).value])
+
+    return filas
+
+# ======================================================
+# OCR DE PÁGINAS ESCANEADAS (OPCIONAL)
+# ======================================================
+# Solo páginas sin capa de texto; sin pytesseract/Tesseract se anotan como incidencia
+OCR_ACTIVADO = os.environ.get("FACTUBAM_OCR", "1") != "0"
+OCR_IDIOMA = os.environ.get("FACTUBAM_OCR_IDIOMA", "spa")
+OCR_RESOLUCION = 300  # ppp al rasterizar
+OCR_DIR = RutaEspacio("ocr")  # Filas reconocidas por huella de página (caché: se puede borrar)
+
+_NUMERO_OCR = re.compile(r'^-?\d[\d.]*(?:,\d+)?€?$')
+_PDF_OCR = None  # PDF abierto en cada proceso del pool de OCR
+
+def ocr_disponible():
+    """True si el OCR está activado y Tesseract responde"""
+    if not OCR_ACTIVADO:
+        return False
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        return True
+    except Exception:
+        return False
+
+def filas_de_texto_ocr(texto):
+    """
+    Convierte el texto reconocido de una página en filas [_, descripción, cantidad, importes...]
+    como las de extract_tables: los números al final de cada línea pasan a ser sus columnas.
+    """
+    filas = []
+    for linea in texto.splitlines():
+        palabras = linea.split()
+        if not palabras:
+            continue
+        corte = len(palabras)
+        while corte > 0 and _NUMERO_OCR.match(palabras[corte - 1]):
+            corte -= 1
+        filas.append(['', ' '.join(palabras[:corte]), *(palabras[corte:] or [''])])
+    return filas
+
+def _huella_pagina(page):
+    """MD5 de las imágenes en bruto de una página escaneada y de los parámetros del OCR"""
+    md5 = hashlib.md5(f"{OCR_IDIOMA}|{OCR_RESOLUCION}|{page.width}x{page.height}".encode())
+    for imagen in page.images:
+        md5.update(imagen['stream'].get_rawdata() or b'')
+    return md5.hexdigest()
+
+def _iniciar_ocr(pdf_bytes):
+    global _PDF_OCR
+    import pdfplumber
+    _PDF_OCR = pdfplumber.open(io.BytesIO(pdf_bytes))
+
+def _ocr_pagina(indice):
+    """Rasteriza y reconoce una página (en un proceso del pool); devuelve sus filas"""
+    import pytesseract
+    imagen = _PDF_OCR.pages[indice].to_image(resolution=OCR_RESOLUCION).original
+    return filas_de_texto_ocr(pytesseract.image_to_string(imagen, lang=OCR_IDIOMA, config='--psm 6'))
+
+def ocr_paginas(pdf_bytes, huellas, max_workers=None):
+    """
+    Filas reconocidas {indice_pagina: filas} de las páginas {indice_pagina: huella}.
+    Las que no están en la caché se reconocen en un pool de procesos.
+    """
+    reconocidas = {}
+    pendientes = []
+    for indice, huella in huellas.items():
+        try:
+            with open(OCR_DIR / f"{huella}.json", 'r', encoding='utf-8') as f:
+                reconocidas[indice] = json.load(f)
+        except (OSError, ValueError):
+            pendientes.append(indice)
+
+    if pendientes:
+        max_workers = max_workers or min(len(pendientes), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_iniciar_ocr, initargs=(pdf_bytes,)) as pool:
+            for indice, filas in zip(pendientes, pool.map(_ocr_pagina, pendientes)):
+                reconocidas[indice] = filas
+                escribir_atomico(OCR_DIR / f"{huellas[indice]}.json", _json_texto(filas, indent=None))
+    return reconocidas
+
+# ======================================================
+# LECTURA DE LA FACTURA (PDF) Y CRUCE CON EL INVENTARIO
+# ======================================================
+# "<S/N> N/S" abre un dispositivo; "TOTAL MONOCROMO"/"TOTAL COLOR" llevan sus contadores
+_PATRON_SN = re.compile(r'([A-Z0-9]{8,})\s+N/S')
+_PATRON_TOTAL = re.compile(
+    r'TOTAL (?P<total>FACTURA|A PAGAR)|IMPORTE (?P<importe>TOTAL)'
+    r'|BASE (?P<base>IMPONIBLE)|CUOTA (?P<iva>(?:DE )?I\.?V\.?A)'
+)
+
+def parsear_numero_es(valor):
+    """'1.234,00' -> 1234.0 (miles con punto, decimales con coma); ValueError si no es un número"""
+    return float(str(valor).replace('.', '').replace(',', '.'))
+
+def _leer_cantidad(fila, sn, columna, incidencias, pagina):
+    try:
+        return int(parsear_numero_es(fila[2]))
+    except (ValueError, OverflowError):
+        if incidencias is not None:
+            incidencias.append({
+                'pagina': pagina,
+                'sn': sn,
+                'columna': columna,
+                'descripcion': str(fila[1]),
+                'cantidad': str(fila[2])
+            })
+        return 0
+
+def _leer_importe(fila, desde):
+    """Último importe legible de la fila a partir de la columna `desde` (None si no hay)"""
+    for celda in reversed(fila[desde:]):
+        if celda is None or not str(celda).strip():
+            continue
+        try:
+            return parsear_numero_es(str(celda).replace('€', '').strip())
+        except ValueError:
+            continue
+    return None
+
+def procesar_filas(filas, datos, sn_actual=None, incidencias=None, pagina=None, totales=None):
+    """
+    Vuelca en `datos` los contadores de unas filas [_, descripción, cantidad, ...]; las
+    cantidades ilegibles cuentan como 0 y se anotan en `incidencias`. Con `totales` recoge
+    además base/iva/total y, en 'importes', el importe de cada línea por S/N.
+    Devuelve el S/N en curso para continuar en la página siguiente.
+    """
+    for fila in filas:
+        desc = str(fila[1]).upper()
+        if 'N/S' in desc:
+            match_sn = _PATRON_SN.search(desc)
+            if match_sn:
+                sn_actual = match_sn.group(1)
+                continue
+
+        es_bn = 'TOTAL MONOCROMO' in desc
+        es_color = 'TOTAL COLOR' in desc
+        if not (es_bn or es_color):
+            if totales is not None and ('TOTAL' in desc or 'BASE' in desc or 'CUOTA' in desc):
+                match_total = _PATRON_TOTAL.search(desc)
+                if match_total:
+                    importe = _leer_importe(fila, 2)
+                    if importe is not None:
+                        # Si se repite (resumen al final), vale la última aparición
+                        clave = match_total.lastgroup
+                        totales['total' if clave == 'importe' else clave] = importe
+            continue
+
+        if sn_actual is None:
+            continue
+
+        if es_bn:
+            datos[sn_actual]["bn"] = _leer_cantidad(fila, sn_actual, "bn", incidencias, pagina)
+        if es_color:
+            datos[sn_actual]["color"] = _leer_cantidad(fila, sn_actual, "color", incidencias, pagina)
+        if totales is not None:
+            importe = _leer_importe(fila, 3)
+            if importe is not None:
+                linea = totales.setdefault('importes', {}).setdefault(sn_actual, {})
+                if es_bn:
+                    linea['bn'] = importe
+                if es_color:
+                    linea['color'] = importe
+    return sn_actual
+
+# Totales escritos como texto libre al pie de la factura (fuera de las tablas)
+_PATRON_TOTALES_TEXTO = re.compile(
+    r'(?P<concepto>BASE IMPONIBLE|CUOTA (?:DE )?I\.?V\.?A|TOTAL (?:FACTURA|A PAGAR)|IMPORTE TOTAL)'
+    r'[^\n]*?(?<![\d.,])(?P<importe>\d{1,3}(?:\.\d{3})*,\d{2}|\d+,\d{2})'
+)
+
+def _totales_en_texto(texto, totales):
+    for m in _PATRON_TOTALES_TEXTO.finditer(texto.upper()):
+        concepto = m.group('concepto')
+        clave = 'base' if concepto.startswith('BASE') else 'iva' if concepto.startswith('CUOTA') else 'total'
+        totales[clave] = parsear_numero_es(m.group('importe'))
+
+def extraer_datos_pdf(pdf_bytes, incidencias=None, totales=None, ocr=None):
+    """
+    Extrae {sn: {'bn', 'color'}} de las tablas de la factura (y sus importes en `totales`).
+    Las páginas escaneadas se leen por OCR si `ocr` (por defecto, si está disponible).
+    """
+    import pdfplumber  # diferido: solo se necesita al procesar una factura
+
+    datos = defaultdict(lambda: {"bn": 0, "color": 0})
+    sn_actual = None
+    with pdfplumber.open(pdf_bytes) as pdf:
+        # Filas de cada página, en orden (None: página escaneada pendiente de OCR)
+        paginas = []
+        escaneadas = {}
+        for indice, page in enumerate(pdf.pages):
+            tables = page.extract_tables()
+            if not tables and not page.chars and page.images:
+                escaneadas[indice] = _huella_pagina(page)
+                paginas.append(None)
+            else:
+                paginas.append([fila for table in tables for fila in table if fila and len(fila) >= 3])
+
+        reconocidas = {}
+        if escaneadas and (ocr if ocr is not None else ocr_disponible()):
+            contenido = pdf_bytes.getvalue() if hasattr(pdf_bytes, 'getvalue') else Path(pdf_bytes).read_bytes()
+            reconocidas = ocr_paginas(contenido, escaneadas)
+        elif escaneadas:
+            logger.warning(f"{len(escaneadas)} página(s) escaneada(s) sin OCR disponible: no se leen")
+            if incidencias is not None:
+                incidencias.extend(
+                    {'pagina': indice + 1, 'sn': None, 'columna': None,
+                     'descripcion': "Página escaneada (sin OCR disponible)", 'cantidad': ''}
+                    for indice in escaneadas
+                )
+
+        for indice, filas in enumerate(paginas):
+            if filas is None:
+                filas = reconocidas.get(indice, [])
+            if filas:
+                sn_actual = procesar_filas(filas, datos, sn_actual, incidencias, indice + 1, totales)
+
+        if (totales is not None and pdf.pages and pdf.pages[-1].chars
+                and not ('base' in totales or 'total' in totales)):
+            # Sin líneas de totales en las tablas: se buscan en el texto de la última página
+            _totales_en_texto(pdf.pages[-1].extract_text() or '', totales)
+    return datos
+
+def cruzar_excel(xlsx_file, datos_pdf):
+    return cruzar_inventario(leer_inventario_excel(xlsx_file), datos_pdf)
+
+def cruzar_inventario(filas_inventario, datos_pdf, tarifa=None):
+    """Cruza los datos del PDF con las filas [S/N, organismo, ubicación] de un inventario"""
+    resultados = []
+    
+    # IMPORTANTE: Set para rastrear qué números de serie del PDF están en el Excel
+    sns_encontrados_en_excel = set()
+    
+    # Los S/N se comparan normalizados (mayúsculas, sin guiones ni ceros a la izquierda)
+    sn_pdf_por_clave = {}
+    for sn_pdf in datos_pdf:
+        sn_pdf_por_clave.setdefault(normalizar_sn(sn_pdf), sn_pdf)
+
+    for sn_excel, organismo, ubicacion in filas_inventario:
+        sn = sn_pdf_por_clave.get(normalizar_sn(sn_excel))
+        if sn is not None:
+            # Marcamos este SN como encontrado
+            sns_encontrados_en_excel.add(sn)
+
+            bn = datos_pdf[sn]["bn"]
+            color = datos_pdf[sn]["color"]
+            
+            # CÁLCULOS CON REDONDEO ESTRICTO
+            calculos = calcular_linea_redondeada(bn, color, tarifa)
+            
+            registro = {
+                "sn": sn,
+                "organismo": organismo,
+                "ubicacion": ubicacion,
+                "bn": bn,
+                "color": color,
+                "estado": "Revisado"
+            }
+            registro.update(calculos)
+            resultados.append(registro)
+    
+    # === CORRECCIÓN DEL DESCUADRE (LOS 200€) ===
+    # Buscar qué S/N existen en el PDF pero NO se encontraron en el Excel
+    for sn_pdf, valores in datos_pdf.items():
+        if sn_pdf not in sns_encontrados_en_excel:
+            # Esta es una máquina que se ha facturado pero no está en el inventario Excel
+            bn = valores["bn"]
+            color = valores["color"]
+            
+            # Calculamos sus costes
+            calculos = calcular_linea_redondeada(bn, color, tarifa)
+
+            # Añadir al resultado con aviso visible
+            registro = {
+                "sn": sn_pdf,
+                "organismo": "⚠️ NO EN EXCEL (Solo Factura)",
+                "ubicacion": "Desconocida",
+                "bn": bn,
+                "color": color,
+                "estado": "⚠️ Faltante en Excel"
+            }
+            registro.update(calculos)
+            resultados.append(registro)
+
+    return resultados
+
+# ======================================================
+# MUESTRAS PARA LA VALIDACIÓN PREVIA
+# ======================================================
+PAGINAS_VALIDACION = 2
+
+def muestra_pdf(pdf_bytes, paginas=PAGINAS_VALIDACION):
+    """Lecturas de las primeras páginas: {'paginas', 'muestreadas', 'escaneadas', 'sns'}"""
+    import pdfplumber
+
+    datos = defaultdict(lambda: {"bn": 0, "color": 0})
+    sn_actual = None
+    escaneadas = 0
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        total = len(pdf.pages)
+        for indice, page in enumerate(pdf.pages[:paginas]):
+            tables = page.extract_tables()
+            if not tables and not page.chars and page.images:
+                escaneadas += 1
+                continue
+            filas = [fila for table in tables for fila in table if fila and len(fila) >= 3]
+            if filas:
+                sn_actual = procesar_filas(filas, datos, sn_actual, pagina=indice + 1)
+    return {'paginas': total, 'muestreadas': min(paginas, total), 'escaneadas': escaneadas, 'sns': list(datos)}
+
+def cabeceras_inventario(excel_bytes):
+    """Cabecera de cada hoja del xlsx, sin leer sus filas: [{'hoja', 'columnas', 'faltan', 'filas'}]"""
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(excel_bytes), read_only=True)
+    try:
+        hojas = []
+        for sheet in wb.worksheets:
+            cabecera = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            hojas.append({
+                'hoja': sheet.title,
+                'columnas': [str(valor) for valor in cabecera if valor is not None],
+                'faltan': [col for col in COLUMNAS_INVENTARIO if col not in cabecera],
+                'filas': max((sheet.max_row or 1) - 1, 0)  # según la dimensión declarada en el xlsx
+            })
+        return hojas
+    finally:
+        wb.close()
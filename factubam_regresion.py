@@ -0,0 +1,462 @@
+"""
+Regresión contra salidas de referencia ("doradas") de la extracción y la valoración.
+
+El redondeo de `redondear_euro` y `calcular_linea_redondeada` está ajustado al
+céntimo con Excel; cualquier optimización de la lectura del PDF o del cálculo de
+costes debe dar exactamente las mismas filas. Este script:
+
+    python factubam_regresion.py generar otro_corpus/  # corpus sintético (PDF + inventario)
+    python factubam_regresion.py grabar otro_corpus/   # graba las salidas de referencia
+    python factubam_regresion.py verificar             # compara y mide con el corpus del repo
+
+El corpus del repositorio está en `regresion/`, con sus salidas doradas ya grabadas.
+Cada caso es `<caso>.pdf` con un `<caso>.json` opcional ({'inventario': [[S/N,
+organismo, ubicación], ...], 'tarifa': {...}, 'totales_factura': {'base', 'iva',
+'total'}}); así se pueden añadir facturas reales anonimizadas junto a las sintéticas.
+La salida dorada (`<caso>.dorada.json`) guarda las filas por dispositivo, sus totales
+y los totales de la factura.
+
+Las doradas no salen de los motores que se quieren vigilar: se graban con los de
+referencia de este script (el bucle original fila a fila con su propia lectura de
+números, y un cruce exacto por S/N canónico en el que manda la primera fila del
+inventario) y con `calcular_linea_redondeada` línea a línea, que es la definición de
+los importes. Los totales de la factura se toman del `.json` del caso (los sintéticos
+los traen del generador). `grabar` no pisa las que ya existen salvo con `--regrabar`.
+
+La verificación ejecuta el circuito completo (extraer_datos_pdf, cruzar_inventario y
+el paso por el esquema compacto) y, por separado, cada motor de referencia frente al
+actual sobre las mismas entradas: la lectura de las filas del PDF y la valoración de
+los contadores (escalar frente a `calcular_costes_vectorizado`). Informa de la
+igualdad exacta y de los tiempos, marcando los casos en los que el actual es más lento.
+"""
+import argparse
+import io
+import json
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import factubam_almacen as almacen
+import factubam_calculo as calculo
+import factubam_extraccion as extraccion
+
+COLUMNAS_TEXTO = ['sn', 'organismo', 'ubicacion', 'estado']
+COLUMNAS_CONTADORES = ['bn', 'color']
+COLUMNAS_SALIDA = COLUMNAS_TEXTO + COLUMNAS_CONTADORES + calculo.COLUMNAS_COSTE
+TARIFAS_SINTETICAS = [
+    {'desde': '2000-01-01', 'precio_bn': calculo.PRECIO_BN, 'precio_color': calculo.PRECIO_COLOR, 'iva': calculo.IVA},
+    {'desde': '2000-01-01', 'precio_bn': 0.0105, 'precio_color': 0.0985, 'iva': 0.21},
+    {'desde': '2000-01-01', 'precio_bn': 0.0079, 'precio_color': 0.125, 'iva': 0.10},
+]
+CASOS_SINTETICOS = 12
+SEMILLA = 2024
+CORPUS = Path(__file__).resolve().parent / "regresion"
+
+
+# ======================================================
+# CORPUS SINTÉTICO
+# ======================================================
+
+def _numero_es(valor, decimales=0):
+    texto = f"{valor:,.{decimales}f}"
+    return texto.replace(',', 'X').replace('.', ',').replace('X', '.')
+
+
+def _sn_aleatorio(azar):
+    return ''.join(azar.choice('ABCDEFGHJKLMNPQRSTUVWXYZ0123456789') for _ in range(azar.randint(8, 14)))
+
+
+def _variante_sn(azar, sn):
+    """Cómo podría venir escrito el mismo S/N en el inventario"""
+    return azar.choice([sn, sn.lower(), f"{sn[:4]}-{sn[4:]}", f" {sn} ", f"{sn[:3]} {sn[3:]}"])
+
+
+def _caso_sintetico(azar, indice):
+    """Dispositivos, inventario y tarifa de un caso; cubre los formatos que aparecen en las facturas"""
+    dispositivos = []
+    for _ in range(azar.choice([3, 25, 80, 250, 600])):
+        sn = _sn_aleatorio(azar)
+        # Contadores repartidos por órdenes de magnitud para recorrer los redondeos
+        bn = int(10 ** azar.uniform(0, 5.5)) if azar.random() > 0.05 else 0
+        color = int(10 ** azar.uniform(0, 4.5)) if azar.random() > 0.3 else 0
+        dispositivos.append((sn, bn, color))
+
+    inventario = []
+    for sn, _, _ in dispositivos:
+        sorteo = azar.random()
+        if sorteo < 0.85:
+            inventario.append([_variante_sn(azar, sn), f"Organismo {azar.randint(1, 12)}", f"Planta {azar.randint(0, 6)}"])
+        elif sorteo < 0.9:
+            # S/N repetido en el inventario: manda la primera fila
+            inventario.append([sn, "Organismo duplicado A", "Sala 1"])
+            inventario.append([sn, "Organismo duplicado B", "Sala 2"])
+        # el resto solo figura en la factura
+    inventario += [[_sn_aleatorio(azar), "Solo inventario", "Almacén"] for _ in range(azar.randint(0, 5))]
+    azar.shuffle(inventario)
+
+    return {
+        'dispositivos': dispositivos,
+        'inventario': inventario,
+        'tarifa': TARIFAS_SINTETICAS[indice % len(TARIFAS_SINTETICAS)],
+        'por_pagina': azar.choice([8, 20, 35]),
+        'ilegible': indice % 4 == 3  # alguna cantidad que no se puede leer
+    }
+
+
+def _pdf_sintetico(azar, caso):
+    """
+    Factura en PDF con el formato de tablas del proveedor (S/N N/S, TOTAL MONOCROMO/COLOR).
+    Devuelve (bytes del PDF, {'base', 'iva', 'total'} impresos en su resumen).
+    """
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import PageBreak, SimpleDocTemplate, Table, TableStyle
+
+    tarifa = caso['tarifa']
+    base = 0.0
+    historia = []
+    dispositivos = caso['dispositivos']
+    for inicio in range(0, len(dispositivos), caso['por_pagina']):
+        filas = [["Ref", "Descripción", "Cantidad", "Precio", "Importe"]]
+        for sn, bn, color in dispositivos[inicio:inicio + caso['por_pagina']]:
+            importe_bn = calculo.redondear_euro(bn * tarifa['precio_bn'])
+            importe_color = calculo.redondear_euro(color * tarifa['precio_color'])
+            base += importe_bn + importe_color
+            filas.append(["", azar.choice([f"Equipo {sn} N/S", f"{sn} N/S", f"MFP {sn}  N/S"]), "", "", ""])
+            filas.append(["", azar.choice(["Contador anterior", "Periodo facturado"]), _numero_es(azar.randint(0, 99999)), "", ""])
+            filas.append(["", azar.choice(["Total monocromo", "TOTAL MONOCROMO", "total monocromo"]),
+                          _numero_es(bn, azar.choice([0, 2])), _numero_es(tarifa['precio_bn'], 4), _numero_es(importe_bn, 2)])
+            if color or azar.random() > 0.5:
+                filas.append(["", azar.choice(["Total color", "TOTAL COLOR"]),
+                              _numero_es(color, azar.choice([0, 2])), _numero_es(tarifa['precio_color'], 4), _numero_es(importe_color, 2)])
+        if caso['ilegible'] and inicio == 0 and len(filas) > 3:
+            filas[3][2] = "n/d"
+        tabla = Table(filas)
+        tabla.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 0.5, 'black'), ('FONTSIZE', (0, 0), (-1, -1), 7)]))
+        historia += [tabla, PageBreak()]
+
+    base = round(base, 2)
+    iva = calculo.redondear_euro(base * tarifa['iva'])
+    totales = {'base': base, 'iva': iva, 'total': round(base + iva, 2)}
+    resumen = Table([
+        ["", "Base imponible", "", "", _numero_es(totales['base'], 2)],
+        ["", "Cuota IVA", "", "", _numero_es(totales['iva'], 2)],
+        ["", "Total factura", "", "", _numero_es(totales['total'], 2)],
+    ])
+    resumen.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 0.5, 'black')]))
+    historia.append(resumen)
+
+    salida = io.BytesIO()
+    SimpleDocTemplate(salida, pagesize=A4).build(historia)
+    return salida.getvalue(), totales
+
+
+def generar_corpus(directorio, casos=CASOS_SINTETICOS, semilla=SEMILLA):
+    """Escribe los casos sintéticos (PDF + inventario y tarifa) en el directorio"""
+    directorio = Path(directorio)
+    directorio.mkdir(parents=True, exist_ok=True)
+    for indice in range(casos):
+        azar = random.Random(semilla * 1000 + indice)
+        caso = _caso_sintetico(azar, indice)
+        nombre = f"sintetico_{indice:02d}"
+        pdf_bytes, totales = _pdf_sintetico(azar, caso)
+        (directorio / f"{nombre}.pdf").write_bytes(pdf_bytes)
+        (directorio / f"{nombre}.json").write_text(
+            almacen._json_texto({'inventario': caso['inventario'], 'tarifa': caso['tarifa'], 'totales_factura': totales}),
+            encoding='utf-8'
+        )
+    return casos
+
+
+# ======================================================
+# MOTORES (REFERENCIA FRENTE A ACTUAL)
+# ======================================================
+
+def _numero_referencia(texto):
+    """Lectura de referencia de una cantidad: '1.234' o '1.234,56' (miles con punto, decimales con coma)"""
+    texto = str(texto).strip()
+    if not re.fullmatch(r'\d{1,3}(\.\d{3})*(,\d+)?|\d+(,\d+)?', texto):
+        raise ValueError(texto)
+    enteros, _, decimales = texto.partition(',')
+    return float(f"{enteros.replace('.', '')}.{decimales or 0}")
+
+
+def _sn_referencia(sn):
+    """Clave de referencia de un S/N: mayúsculas, solo letras y dígitos, sin ceros a la izquierda"""
+    clave = ''.join(c for c in str(sn).upper() if c.isalnum())
+    return clave.lstrip('0') or clave
+
+
+def cruzar_referencia(inventario, datos, tarifa):
+    """
+    Cruce de referencia: el cruce exacto original, pero por clave canónica. Manda la
+    primera fila del inventario de cada S/N; lo que solo está en la factura va al final.
+    """
+    por_clave = {}
+    for sn in datos:
+        por_clave.setdefault(_sn_referencia(sn), sn)
+    resultados, cruzados = [], set()
+    for sn_inventario, organismo, ubicacion in inventario:
+        sn = por_clave.get(_sn_referencia(sn_inventario))
+        if sn is None:
+            continue
+        cruzados.add(sn)
+        resultados.append({"sn": sn, "organismo": organismo, "ubicacion": ubicacion, **datos[sn], "estado": "Revisado",
+                           **calculo.calcular_linea_redondeada(datos[sn]["bn"], datos[sn]["color"], tarifa)})
+    for sn, valores in datos.items():
+        if sn not in cruzados:
+            resultados.append({"sn": sn, "organismo": "⚠️ NO EN EXCEL (Solo Factura)", "ubicacion": "Desconocida",
+                               **valores, "estado": "⚠️ Faltante en Excel",
+                               **calculo.calcular_linea_redondeada(valores["bn"], valores["color"], tarifa)})
+    return resultados
+
+
+def extraer_fila_a_fila(filas):
+    """Lectura de referencia: el bucle original, una búsqueda de regex por fila"""
+    datos = defaultdict(lambda: {"bn": 0, "color": 0})
+    sn_actual = None
+    for fila in filas:
+        descripcion = str(fila[1]).upper()
+        m = re.search(r'([A-Z0-9]{8,})\s+N/S', descripcion)
+        if m:
+            sn_actual = m.group(1)
+            continue
+        if sn_actual is None:
+            continue
+        for marca, columna in (("TOTAL MONOCROMO", "bn"), ("TOTAL COLOR", "color")):
+            if marca in descripcion:
+                try:
+                    datos[sn_actual][columna] = int(_numero_referencia(fila[2]))
+                except (ValueError, OverflowError):
+                    datos[sn_actual][columna] = 0
+    return datos
+
+
+def extraer_actual(filas):
+    """Lectura actual: procesar_filas, con incidencias y totales de la factura"""
+    datos = defaultdict(lambda: {"bn": 0, "color": 0})
+    extraccion.procesar_filas(filas, datos, None, [], 1, {})
+    return datos
+
+
+def valorar_escalar(bn, color, tarifa):
+    """Valoración de referencia: calcular_linea_redondeada línea a línea, en columnas"""
+    lineas = [calculo.calcular_linea_redondeada(b, c, tarifa) for b, c in zip(bn, color)]
+    return {columna: [linea[columna] for linea in lineas] for columna in calculo.COLUMNAS_COSTE}
+
+
+def valorar_vectorizado(bn, color, tarifa):
+    """Valoración actual de repreciar_historial sobre los mismos contadores"""
+    return calculo.calcular_costes_vectorizado(bn, color, tarifa['precio_bn'], tarifa['precio_color'], tarifa['iva'])
+
+
+# ======================================================
+# SALIDAS NORMALIZADAS Y COMPARACIÓN
+# ======================================================
+
+def _salida(df, totales_factura=None):
+    """Filas y totales en tipos exactos (importes en céntimos) para comparar sin tolerancias"""
+    filas = []
+    if not df.empty:
+        df = df.reindex(columns=COLUMNAS_SALIDA)
+        for registro in df.to_dict('records'):
+            fila = [None if pd.isna(registro[col]) else str(registro[col]) for col in COLUMNAS_TEXTO]
+            fila += [int(registro[col]) for col in COLUMNAS_CONTADORES]
+            fila += [int(round(float(registro[col]) * 100)) for col in calculo.COLUMNAS_COSTE]
+            filas.append(fila)
+    columnas = np.array([fila[len(COLUMNAS_TEXTO):] for fila in filas], dtype=np.int64).reshape(len(filas), -1)
+    return {
+        'columnas': COLUMNAS_SALIDA,
+        'filas': filas,
+        'totales': dict(zip(COLUMNAS_CONTADORES + calculo.COLUMNAS_COSTE, columnas.sum(axis=0).tolist()))
+        if filas else {},
+        'totales_factura': {k: v for k, v in (totales_factura or {}).items() if k != 'importes'}
+    }
+
+
+def _diferencias(esperada, obtenida, maximo=5):
+    """Primeras diferencias legibles entre dos salidas normalizadas"""
+    if esperada == obtenida:
+        return []
+    textos = []
+    if len(esperada['filas']) != len(obtenida['filas']):
+        textos.append(f"{len(esperada['filas'])} filas esperadas, {len(obtenida['filas'])} obtenidas")
+    for i, (a, b) in enumerate(zip(esperada['filas'], obtenida['filas'])):
+        for columna, x, y in zip(esperada['columnas'], a, b):
+            if x != y:
+                textos.append(f"fila {i} ({a[0]}) {columna}: {x} != {y}")
+        if len(textos) >= maximo:
+            break
+    for clave in ('totales', 'totales_factura'):
+        if esperada[clave] != obtenida[clave]:
+            textos.append(f"{clave}: {esperada[clave]} != {obtenida[clave]}")
+    return textos[:maximo]
+
+
+def _leer_caso(ruta_pdf):
+    """(bytes del PDF, inventario, tarifa, totales de la factura)"""
+    auxiliar = ruta_pdf.with_suffix('.json')
+    datos = json.loads(auxiliar.read_text(encoding='utf-8')) if auxiliar.exists() else {}
+    # Sin tarifa en el caso se valora con la del contrato
+    return (ruta_pdf.read_bytes(), datos.get('inventario', []), datos.get('tarifa') or TARIFAS_SINTETICAS[0],
+            datos.get('totales_factura', {}))
+
+
+def _filas_pdf(pdf_bytes):
+    """Filas [_, descripción, cantidad, ...] de todas las tablas del PDF, como las lee extraer_datos_pdf"""
+    import pdfplumber
+
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return [fila for page in pdf.pages for table in page.extract_tables()
+                for fila in table if fila and len(fila) >= 3]
+
+
+def _casos(directorio):
+    return sorted(Path(directorio).glob('*.pdf'))
+
+
+def salida_circuito(pdf_bytes, inventario, tarifa):
+    """El circuito completo de procesar_factura, incluido el paso por el esquema compacto"""
+    totales = {}
+    datos = extraccion.extraer_datos_pdf(io.BytesIO(pdf_bytes), [], totales)
+    df = pd.DataFrame(extraccion.cruzar_inventario(inventario, datos, tarifa))
+    return _salida(calculo.df_con_costes(calculo.compactar_df(df)), totales)
+
+
+def salida_referencia(pdf_bytes, inventario, tarifa, totales_factura):
+    """La salida esperada, con los motores de referencia y sin esquema compacto"""
+    datos = extraer_fila_a_fila(_filas_pdf(pdf_bytes))
+    return _salida(pd.DataFrame(cruzar_referencia(inventario, datos, tarifa)), totales_factura)
+
+
+def grabar_doradas(directorio, regrabar=False):
+    """Graba la salida de referencia de los casos que no la tienen (o de todos); devuelve cuántas"""
+    grabadas = 0
+    for ruta in _casos(directorio):
+        destino = ruta.with_suffix('.dorada.json')
+        if destino.exists() and not regrabar:
+            continue
+        salida = salida_referencia(*_leer_caso(ruta))
+        destino.write_text(almacen._json_texto(salida, indent=None), encoding='utf-8')
+        grabadas += 1
+    return grabadas
+
+
+def _cronometrar(funcion, *args, repeticiones=3):
+    """(resultado, mejor tiempo en segundos)"""
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return resultado, mejor
+
+
+def _en_centimos(costes):
+    return {columna: [int(round(float(valor) * 100)) for valor in costes[columna]] for columna in calculo.COLUMNAS_COSTE}
+
+
+def verificar(directorio=CORPUS, repeticiones=3):
+    """
+    Compara cada caso con su salida dorada y los motores de referencia con los actuales.
+    Devuelve una fila por caso y comparación: caso, comparacion, iguales, diferencias,
+    t_referencia, t_nuevo y ratio (veces más rápido el actual).
+    """
+    resultados = []
+    for ruta in _casos(directorio):
+        pdf_bytes, inventario, tarifa, _ = _leer_caso(ruta)
+        dorada_ruta = ruta.with_suffix('.dorada.json')
+        if not dorada_ruta.exists():
+            resultados.append({'caso': ruta.stem, 'comparacion': 'circuito', 'iguales': False,
+                               'diferencias': ["sin salida dorada (ejecuta 'grabar')"]})
+            continue
+        dorada = json.loads(dorada_ruta.read_text(encoding='utf-8'))
+        obtenida, t_circuito = _cronometrar(salida_circuito, pdf_bytes, inventario, tarifa, repeticiones=1)
+        resultados.append({
+            'caso': ruta.stem, 'comparacion': 'circuito', 'iguales': obtenida == dorada,
+            'diferencias': _diferencias(dorada, obtenida), 't_nuevo': t_circuito
+        })
+
+        # Los motores se comparan sobre las mismas filas ya extraídas del PDF
+        filas = _filas_pdf(pdf_bytes)
+        datos_ref, t_ref = _cronometrar(extraer_fila_a_fila, filas, repeticiones=repeticiones)
+        datos_nuevo, t_nuevo = _cronometrar(extraer_actual, filas, repeticiones=repeticiones)
+        resultados.append({
+            'caso': ruta.stem, 'comparacion': 'extracción fila a fila → actual',
+            'iguales': dict(datos_ref) == dict(datos_nuevo),
+            'diferencias': [f"{sn}: {datos_ref.get(sn)} != {datos_nuevo.get(sn)}"
+                            for sn in sorted(set(datos_ref) | set(datos_nuevo))
+                            if datos_ref.get(sn) != datos_nuevo.get(sn)][:5],
+            't_referencia': t_ref, 't_nuevo': t_nuevo
+        })
+
+        # Y la valoración, solo el cálculo, sobre los contadores del cruce
+        cruce = cruzar_referencia(inventario, datos_ref, tarifa)
+        bn = np.array([fila['bn'] for fila in cruce], dtype=np.int64)
+        color = np.array([fila['color'] for fila in cruce], dtype=np.int64)
+        costes_ref, t_ref = _cronometrar(valorar_escalar, bn.tolist(), color.tolist(), tarifa, repeticiones=repeticiones)
+        costes_nuevo, t_nuevo = _cronometrar(valorar_vectorizado, bn, color, tarifa, repeticiones=repeticiones)
+        esperados, obtenidos = _en_centimos(costes_ref), _en_centimos(costes_nuevo)
+        resultados.append({
+            'caso': ruta.stem, 'comparacion': 'valoración escalar → vectorizada',
+            'iguales': esperados == obtenidos,
+            'diferencias': [f"fila {i} ({cruce[i]['sn']}) {columna}: {esperados[columna][i]} != {obtenidos[columna][i]}"
+                            for columna in calculo.COLUMNAS_COSTE
+                            for i in range(len(cruce)) if esperados[columna][i] != obtenidos[columna][i]][:5],
+            't_referencia': t_ref, 't_nuevo': t_nuevo
+        })
+
+    informe = pd.DataFrame(resultados, columns=['caso', 'comparacion', 'iguales', 'diferencias',
+                                                't_referencia', 't_nuevo', 'ratio'])
+    informe['ratio'] = informe['t_referencia'] / informe['t_nuevo']
+    return informe
+
+
+def imprimir_informe(informe):
+    for caso, filas in informe.groupby('caso', sort=False):
+        print(f"{caso}")
+        for _, fila in filas.iterrows():
+            marca = "✅" if fila['iguales'] else "❌"
+            tiempos = ""
+            if pd.notna(fila['t_referencia']):
+                tiempos = (f"  {fila['t_referencia'] * 1000:8.2f} ms → {fila['t_nuevo'] * 1000:8.2f} ms"
+                           f"  (x{fila['ratio']:.2f}{', más lento' if fila['ratio'] < 1 else ''})")
+            elif pd.notna(fila['t_nuevo']):
+                tiempos = f"  {fila['t_nuevo'] * 1000:8.2f} ms"
+            print(f"  {marca} {fila['comparacion']:<34}{tiempos}")
+            for diferencia in fila['diferencias'] or []:
+                print(f"      {diferencia}")
+
+    fallos = int((~informe['iguales']).sum())
+    for comparacion, filas in informe.dropna(subset=['ratio']).groupby('comparacion', sort=False):
+        # Ratio agregado: tiempo total de referencia entre tiempo total del nuevo
+        lentos = int((filas['ratio'] < 1).sum())
+        print(f"{comparacion}: x{filas['t_referencia'].sum() / filas['t_nuevo'].sum():.2f} en conjunto; "
+              f"más lento que la referencia en {lentos} de {len(filas)} caso(s)")
+    print(f"{len(informe)} comprobación(es), {fallos} con diferencias")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regresión de extracción y valoración contra salidas doradas")
+    parser.add_argument("accion", choices=("generar", "grabar", "verificar"))
+    parser.add_argument("directorio", nargs="?", default=CORPUS,
+                        help="Directorio del corpus (<caso>.pdf, <caso>.json, <caso>.dorada.json); por defecto, regresion/")
+    parser.add_argument("--casos", type=int, default=CASOS_SINTETICOS, help="Casos sintéticos a generar")
+    parser.add_argument("--semilla", type=int, default=SEMILLA)
+    parser.add_argument("--repeticiones", type=int, default=3, help="Repeticiones al medir cada motor (vale la mejor)")
+    parser.add_argument("--regrabar", action="store_true", help="Con 'grabar', vuelve a grabar también las doradas existentes")
+    args = parser.parse_args()
+
+    if args.accion == "generar":
+        print(f"{generar_corpus(args.directorio, args.casos, args.semilla)} caso(s) generado(s) en {args.directorio}")
+    elif args.accion == "grabar":
+        print(f"{grabar_doradas(args.directorio, args.regrabar)} salida(s) dorada(s) grabada(s)")
+    else:
+        informe = verificar(args.directorio, args.repeticiones)
+        imprimir_informe(informe)
+        sys.exit(1 if not informe['iguales'].all() else 0)
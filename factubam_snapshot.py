@@ -0,0 +1,387 @@
+"""
+Copias de seguridad de FactuBAM en un único paquete portable.
+
+Un paquete (`.fbsnap`) es un zip comprimido con todo lo necesario para rehacer
+un espacio de trabajo: el índice del historial, las tablas de dispositivos de
+cada registro en columnas, las versiones de inventario, las tarifas, los
+escenarios y los PDF y xlsx originales. Los binarios y las tablas se guardan una
+sola vez por contenido (su nombre es su SHA-256), así que las copias idénticas
+del mismo inventario no ocupan más. El manifiesto lleva la suma de cada miembro.
+
+    python factubam_snapshot.py crear copia.fbsnap
+    python factubam_snapshot.py crear lunes.fbsnap --base copia.fbsnap     # incremental
+    python factubam_snapshot.py verificar lunes.fbsnap
+    python factubam_snapshot.py restaurar lunes.fbsnap --espacio nuevo
+
+Una copia incremental solo contiene lo que no está ya en su base (y en la base de
+esta, etc.); para restaurarla, las bases tienen que estar en la misma carpeta.
+Con el bloqueo del historial tomado solo se leen los índices y se fijan con enlaces
+duros los archivos que hay que copiar, así que la copia es coherente aunque la
+aplicación esté escribiendo; leerlos, sumarlos y comprimirlos se hace después, sin
+frenar a nadie. Al restaurar se comprueban antes todas las sumas en paralelo y solo
+se escribe en un espacio vacío.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import factubam_almacen as almacen
+import factubam_core as core
+import factubam_derivados as derivados
+
+FORMATO = 1
+MANIFIESTO = "manifiesto.json"
+SUMA_MANIFIESTO = "manifiesto.sha256"
+ARCHIVOS_SUELTOS = ("tarifas.json",)  # además de inventarios/ y escenarios/
+PREFIJO_PREPARACION = ".copia-"  # carpeta de enlaces mientras se escribe un paquete (factubam_verificar.py la salta)
+
+
+def _sha256(contenido):
+    return hashlib.sha256(contenido).hexdigest()
+
+
+def _tabla_en_columnas(filas):
+    """Filas de un _data.json como {'columnas': [...], 'datos': {columna: [valores]}}"""
+    columnas = list(filas[0]) if filas else []
+    return {'columnas': columnas, 'datos': {col: [fila.get(col) for fila in filas] for col in columnas}}
+
+
+def _filas_de_columnas(tabla):
+    columnas = tabla['columnas']
+    return [dict(zip(columnas, valores)) for valores in zip(*(tabla['datos'][col] for col in columnas))]
+
+
+# ======================================================
+# CADENA DE PAQUETES (COPIAS INCREMENTALES)
+# ======================================================
+
+def leer_manifiesto(ruta):
+    """Manifiesto de un paquete, comprobando su suma"""
+    with zipfile.ZipFile(ruta) as zf:
+        contenido = zf.read(MANIFIESTO)
+        suma = zf.read(SUMA_MANIFIESTO).decode('ascii').strip()
+    if _sha256(contenido) != suma:
+        raise ValueError(f"{Path(ruta).name}: el manifiesto no coincide con su suma")
+    manifiesto = json.loads(contenido)
+    if manifiesto.get('formato') != FORMATO:
+        raise ValueError(f"{Path(ruta).name}: formato de paquete {manifiesto.get('formato')} no soportado")
+    manifiesto['_suma'] = suma
+    return manifiesto
+
+
+def cadena_de_paquetes(ruta):
+    """[(ruta, manifiesto)] del paquete y sus bases, del más reciente al más antiguo"""
+    cadena = []
+    ruta = Path(ruta)
+    while True:
+        manifiesto = leer_manifiesto(ruta)
+        cadena.append((ruta, manifiesto))
+        base = manifiesto.get('base')
+        if not base:
+            return cadena
+        ruta = ruta.with_name(base['archivo'])
+        if not ruta.exists():
+            raise FileNotFoundError(f"Falta la copia base {base['archivo']} junto a {cadena[-1][0].name}")
+        if leer_manifiesto(ruta)['_suma'] != base['manifiesto']:
+            raise ValueError(f"{base['archivo']} no es la copia sobre la que se hizo {cadena[-1][0].name}")
+
+
+def _miembros_de_cadena(cadena):
+    """{miembro: ruta del paquete que lo contiene}"""
+    ubicacion = {}
+    for ruta, manifiesto in reversed(cadena):
+        for miembro in manifiesto['miembros']:
+            ubicacion[miembro] = ruta
+    return ubicacion
+
+
+# ======================================================
+# CREAR
+# ======================================================
+
+def crear_paquete(destino, base=None):
+    """
+    Copia el espacio activo en `destino`. Con `base`, solo se guardan los miembros que
+    no estén en esa cadena y los registros sin cambios (misma revisión) no se vuelven a leer.
+    Devuelve el manifiesto.
+    """
+    destino = Path(destino)
+    cadena = cadena_de_paquetes(base) if base else []
+    en_bases = _miembros_de_cadena(cadena)
+    registros_base = cadena[0][1]['registros'] if cadena else {}
+
+    manifiesto = {
+        'formato': FORMATO,
+        'creado': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'espacio': almacen.espacio_activo(),
+        'base': {'archivo': Path(base).name, 'manifiesto': cadena[0][1]['_suma']} if cadena else None,
+        'registros': {},
+        'archivos': {},
+        'miembros': {}
+    }
+    tmp = destino.with_name(f"{destino.name}.{os.getpid()}.tmp")
+
+    try:
+        _escribir_paquete(tmp, manifiesto, en_bases, registros_base)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, destino)
+    return manifiesto
+
+
+def _fijador(preparacion):
+    """
+    fijar(ruta): enlace duro en `preparacion` al archivo tal como está ahora (None si no existe).
+    Las escrituras del historial reemplazan los archivos en vez de modificarlos, así que el
+    enlace conserva este contenido aunque después se reescriba, se archive o se borre.
+    """
+    fijados = {}
+
+    def fijar(ruta):
+        if ruta not in fijados:
+            destino = preparacion / str(len(fijados))
+            try:
+                os.link(ruta, destino)
+            except FileNotFoundError:
+                destino = None
+            except OSError:  # sistema de archivos sin enlaces duros: se copia
+                shutil.copyfile(ruta, destino)
+            fijados[ruta] = destino
+        return fijados[ruta]
+
+    return fijar
+
+
+def _binario_fijado(entrada, clave, fijar):
+    """Como core.obtener_binario, pero sobre los archivos fijados"""
+    ruta = almacen._archivos_registro(entrada['id'])[clave]
+    fijado = fijar(ruta)
+    if fijado is not None:
+        return fijado.read_bytes()
+    anual = fijar(core._archivo_anual(entrada['archivado'])) if entrada.get('archivado') else None
+    if anual is not None:
+        with zipfile.ZipFile(anual) as zf:
+            if ruta.name in zf.NameToInfo:
+                return zf.read(ruta.name)
+    if clave == 'excel_bytes' and entrada.get('inventario_id') is not None:
+        # La copia del inventario no se archiva si es idéntica a su versión registrada
+        version = fijar(almacen.INVENTARIOS_DIR / f"{entrada['inventario_id']}_inventario.xlsx")
+        if version is not None:
+            return version.read_bytes()
+    return None
+
+
+def _escribir_paquete(tmp, manifiesto, en_bases, registros_base):
+    preparacion = Path(tempfile.mkdtemp(prefix=PREFIJO_PREPARACION, dir=almacen.DATA_DIR))
+    try:
+        fijar = _fijador(preparacion)
+        with almacen.bloqueo_historial():
+            indice = almacen.cargar_indice()
+            manifiesto['indice'] = indice
+            manifiesto['inventarios'] = almacen.cargar_inventarios()
+
+            pendientes = []
+            for entrada in indice:
+                anterior = registros_base.get(str(entrada['id']))
+                if anterior is not None and anterior['revision'] == entrada.get('revision', 0):
+                    manifiesto['registros'][str(entrada['id'])] = anterior
+                    continue
+                # Todo lo que _binario_fijado pueda necesitar, tal como está con el bloqueo tomado
+                for ruta in almacen._archivos_registro(entrada['id']).values():
+                    fijar(ruta)
+                if entrada.get('archivado'):
+                    fijar(core._archivo_anual(entrada['archivado']))
+                if entrada.get('inventario_id') is not None:
+                    fijar(almacen.INVENTARIOS_DIR / f"{entrada['inventario_id']}_inventario.xlsx")
+                pendientes.append(entrada)
+
+            sueltos = [almacen.DATA_DIR / nombre for nombre in ARCHIVOS_SUELTOS]
+            sueltos += sorted(almacen.INVENTARIOS_DIR.glob("*_indice.json")) + sorted(almacen.INVENTARIOS_DIR.glob("*_inventario.xlsx"))
+            sueltos += sorted(almacen.ESCENARIOS_DIR.glob("*.json"))
+            sueltos = {almacen._relativa(ruta): fijar(ruta) for ruta in sueltos}
+
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+            def guardar(tipo, contenido):
+                suma = _sha256(contenido)
+                miembro = f"{tipo}/{suma}"
+                if miembro not in en_bases and miembro not in manifiesto['miembros']:
+                    zf.writestr(miembro, contenido)
+                    manifiesto['miembros'][miembro] = suma
+                return miembro
+
+            for entrada in pendientes:
+                registro = {'revision': entrada.get('revision', 0), 'tabla': None}
+                datos = fijar(almacen._archivos_registro(entrada['id'])['df'])
+                if datos is not None:  # sin datos se copia tal cual: factubam_verificar.py lo señala
+                    with open(datos, 'r', encoding='utf-8') as f:
+                        tabla = _tabla_en_columnas(json.load(f))
+                    registro['tabla'] = guardar("tablas", almacen._json_texto(tabla, indent=None).encode('utf-8'))
+                for clave in ('pdf_bytes', 'excel_bytes'):
+                    contenido = _binario_fijado(entrada, clave, fijar)
+                    registro[clave] = guardar("blobs", contenido) if contenido else None
+                manifiesto['registros'][str(entrada['id'])] = registro
+
+            for relativa, fijado in sueltos.items():
+                if fijado is not None:
+                    manifiesto['archivos'][relativa] = guardar("blobs", fijado.read_bytes())
+
+            contenido = almacen._json_texto(manifiesto).encode('utf-8')
+            zf.writestr(MANIFIESTO, contenido)
+            zf.writestr(SUMA_MANIFIESTO, _sha256(contenido))
+        manifiesto['_suma'] = _sha256(contenido)
+    finally:
+        shutil.rmtree(preparacion, ignore_errors=True)
+
+
+# ======================================================
+# VERIFICAR Y RESTAURAR
+# ======================================================
+
+def verificar_paquete(ruta, max_workers=None):
+    """
+    Comprueba en paralelo la suma de todos los miembros de la cadena y que no falte
+    ninguno de los que usa el paquete. Devuelve un informe (dict).
+    """
+    cadena = cadena_de_paquetes(ruta)
+    ubicacion = _miembros_de_cadena(cadena)
+    sumas = {miembro: suma for _, manifiesto in cadena for miembro, suma in manifiesto['miembros'].items()}
+
+    # Cada hilo abre sus propios zip: así la lectura y la descompresión no se turnan
+    local = threading.local()
+    todos = []
+
+    def comprobar(miembro):
+        if not hasattr(local, 'zips'):
+            local.zips = {}
+            todos.append(local.zips)
+        paquete = ubicacion[miembro]
+        if paquete not in local.zips:
+            local.zips[paquete] = zipfile.ZipFile(paquete)
+        try:
+            contenido = local.zips[paquete].read(miembro)
+        except (KeyError, zipfile.BadZipFile, OSError) as e:
+            return miembro, 0, str(e)
+        return miembro, len(contenido), None if _sha256(contenido) == sumas[miembro] else "suma incorrecta"
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            resultados = list(pool.map(comprobar, sorted(ubicacion)))
+    finally:
+        for zips in todos:
+            for zf in zips.values():
+                zf.close()
+
+    manifiesto = cadena[0][1]
+    usados = set(manifiesto['archivos'].values())
+    for registro in manifiesto['registros'].values():
+        usados.update(m for m in (registro['tabla'], registro['pdf_bytes'], registro['excel_bytes']) if m)
+    return {
+        'paquetes': [ruta.name for ruta, _ in cadena],
+        'registros': len(manifiesto['indice']),
+        'miembros': len(resultados),
+        'bytes': sum(tamano for _, tamano, _ in resultados),
+        'errores': {miembro: error for miembro, _, error in resultados if error},
+        'faltan': sorted(usados - set(ubicacion))
+    }
+
+
+def restaurar_paquete(ruta, max_workers=None):
+    """
+    Rehace en el espacio activo (que debe estar vacío) el contenido del paquete, después de
+    verificarlo entero. El índice se escribe lo último: si algo falla antes, el espacio
+    sigue vacío y lo escrito queda como huérfano para factubam_verificar.py.
+    """
+    informe = verificar_paquete(ruta, max_workers)
+    if informe['errores'] or informe['faltan']:
+        raise ValueError(f"El paquete no está íntegro: {len(informe['errores'])} miembro(s) dañado(s), "
+                         f"{len(informe['faltan'])} ausente(s)")
+
+    cadena = cadena_de_paquetes(ruta)
+    manifiesto = cadena[0][1]
+    ubicacion = _miembros_de_cadena(cadena)
+    zips = {paquete: zipfile.ZipFile(paquete) for paquete in set(ubicacion.values())}
+
+    def leer(miembro):
+        return zips[ubicacion[miembro]].read(miembro)
+
+    try:
+        with almacen.bloqueo_historial():
+            if almacen.cargar_indice() or almacen.cargar_inventarios():
+                raise ValueError(f"El espacio '{almacen.espacio_activo() or 'principal'}' no está vacío")
+
+            for relativa, miembro in manifiesto['archivos'].items():
+                almacen.escribir_atomico(almacen.DATA_DIR / relativa, leer(miembro))
+            for registro_id, registro in manifiesto['registros'].items():
+                destinos = almacen._archivos_registro(registro_id)
+                if registro['tabla']:
+                    tabla = json.loads(leer(registro['tabla']))
+                    almacen.escribir_atomico(destinos['df'], almacen._json_texto(_filas_de_columnas(tabla)))
+                for clave in ('pdf_bytes', 'excel_bytes'):
+                    if registro[clave]:
+                        almacen.escribir_atomico(destinos[clave], leer(registro[clave]))
+
+            # Los binarios vuelven sin archivar; las series y el almacén columnar se reconstruyen al leerlos
+            indice = [{**entrada, 'archivado': None} for entrada in manifiesto['indice']]
+            almacen.SERIES_FILE.unlink(missing_ok=True)
+            derivados.COLUMNAR_LOTES_FILE.unlink(missing_ok=True)
+            almacen.escribir_atomico(almacen.INVENTARIOS_FILE, almacen._json_texto(manifiesto['inventarios']))
+            almacen.escribir_atomico(almacen.HISTORIAL_FILE, almacen._json_texto(indice))
+    finally:
+        for zf in zips.values():
+            zf.close()
+    return informe
+
+
+def _tamano(n):
+    for unidad in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unidad == 'GB':
+            return f"{n:.0f} {unidad}" if unidad == 'B' else f"{n:.1f} {unidad}"
+        n /= 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copias de seguridad de FactuBAM en un único paquete")
+    parser.add_argument("accion", choices=("crear", "verificar", "restaurar"))
+    parser.add_argument("paquete")
+    parser.add_argument("--base", help="Copia anterior sobre la que hacer una incremental (crear)")
+    parser.add_argument("--espacio", default=almacen.ESPACIO_POR_DEFECTO,
+                        help="Espacio de trabajo (al restaurar se crea si no existe)")
+    parser.add_argument("--hilos", type=int, default=None, help="Hilos para verificar las sumas")
+    args = parser.parse_args()
+
+    try:
+        almacen.activar_espacio(args.espacio, crear=args.accion == "restaurar")
+    except (ValueError, LookupError) as e:
+        parser.error(str(e))
+
+    try:
+        if args.accion == "crear":
+            manifiesto = crear_paquete(args.paquete, args.base)
+            print(f"{len(manifiesto['indice'])} registro(s), {len(manifiesto['miembros'])} miembro(s) nuevos "
+                  f"-> {args.paquete} ({_tamano(Path(args.paquete).stat().st_size)})")
+        elif args.accion == "verificar":
+            informe = verificar_paquete(args.paquete, args.hilos)
+            print(f"{' <- '.join(informe['paquetes'])}: {informe['miembros']} miembro(s), {_tamano(informe['bytes'])}")
+            for miembro, error in informe['errores'].items():
+                print(f"❌ {miembro}: {error}")
+            for miembro in informe['faltan']:
+                print(f"❌ {miembro}: no está en ningún paquete de la cadena")
+            if informe['errores'] or informe['faltan']:
+                raise SystemExit(1)
+            print("✅ Paquete íntegro")
+        else:
+            informe = restaurar_paquete(args.paquete, args.hilos)
+            print(f"✅ {informe['registros']} registro(s) restaurados en el espacio "
+                  f"'{almacen.espacio_activo() or 'principal'}'")
+    except (ValueError, FileNotFoundError, zipfile.BadZipFile) as e:
+        print(f"❌ {e}")
+        raise SystemExit(1)
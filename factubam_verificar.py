@@ -0,0 +1,313 @@
+"""
+Verificación y reparación de `factubam_data/`.
+
+Recorre todo el directorio de datos calculando el MD5 de cada archivo en un pool
+de hilos y cruza el índice del historial y el de inventarios con lo que hay en
+disco: registros sin datos o con el JSON truncado, archivos huérfanos,
+temporales abandonados, duplicados y series de contadores desfasadas.
+
+    python factubam_verificar.py              # solo informe
+    python factubam_verificar.py --reparar    # repara y recoge la basura
+    python factubam_verificar.py --espacio sevilla
+
+La reparación se hace con el bloqueo del historial tomado y vuelve a comprobar
+cada caso antes de tocarlo. Los archivos de registros ilegibles no se borran:
+se apartan a `factubam_data/cuarentena/` para poder reprocesarlos.
+"""
+import argparse
+import json
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import factubam_almacen as almacen
+import factubam_core as core
+import factubam_derivados as derivados
+
+CUARENTENA_DIR = almacen.RutaEspacio("cuarentena")
+EDAD_MINIMA_TEMPORAL = 3600  # segundos; los más recientes pueden ser de una escritura en curso
+BLOQUE_MD5 = 1 << 20
+
+_PATRON_DOCUMENTO = re.compile(r'^(\d+)_(data\.json|factura\.pdf|inventario\.xlsx)$')
+_PATRON_INVENTARIO = re.compile(r'^(\d+)_(indice\.json|inventario\.xlsx)$')
+
+
+def _examinar(ruta):
+    """Tamaño, MD5 y, para los JSON, si se pueden leer completos"""
+    info = {
+        'ruta': ruta,
+        'bytes': ruta.stat().st_size,
+        'md5': almacen.calcular_md5_archivo(ruta, bloque_size=BLOQUE_MD5),
+        'json_valido': None
+    }
+    if ruta.suffix == '.json':
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                json.load(f)
+            info['json_valido'] = True
+        except (ValueError, UnicodeDecodeError):
+            info['json_valido'] = False
+    return info
+
+
+def _datos_legibles(registro_id):
+    """Si el _data.json del registro existe y se puede leer completo"""
+    try:
+        with open(almacen.DOCUMENTOS_DIR / f"{registro_id}_data.json", 'r', encoding='utf-8') as f:
+            json.load(f)
+    except (OSError, ValueError, UnicodeDecodeError):
+        return False
+    return True
+
+
+def _ids_en_series():
+    """Registros con serie según las líneas de SERIES_FILE (vale la última de cada id)"""
+    ids = set()
+    with open(almacen.SERIES_FILE, 'r', encoding='utf-8') as f:
+        for linea in f:
+            if not linea.endswith('\n'):
+                break  # una escritura que no terminó
+            registro_id, serie = json.loads(linea)
+            if serie is None:
+                ids.discard(registro_id)
+            else:
+                ids.add(registro_id)
+    return ids
+
+
+def _es_temporal_abandonado(ruta, ahora):
+    return ruta.name.endswith('.tmp') and ahora - ruta.stat().st_mtime > EDAD_MINIMA_TEMPORAL
+
+
+def verificar(max_workers=None):
+    """Examina factubam_data sin modificar nada; devuelve un informe (dict)"""
+    # Los demás espacios de trabajo cuelgan del de por defecto: se verifican por separado
+    otros_espacios = almacen.DATA_DIR / "espacios"
+    # La bandeja de entrada no es parte del historial (los PDF ya ingeridos se quedan en ella)
+    excluidos = {CUARENTENA_DIR.resolver(), core.BANDEJA_DIR.resolver(), otros_espacios}
+    # Ni los enlaces de una copia de factubam_snapshot.py en curso
+    excluidos.update(almacen.DATA_DIR.glob(".copia-*"))
+    rutas = [
+        ruta for ruta in almacen.DATA_DIR.rglob('*')
+        if ruta.is_file() and ruta != almacen.LOCK_FILE and excluidos.isdisjoint(ruta.parents)
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        archivos = {info['ruta']: info for info in pool.map(_examinar, rutas)}
+
+    informe = {
+        'archivos': len(archivos),
+        'bytes_totales': sum(info['bytes'] for info in archivos.values()),
+        'indice_ilegible': False,
+        'journal_pendiente': almacen.JOURNAL_FILE.exists(),
+        'ids_repetidos': [],
+        'registros_sin_datos': [],
+        'registros_datos_corruptos': [],
+        'inventarios_sin_archivos': [],
+        'huerfanos': [],
+        'temporales': [],
+        'duplicados': {},
+        'bytes_duplicados': 0,
+        'series_desfasadas': False,
+        'bytes_recuperables': 0
+    }
+
+    try:
+        indice = almacen.cargar_indice()
+    except ValueError:
+        # Sin índice no se puede saber qué es huérfano: solo se informa
+        informe['indice_ilegible'] = True
+        return informe
+
+    vistos = set()
+    for entrada in indice:
+        if entrada['id'] in vistos:
+            informe['ids_repetidos'].append(entrada['id'])
+        vistos.add(entrada['id'])
+
+        datos = archivos.get(almacen.DOCUMENTOS_DIR / f"{entrada['id']}_data.json")
+        if datos is None:
+            informe['registros_sin_datos'].append(entrada['id'])
+        elif not datos['json_valido']:
+            informe['registros_datos_corruptos'].append(entrada['id'])
+
+    try:
+        versiones = {v['id'] for v in almacen.cargar_inventarios()}
+    except ValueError:
+        versiones = None
+    if versiones is not None:
+        for version_id in sorted(versiones):
+            if not (almacen.INVENTARIOS_DIR / f"{version_id}_indice.json").exists():
+                informe['inventarios_sin_archivos'].append(version_id)
+
+    ahora = time.time()
+    por_md5 = defaultdict(list)
+    bytes_por_md5 = {}
+    for ruta, info in archivos.items():
+        if ruta.name.endswith('.tmp'):
+            if _es_temporal_abandonado(ruta, ahora):
+                informe['temporales'].append(almacen._relativa(ruta))
+                informe['bytes_recuperables'] += info['bytes']
+            continue
+
+        por_md5[info['md5']].append(almacen._relativa(ruta))
+        bytes_por_md5[info['md5']] = info['bytes']
+        if ruta.parent == almacen.DOCUMENTOS_DIR:
+            coincidencia = _PATRON_DOCUMENTO.match(ruta.name)
+            huerfano = coincidencia is not None and int(coincidencia.group(1)) not in vistos
+        elif ruta.parent == almacen.INVENTARIOS_DIR and versiones is not None:
+            coincidencia = _PATRON_INVENTARIO.match(ruta.name)
+            huerfano = coincidencia is not None and int(coincidencia.group(1)) not in versiones
+        else:
+            huerfano = False
+        if huerfano:
+            informe['huerfanos'].append(almacen._relativa(ruta))
+            informe['bytes_recuperables'] += info['bytes']
+
+    informe['duplicados'] = {md5: sorted(rutas) for md5, rutas in por_md5.items() if len(rutas) > 1}
+    # Lo que ocupan las copias sobrantes (una de cada grupo se considera la original)
+    informe['bytes_duplicados'] = sum(bytes_por_md5[md5] * (len(rutas) - 1) for md5, rutas in informe['duplicados'].items())
+
+    if almacen.SERIES_FILE.resolver() in archivos:
+        try:
+            informe['series_desfasadas'] = _ids_en_series() != vistos
+        except (ValueError, TypeError):
+            informe['series_desfasadas'] = True
+
+    return informe
+
+
+def reparar(informe):
+    """
+    Aplica las reparaciones del informe con el bloqueo tomado, comprobando de nuevo cada caso.
+    Devuelve la lista de acciones realizadas y los bytes recuperados.
+    """
+    acciones = []
+    recuperados = 0
+    if informe['indice_ilegible']:
+        return {'acciones': ["Índice ilegible: no se repara nada automáticamente"], 'bytes_recuperados': 0}
+
+    with almacen.bloqueo_historial():  # al tomarlo se rehace también el journal pendiente
+        if informe['journal_pendiente']:
+            acciones.append("Rehechas las transacciones pendientes del journal")
+
+        indice = almacen.cargar_indice()
+        if informe['ids_repetidos']:
+            unicos = {}
+            for entrada in indice:
+                unicos.setdefault(entrada['id'], entrada)
+            almacen.escribir_atomico(almacen.HISTORIAL_FILE, almacen._json_texto(list(unicos.values())))
+            indice = list(unicos.values())
+            acciones.append(f"Quitadas {len(informe['ids_repetidos'])} entrada(s) repetida(s) del índice")
+
+        ids = {entrada['id'] for entrada in indice}
+        # El informe se hizo sin el bloqueo: un registro guardado (o reescrito) después del
+        # recorrido ya puede tener sus datos completos, y entonces no se toca
+        ilegibles = [
+            registro_id for registro_id in informe['registros_sin_datos'] + informe['registros_datos_corruptos']
+            if registro_id in ids and not _datos_legibles(registro_id)
+        ]
+        if ilegibles:
+            CUARENTENA_DIR.mkdir(parents=True, exist_ok=True)
+            mover = [
+                [almacen._relativa(ruta), almacen._relativa(CUARENTENA_DIR / ruta.name)]
+                for registro_id in ilegibles
+                for ruta in almacen._archivos_registro(registro_id).values()
+                if ruta.exists()
+            ]
+            almacen._ejecutar_transaccion({'mover': mover, 'quitar': ilegibles})
+            derivados._actualizar_series(quitar=ilegibles)
+            derivados._actualizar_columnar()
+            ids -= set(ilegibles)
+            acciones.append(
+                f"Retirados del índice {len(ilegibles)} registro(s) ilegible(s); "
+                f"{len(mover)} archivo(s) apartados a {almacen._relativa(CUARENTENA_DIR)}/"
+            )
+
+        versiones = {v['id'] for v in almacen.cargar_inventarios()}
+        ahora = time.time()
+        borrados = 0
+        for relativa in informe['huerfanos'] + informe['temporales']:
+            ruta = almacen.DATA_DIR / relativa
+            if not ruta.exists():
+                continue
+            if ruta.name.endswith('.tmp'):
+                sigue_sobrando = _es_temporal_abandonado(ruta, ahora)
+            elif ruta.parent == almacen.DOCUMENTOS_DIR:
+                sigue_sobrando = int(_PATRON_DOCUMENTO.match(ruta.name).group(1)) not in ids
+            else:
+                sigue_sobrando = int(_PATRON_INVENTARIO.match(ruta.name).group(1)) not in versiones
+            if sigue_sobrando:
+                recuperados += ruta.stat().st_size
+                ruta.unlink()
+                borrados += 1
+        if borrados:
+            acciones.append(f"Borrados {borrados} archivo(s) huérfano(s) o temporal(es)")
+
+        if informe['series_desfasadas'] or ilegibles:
+            almacen.SERIES_FILE.unlink(missing_ok=True)
+            acciones.append("Series de contadores descartadas (se reconstruyen en la próxima lectura)")
+
+    return {'acciones': acciones, 'bytes_recuperados': recuperados}
+
+
+def _tamano(n):
+    for unidad in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unidad == 'GB':
+            return f"{n:.0f} {unidad}" if unidad == 'B' else f"{n:.1f} {unidad}"
+        n /= 1024
+
+
+def imprimir_informe(informe):
+    print(f"Archivos examinados: {informe['archivos']} ({_tamano(informe['bytes_totales'])})")
+    if informe['indice_ilegible']:
+        print("❌ historial.json no se puede leer")
+    if informe['journal_pendiente']:
+        print("⚠️ Hay transacciones pendientes en el journal")
+    etiquetas = [
+        ('ids_repetidos', "ids repetidos en el índice"),
+        ('registros_sin_datos', "registros sin _data.json"),
+        ('registros_datos_corruptos', "registros con _data.json truncado o ilegible"),
+        ('inventarios_sin_archivos', "versiones de inventario sin archivos"),
+        ('huerfanos', "archivos huérfanos"),
+        ('temporales', "temporales abandonados"),
+    ]
+    for clave, texto in etiquetas:
+        if informe[clave]:
+            print(f"⚠️ {len(informe[clave])} {texto}:")
+            for elemento in informe[clave]:
+                print(f"    {elemento}")
+    if informe['duplicados']:
+        print(f"ℹ️ {len(informe['duplicados'])} grupo(s) de archivos idénticos "
+              f"({_tamano(informe['bytes_duplicados'])} en copias):")
+        for rutas in informe['duplicados'].values():
+            resto = f" y {len(rutas) - 3} más" if len(rutas) > 3 else ""
+            print(f"    {', '.join(rutas[:3])}{resto}")
+    if informe['series_desfasadas']:
+        print("⚠️ Las series de contadores no cuadran con el índice")
+    print(f"Espacio recuperable: {_tamano(informe['bytes_recuperables'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica (y opcionalmente repara) factubam_data")
+    parser.add_argument("--reparar", action="store_true", help="Aplica las reparaciones y borra huérfanos y temporales")
+    parser.add_argument("--hilos", type=int, default=None, help="Hilos para calcular los MD5")
+    parser.add_argument("--json", action="store_true", help="Informe en JSON")
+    parser.add_argument("--espacio", default=almacen.ESPACIO_POR_DEFECTO, help="Espacio de trabajo (por defecto, el principal)")
+    args = parser.parse_args()
+
+    try:
+        almacen.activar_espacio(args.espacio, crear=False)
+    except (ValueError, LookupError) as e:
+        parser.error(str(e))
+
+    informe = verificar(args.hilos)
+    resultado = reparar(informe) if args.reparar else None
+    if args.json:
+        print(json.dumps({**informe, 'reparacion': resultado}, ensure_ascii=False, indent=2, default=str))
+    else:
+        imprimir_informe(informe)
+        if resultado is not None:
+            for accion in resultado['acciones']:
+                print(f"✅ {accion}")
+            print(f"Espacio recuperado: {_tamano(resultado['bytes_recuperados'])}")
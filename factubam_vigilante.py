@@ -0,0 +1,241 @@
+"""
+Vigilante de la bandeja de entrada de FactuBAM.
+
+Procesa sin intervención las facturas que se dejan en `factubam_data/bandeja/`
+(o en `factubam_data/espacios/<nombre>/bandeja/`): extrae el PDF, lo cruza con
+el inventario y la tarifa vigentes en la fecha de la factura y guarda el
+registro. Cada PDF se identifica por su MD5, así que una factura que ya está en
+el historial (subida a mano o copiada dos veces) no se vuelve a guardar.
+
+    python factubam_vigilante.py                    # todos los espacios, en bucle
+    python factubam_vigilante.py --una-vez          # una pasada y termina
+    python factubam_vigilante.py --espacio sevilla
+
+Con watchdog instalado reacciona en cuanto llega un archivo (inotify); sin él, o
+en carpetas de red donde los eventos no llegan, revisa las bandejas cada
+`--intervalo` segundos. La fecha de la factura se toma del nombre del archivo
+(`2025-03`, `20250315`, `11_2025`, `03-11-2025`...); si no la lleva, el PDF va a
+`errores/` para que se renombre, porque con otra fecha se cruzaría con el inventario
+y la tarifa equivocados. Después de procesarlo, el PDF pasa a `procesadas/`,
+`duplicadas/` o `errores/` (con el motivo en un .txt al lado) y se anota un aviso
+que la interfaz muestra.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+
+import factubam_almacen as almacen
+import factubam_core as core
+
+logger = logging.getLogger("factubam.vigilante")
+
+INTERVALO = int(os.environ.get("FACTUBAM_BANDEJA_INTERVALO", "60"))  # segundos entre pasadas
+ESPERA_ESTABLE = 5  # segundos sin cambios antes de dar un PDF por copiado entero
+INGERIDAS_FILE = almacen.RutaEspacio("bandeja/ingeridas.json")  # MD5 del PDF de cada registro (caché)
+SUBCARPETAS = {'guardado': "procesadas", 'duplicado': "duplicadas", 'error': "errores"}
+
+# Año primero (2025-03, 2025_03_15, 20250315) o a la española (11_2025, 03-11-2025)
+_PATRON_FECHA = re.compile(r'(?<!\d)(20\d\d)[-_.]?(0[1-9]|1[0-2])(?:[-_.]?(0[1-9]|[12]\d|3[01]))?(?!\d)')
+_PATRON_FECHA_ES = re.compile(r'(?<!\d)(?:(0?[1-9]|[12]\d|3[01])[-_.])?(0?[1-9]|1[0-2])[-_.](20\d\d)(?!\d)')
+
+
+def fecha_del_archivo(ruta):
+    """Fecha de la factura según el nombre (día 1 si solo lleva el mes); None si no la lleva"""
+    coincidencia = _PATRON_FECHA.search(ruta.stem)
+    if coincidencia:
+        anio, mes, dia = coincidencia.groups()
+    else:
+        coincidencia = _PATRON_FECHA_ES.search(ruta.stem)
+        if coincidencia is None:
+            return None
+        dia, mes, anio = coincidencia.groups()
+    try:
+        return date(int(anio), int(mes), int(dia or 1))
+    except ValueError:
+        return None  # 31-02-2025 y similares
+
+
+def _md5(contenido):
+    return hashlib.md5(contenido).hexdigest()
+
+
+def _md5_registro(entrada):
+    contenido = core.obtener_binario(entrada, 'pdf_bytes')
+    return _md5(contenido) if contenido else None
+
+
+def huellas_del_historial(max_workers=None):
+    """
+    {md5 del PDF: id} de los registros del espacio activo. Las huellas se guardan en la
+    bandeja y en cada pasada solo se calculan las de registros nuevos (también los subidos
+    a mano); las de registros borrados se olvidan, así que esa factura se puede volver a ingerir.
+    """
+    guardadas = {}
+    if INGERIDAS_FILE.exists():
+        try:
+            with open(INGERIDAS_FILE, 'r', encoding='utf-8') as f:
+                guardadas = json.load(f)
+        except ValueError:
+            logger.warning("Huellas de la bandeja ilegibles: se recalculan")
+
+    indice = {entrada['id']: entrada for entrada in almacen.cargar_indice()}
+    huellas = {int(i): md5 for i, md5 in guardadas.items() if int(i) in indice}
+    nuevas = [entrada for registro_id, entrada in indice.items() if registro_id not in huellas]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for entrada, md5 in zip(nuevas, pool.map(_md5_registro, nuevas)):
+            huellas[entrada['id']] = md5  # None si el registro no tiene PDF guardado
+
+    if nuevas or len(huellas) != len(guardadas):
+        almacen.escribir_atomico(INGERIDAS_FILE, almacen._json_texto({str(i): md5 for i, md5 in huellas.items()}))
+    return {md5: registro_id for registro_id, md5 in huellas.items() if md5}
+
+
+def _apartar(ruta, estado, motivo=None):
+    """Saca el PDF de la bandeja a la subcarpeta de su estado (sin pisar otro del mismo nombre)"""
+    carpeta = core.BANDEJA_DIR / SUBCARPETAS[estado]
+    carpeta.mkdir(exist_ok=True)
+    destino = carpeta / ruta.name
+    if destino.exists():
+        destino = carpeta / f"{ruta.stem}_{int(time.time() * 1000)}{ruta.suffix}"
+    os.replace(ruta, destino)
+    if motivo:
+        destino.with_name(f"{destino.name}.txt").write_text(motivo, encoding='utf-8')
+    return destino
+
+
+def procesar_archivo(ruta, huellas):
+    """Ingiere un PDF de la bandeja (salvo que ya esté en el historial); devuelve el aviso anotado"""
+    contenido = ruta.read_bytes()
+    md5 = _md5(contenido)
+    aviso = {'archivo': ruta.name, 'espacio': almacen.espacio_activo()}
+    fecha = fecha_del_archivo(ruta)
+    if md5 in huellas:
+        aviso.update(estado='duplicado', registro_id=huellas[md5])
+    elif fecha is None:
+        aviso.update(estado='error', detalle="El nombre del archivo no lleva la fecha de la factura "
+                                             "(p. ej. 2025-03, 11_2025 o 03-11-2025): renómbralo y déjalo otra vez en la bandeja")
+    else:
+        try:
+            registro = core.procesar_factura(ruta.stem, contenido, ruta.name, fecha)
+            core.anadir_registro(registro)
+        except Exception as e:
+            logger.exception(f"No se pudo ingerir {ruta}")
+            aviso.update(estado='error', detalle=str(e))
+        else:
+            huellas[md5] = registro['id']
+            aviso.update(
+                estado='guardado',
+                registro_id=registro['id'],
+                nombre=registro['nombre'],
+                fecha_factura=registro['fecha_factura'],
+                dispositivos=registro['dispositivos'],
+                coste_total_con_iva=registro['coste_total_con_iva'],
+                conciliacion=registro['conciliacion']['estado']
+            )
+    # Si el proceso muere antes de apartarlo, en la siguiente pasada sale como duplicado
+    _apartar(ruta, aviso['estado'], aviso.get('detalle'))
+    return core.anotar_aviso_bandeja(aviso)
+
+
+def revisar_bandeja():
+    """Una pasada por la bandeja del espacio activo: (avisos, PDF que aún se están copiando)"""
+    ahora = time.time()
+    listos, copiando = [], 0
+    for ruta in sorted(core.BANDEJA_DIR.iterdir()):
+        if not ruta.is_file() or ruta.suffix.lower() != '.pdf':
+            continue
+        if ahora - ruta.stat().st_mtime < ESPERA_ESTABLE:
+            copiando += 1
+        else:
+            listos.append(ruta)
+    if not listos:
+        return [], copiando
+    huellas = huellas_del_historial()
+    return [procesar_archivo(ruta, huellas) for ruta in listos], copiando
+
+
+def revisar_espacios(espacios=None):
+    """Revisa las bandejas de los espacios indicados (por defecto, de todos)"""
+    avisos, copiando = [], 0
+    for espacio in espacios if espacios is not None else almacen.listar_espacios():
+        with almacen.espacio_de_trabajo(espacio):
+            nuevos, pendientes = revisar_bandeja()
+        avisos.extend(nuevos)
+        copiando += pendientes
+    return avisos, copiando
+
+
+def _observador(despertar):
+    """Observador de watchdog que despierta el bucle cuando algo cambia en una bandeja; None sin watchdog"""
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class _Bandejas(FileSystemEventHandler):
+        def on_any_event(self, evento):
+            ruta = Path(getattr(evento, 'dest_path', '') or evento.src_path)
+            if ruta.parent.name == "bandeja" and ruta.suffix.lower() == '.pdf':
+                despertar.set()
+
+    observador = Observer()
+    observador.schedule(_Bandejas(), str(almacen.RAIZ_DATOS), recursive=True)
+    observador.start()
+    return observador
+
+
+def vigilar(espacios=None, intervalo=INTERVALO):
+    """Bucle del servicio: una pasada al arrancar y otra con cada evento o cada `intervalo` segundos"""
+    despertar = threading.Event()
+    observador = _observador(despertar)
+    logger.info(f"Vigilando las bandejas {'con inotify' if observador else 'por sondeo'} (cada {intervalo} s)")
+    try:
+        while True:
+            despertar.clear()
+            try:
+                avisos, copiando = revisar_espacios(espacios)
+            except Exception:
+                logger.exception("Error revisando las bandejas")
+                avisos, copiando = [], 0
+            for aviso in avisos:
+                logger.info(core.describir_aviso_bandeja(aviso))
+            # Un PDF a medio copiar se vuelve a mirar en cuanto puede estar completo
+            despertar.wait(ESPERA_ESTABLE if copiando else intervalo)
+    finally:
+        if observador is not None:
+            observador.stop()
+            observador.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingiere las facturas que llegan a la bandeja de entrada")
+    parser.add_argument("--espacio", action="append", help="Espacio a vigilar (se puede repetir; por defecto, todos)")
+    parser.add_argument("--intervalo", type=int, default=INTERVALO, help="Segundos entre pasadas sin eventos")
+    parser.add_argument("--una-vez", action="store_true", help="Hace una pasada y termina")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    espacios = None
+    if args.espacio:
+        try:
+            espacios = [almacen.activar_espacio(espacio, crear=False) for espacio in args.espacio]
+        except (ValueError, LookupError) as e:
+            parser.error(str(e))
+
+    if args.una_vez:
+        avisos, copiando = revisar_espacios(espacios)
+        for aviso in avisos:
+            print(core.describir_aviso_bandeja(aviso))
+        if copiando:
+            print(f"{copiando} PDF aún copiándose: se procesarán en la siguiente pasada")
+    else:
+        vigilar(espacios, args.intervalo)
@@ -0,0 +1,43 @@
+import sys
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import factubam_almacen as almacen
+import factubam_calculo as calculo
+import factubam_core as core
+import factubam_derivados as derivados
+
+
+@pytest.fixture
+def espacio(tmp_path, monkeypatch):
+    """Espacio por defecto vacío bajo tmp_path (factubam_data es relativo al directorio actual)"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(almacen, '_ESPACIOS_PREPARADOS', set())
+    monkeypatch.setattr(derivados, '_SERIES_CACHE', {})
+    monkeypatch.setattr(derivados, '_COLUMNAR_CACHE', {})
+    almacen.activar_espacio(almacen.ESPACIO_POR_DEFECTO)
+    return tmp_path / "factubam_data"
+
+
+def tabla_dispositivos(sns, bn=100, color=10):
+    return pd.DataFrame([
+        {'sn': sn, 'organismo': "Organismo", 'ubicacion': f"Planta {i}", 'estado': "Revisado",
+         'bn': bn, 'color': color, **calculo.calcular_linea_redondeada(bn, color)}
+        for i, sn in enumerate(sns)
+    ])
+
+
+@pytest.fixture
+def guardar_registro(espacio):
+    """Guarda un registro con unos S/N y devuelve el registro guardado"""
+    def guardar(nombre, sns, bn=100, color=10, fecha=date(2025, 1, 1)):
+        registro = core.crear_registro(nombre, b"%PDF-1.4 " + nombre.encode(), f"{nombre}.pdf", b"xlsx",
+                                       "inventario.xlsx", tabla_dispositivos(sns, bn, color), fecha_factura=fecha)
+        core.anadir_registro(registro)
+        return registro
+    return guardar
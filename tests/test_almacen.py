@@ -0,0 +1,74 @@
+import json
+
+import factubam_almacen as almacen
+
+
+def _anotar(*transacciones, cortada=None):
+    """Deja en el journal unas transacciones sin aplicar, como si el proceso hubiera muerto"""
+    with open(almacen.JOURNAL_FILE, 'w', encoding='utf-8') as f:
+        for transaccion in transacciones:
+            f.write(json.dumps(transaccion) + '\n')
+        if cortada:
+            f.write(cortada)
+
+
+def test_journal_rehace_mover_interrumpido(espacio):
+    tmp = almacen.DOCUMENTOS_DIR / "1_data.json.123.abcd.tmp"
+    tmp.write_text("[]", encoding='utf-8')
+    entrada = {'id': 1, 'nombre': "r1", 'revision': 0}
+    _anotar({'tx': "a", 'mover': [[almacen._relativa(tmp), "documentos/1_data.json"]], 'poner': [entrada]})
+
+    with almacen.bloqueo_historial():
+        pass
+
+    assert not tmp.exists()
+    assert (almacen.DOCUMENTOS_DIR / "1_data.json").read_text(encoding='utf-8') == "[]"
+    assert almacen.cargar_indice() == [entrada]
+    assert not almacen.JOURNAL_FILE.exists()
+
+
+def test_journal_rehace_mover_ya_aplicado_a_medias(espacio):
+    # El renombrado llegó a hacerse pero el índice no: rehacerla no debe fallar
+    (almacen.DOCUMENTOS_DIR / "1_data.json").write_text("[]", encoding='utf-8')
+    entrada = {'id': 1, 'nombre': "r1", 'revision': 0}
+    _anotar({'tx': "a", 'mover': [["documentos/1_data.json.123.abcd.tmp", "documentos/1_data.json"]],
+             'poner': [entrada]})
+
+    with almacen.bloqueo_historial():
+        pass
+
+    assert (almacen.DOCUMENTOS_DIR / "1_data.json").exists()
+    assert almacen.cargar_indice() == [entrada]
+
+
+def test_journal_rehace_borrar_interrumpido(espacio):
+    almacen.escribir_atomico(almacen.HISTORIAL_FILE, almacen._json_texto([{'id': 1}, {'id': 2}]))
+    for registro_id in (1, 2):
+        (almacen.DOCUMENTOS_DIR / f"{registro_id}_data.json").write_text("[]", encoding='utf-8')
+    _anotar({'tx': "b", 'quitar': [1],
+             'borrar': [almacen._relativa(ruta) for ruta in almacen._archivos_registro(1).values()]})
+
+    with almacen.bloqueo_historial():
+        pass
+
+    assert not (almacen.DOCUMENTOS_DIR / "1_data.json").exists()
+    assert (almacen.DOCUMENTOS_DIR / "2_data.json").exists()
+    assert almacen.cargar_indice() == [{'id': 2}]
+
+
+def test_journal_descarta_la_linea_cortada(espacio):
+    # La última transacción no llegó a anotarse entera: nunca se aplicó y se descarta
+    _anotar({'tx': "a", 'poner': [{'id': 1}]}, cortada='{"tx": "b", "vaciar": tr')
+
+    with almacen.bloqueo_historial():
+        pass
+
+    assert almacen.cargar_indice() == [{'id': 1}]
+    assert not almacen.JOURNAL_FILE.exists()
+
+
+def test_ejecutar_transaccion_cierra_el_journal(espacio):
+    with almacen.bloqueo_historial():
+        almacen._ejecutar_transaccion({'poner': [{'id': 7}]})
+    assert almacen.cargar_indice() == [{'id': 7}]
+    assert not almacen.JOURNAL_FILE.exists()
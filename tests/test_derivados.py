@@ -0,0 +1,85 @@
+import pytest
+
+import factubam_almacen as almacen
+import factubam_core as core
+import factubam_derivados as derivados
+from conftest import tabla_dispositivos
+
+
+def _descartar(tmp_path, contenido):
+    ruta = tmp_path / "series.jsonl"
+    ruta.write_bytes(contenido)
+    with open(ruta, 'r+b') as f:
+        derivados._descartar_linea_incompleta(f)
+        posicion = f.tell()
+    return ruta.read_bytes(), posicion
+
+
+def test_descartar_linea_incompleta_trunca_la_ultima(tmp_path):
+    contenido, posicion = _descartar(tmp_path, b'[1, null]\n[2, null]\n[3, {"fe')
+    assert contenido == b'[1, null]\n[2, null]\n'
+    assert posicion == len(contenido)
+
+
+def test_descartar_linea_incompleta_respeta_un_archivo_entero(tmp_path):
+    assert _descartar(tmp_path, b'[1, null]\n') == (b'[1, null]\n', 10)
+    assert _descartar(tmp_path, b'') == (b'', 0)
+
+
+def test_descartar_linea_incompleta_sin_ningun_salto(tmp_path):
+    assert _descartar(tmp_path, b'[1, {"fecha": ') == (b'', 0)
+
+
+def test_descartar_linea_incompleta_mas_larga_que_un_bloque(tmp_path):
+    # El salto queda más atrás que el primer bloque leído desde el final
+    completa = b'[1, null]\n'
+    contenido, posicion = _descartar(tmp_path, completa + b'x' * (3 << 16))
+    assert (contenido, posicion) == (completa, len(completa))
+
+
+def test_series_tras_una_linea_cortada(guardar_registro):
+    guardar_registro("r1", ["SN0000001", "SN0000002"])
+    with open(almacen.SERIES_FILE, 'ab') as f:
+        f.write(b'[123, {"fe')
+    guardar_registro("r2", ["SN0000001"])
+    series, _ = derivados.cargar_series()
+    assert sorted(serie['nombre'] for serie in series.values()) == ["r1", "r2"]
+
+
+def test_lotes_vigentes():
+    lotes = {'lotes': [[1, 0, 5], [2, 0, 5], [1, 1, 5]]}
+    assert derivados._lotes_vigentes(lotes, [{'id': 1}, {'id': 2}]) == [1, 2]
+    assert derivados._lotes_vigentes(lotes, [{'id': 2}]) == [1]
+    assert derivados._lotes_vigentes(lotes, [{'id': 1}, {'id': 3}]) is None
+
+
+def test_actualizar_columnar_compacta_los_lotes_muertos(guardar_registro):
+    pytest.importorskip("pyarrow")
+    sns = [f"SN{i:07d}" for i in range(10)]
+    r1 = guardar_registro("r1", sns)
+    r2 = guardar_registro("r2", sns)
+    generacion = derivados._leer_lotes_columnar()['generacion']
+
+    compactado = False
+    for bn in range(200, 260, 10):
+        r1['df'] = tabla_dispositivos(sns, bn=bn)
+        core.actualizar_registros([r1])
+
+        lotes = derivados._leer_lotes_columnar()
+        vigentes = derivados._lotes_vigentes(lotes, almacen.cargar_indice())
+        filas_totales = sum(filas for _, _, filas in lotes['lotes'])
+        filas_vigentes = sum(lotes['lotes'][posicion][2] for posicion in vigentes)
+        # Nunca quedan más filas muertas que las que admite FRACCION_COMPACTAR
+        assert filas_totales - filas_vigentes <= derivados.FRACCION_COMPACTAR * filas_totales
+        assert {lotes['lotes'][posicion][0] for posicion in vigentes} == {r1['id'], r2['id']}
+        revisiones = {lotes['lotes'][posicion][0]: lotes['lotes'][posicion][1] for posicion in vigentes}
+        assert revisiones[r1['id']] == r1['revision']
+
+        df = derivados.dispositivos_columnar()
+        assert len(df) == 20
+        assert set(df.loc[df['documento'] == "r1", 'bn']) == {bn}
+        compactado |= lotes['generacion'] != generacion
+        if compactado:
+            assert len(lotes['lotes']) == 2
+            break
+    assert compactado
@@ -0,0 +1,58 @@
+import zipfile
+
+import pytest
+
+import factubam_almacen as almacen
+import factubam_calculo as calculo
+import factubam_core as core
+import factubam_snapshot as snapshot
+
+
+def test_crear_verificar_restaurar(guardar_registro, tmp_path):
+    r1 = guardar_registro("r1", ["SN0000001", "SN0000002"])
+    r2 = guardar_registro("r2", ["SN0000001"], bn=250)
+    paquete = tmp_path / "copia.zip"
+
+    manifiesto = snapshot.crear_paquete(paquete)
+    assert set(manifiesto['registros']) == {str(r1['id']), str(r2['id'])}
+
+    informe = snapshot.verificar_paquete(paquete)
+    assert informe['registros'] == 2
+    assert informe['errores'] == {} and informe['faltan'] == []
+
+    with almacen.espacio_de_trabajo("restaurado"):
+        snapshot.restaurar_paquete(paquete)
+        indice = almacen.cargar_indice()
+        assert [entrada['id'] for entrada in indice] == [r1['id'], r2['id']]
+        for original, entrada in zip((r1, r2), indice):
+            restaurado = almacen.cargar_registro(entrada)
+            assert restaurado['pdf_bytes'] == original['pdf_bytes']
+            assert restaurado['df']['sn'].tolist() == original['df']['sn'].tolist()
+            assert calculo.total_euros(restaurado['df'], 'coste_con_iva') == original['coste_total_con_iva']
+        assert core.obtener_binario(indice[0], 'excel_bytes') == r1['excel_bytes']
+
+
+def test_verificar_paquete_detecta_un_miembro_danado(guardar_registro, tmp_path):
+    guardar_registro("r1", ["SN0000001"])
+    paquete = tmp_path / "copia.zip"
+    snapshot.crear_paquete(paquete)
+
+    danado = tmp_path / "danado.zip"
+    with zipfile.ZipFile(paquete) as origen, zipfile.ZipFile(danado, 'w') as destino:
+        for info in origen.infolist():
+            contenido = origen.read(info)
+            if info.filename not in (snapshot.MANIFIESTO, snapshot.SUMA_MANIFIESTO) and contenido:
+                contenido = contenido[:-1] + bytes([contenido[-1] ^ 1])
+            destino.writestr(info, contenido)
+
+    assert snapshot.verificar_paquete(danado)['errores']
+    with almacen.espacio_de_trabajo("restaurado"), pytest.raises(ValueError):
+        snapshot.restaurar_paquete(danado)
+
+
+def test_restaurar_exige_un_espacio_vacio(guardar_registro, tmp_path):
+    guardar_registro("r1", ["SN0000001"])
+    paquete = tmp_path / "copia.zip"
+    snapshot.crear_paquete(paquete)
+    with pytest.raises(ValueError, match="no está vacío"):
+        snapshot.restaurar_paquete(paquete)
@@ -0,0 +1,49 @@
+import factubam_almacen as almacen
+import factubam_derivados as derivados
+import factubam_verificar as verificar
+
+
+def test_reparar_borra_los_huerfanos(guardar_registro):
+    registro = guardar_registro("r1", ["SN0000001"])
+    huerfano = almacen.DOCUMENTOS_DIR / "999_data.json"
+    huerfano.write_text("[]", encoding='utf-8')
+
+    informe = verificar.verificar()
+    assert informe['huerfanos'] == ["documentos/999_data.json"]
+    assert informe['registros_sin_datos'] == [] and informe['registros_datos_corruptos'] == []
+
+    resultado = verificar.reparar(informe)
+    assert resultado['bytes_recuperados'] == 2
+    assert not huerfano.exists()
+    assert [entrada['id'] for entrada in almacen.cargar_indice()] == [registro['id']]
+    assert verificar.verificar()['huerfanos'] == []
+
+
+def test_reparar_aparta_un_registro_ilegible(guardar_registro):
+    sano = guardar_registro("sano", ["SN0000001"])
+    roto = guardar_registro("roto", ["SN0000002"])
+    datos = almacen.DOCUMENTOS_DIR / f"{roto['id']}_data.json"
+    datos.write_bytes(datos.read_bytes()[:20])  # escritura cortada
+
+    informe = verificar.verificar()
+    assert informe['registros_datos_corruptos'] == [roto['id']]
+
+    resultado = verificar.reparar(informe)
+    assert resultado['acciones']
+    assert [entrada['id'] for entrada in almacen.cargar_indice()] == [sano['id']]
+    assert (verificar.CUARENTENA_DIR / datos.name).exists()
+    assert not datos.exists()
+    # Las series se rehacen sin el registro retirado
+    series, _ = derivados.cargar_series()
+    assert list(series) == [str(sano['id'])]
+    assert verificar.verificar()['registros_datos_corruptos'] == []
+
+
+def test_reparar_un_registro_sin_datos(guardar_registro):
+    roto = guardar_registro("roto", ["SN0000001"])
+    (almacen.DOCUMENTOS_DIR / f"{roto['id']}_data.json").unlink()
+
+    informe = verificar.verificar()
+    assert informe['registros_sin_datos'] == [roto['id']]
+    verificar.reparar(informe)
+    assert almacen.cargar_indice() == []